@@ -2,7 +2,7 @@
 import logging
 import numpy as np
 import datetime
-from neurocaas_contrib.monitor import RangeFinder
+from neurocaas_contrib.monitor import RangeFinder,UsageTable
 import matplotlib as mpl
 import matplotlib.pyplot as plt
 from matplotlib.lines import Line2D
@@ -90,6 +90,70 @@ def get_logs(path):
 
     return logfiles
 
+def get_tables(path):
+    """Get names of all usage tables (written by neurocaas_contrib monitor visualize-parallelism):
+
+    :path: path to directory where we have log files. 
+    """
+    assert path is not None, "you must provide a valid path where log info is stored."
+    table_cands = os.listdir(path)
+    tables = [tc for tc in table_cands if tc.endswith("usage_table.npy")]
+
+    return tables
+
+def load_usage_tables(path,tablefiles):
+    """Load and concatenate usage tables, excluding datapoints we do not trust. Instances that appear in more than one table are counted once, using the most recently written table. 
+
+    :param path: path to the directory where usage tables are located.  
+    :param tablefiles: all the names of the usage tables.
+    :returns: UsageTable
+    """
+    tablefiles = sorted(tablefiles,key = lambda tf: os.path.getmtime(os.path.join(path,tf)))
+    data = np.concatenate([UsageTable.load(os.path.join(path,tf)).data for tf in tablefiles])
+    ## tables written by earlier runs (older versions wrote a new table on each run) overlap with later ones. 
+    _,last = np.unique(data["key"][::-1],return_index = True)
+    data = data[::-1][last]
+    ## filter out internal testing and some problem files. 
+    exclude = np.zeros(len(data),dtype = bool)
+    for prefix in ["reviewers","debuggers","examplegroup2"]:
+        exclude |= np.char.startswith(data["jobpath"],prefix)
+    exclude |= np.isin(data["jobpath"],["sawtelllab/results/job__dlc-ncap-web_1595302867","sawtelllabdlcdevelop/results/job__dlc-ncap-stable_20200720_16_47"])
+    exclude |= data["stack"] == "cianalysispermastack"
+    return UsageTable(data[~exclude])
+
+def process_usage_tables(path,tablefiles):
+    """Equivalent to process_log_files, but reads columnar usage tables instead of json logs, and computes per job statistics with vectorized group-bys. 
+
+    :param path: path to the directory where usage tables are located.  
+    :param tablefiles: all the names of the usage tables.
+    :returns: same as process_log_files.
+    """
+    table = load_usage_tables(path,tablefiles)
+    ## instances with neither a start nor an end time are skipped, as in calculate_parallelism. 
+    table = UsageTable(table.data[~(np.isnat(table.data["start"]) & np.isnat(table.data["end"]))])
+
+    ## negative and missing durations are set to zero. 
+    durations = np.clip(np.nan_to_num(table.durations()),0,None)
+    jobs,first,inverse,counts = np.unique(table.data["jobpath"],return_index = True,return_inverse = True,return_counts = True)
+    job_durations = np.bincount(inverse,weights = durations,minlength = len(jobs))
+    [rf.update(str(s)+"Z") for s in table.data["start"][first] if not np.isnat(s)]
+
+    all_parallelism = list(counts)
+    all_durations = {} 
+    for c,d in zip(counts,job_durations):
+        all_durations[c] = all_durations.get(c,0)+d
+    ## users are named by the group folder of the first dataset of each job. 
+    users = [datapath.split("/")[0] for datapath in table.data["datapath"][first]]
+    stacks = table.data["stack"][first]
+    all_users,all_user_durations,all_data,all_data_durations = {},{},{},{}
+    for u,s,c,d in zip(users,stacks,counts,job_durations):
+        all_users[u] = all_users.get(u,0)+c
+        all_user_durations[u] = all_user_durations.get(u,0)+d
+        all_data[s] = all_data.get(s,0)+c
+        all_data_durations[s] = all_data_durations.get(s,0)+d
+    count = int(np.sum(counts > 50))
+    return all_parallelism, all_durations, all_users, all_user_durations, all_data, all_data_durations, count        
+
 def process_log_files(path,logfiles):
     """Iterate through json logs, and extract useful information. Exclude datapoint we do not trust. 
 
@@ -179,10 +243,14 @@ if __name__ == "__main__":
     ## Find all log files. 
     rf = RangeFinder()
     path = sys.argv[1]
-    logfiles = get_logs(path)
+    tablefiles = get_tables(path)
     
-    ## get out the parallelism and duration data from log files: 
-    all_parallelism,all_durations, all_users, all_user_durations, all_data, all_data_durations ,count = process_log_files(path,logfiles)
+    ## get out the parallelism and duration data from usage tables if available, or log files otherwise: 
+    if len(tablefiles) > 0:
+        all_parallelism,all_durations, all_users, all_user_durations, all_data, all_data_durations ,count = process_usage_tables(path,tablefiles)
+    else:    
+        logfiles = get_logs(path)
+        all_parallelism,all_durations, all_users, all_user_durations, all_data, all_data_durations ,count = process_log_files(path,logfiles)
 
     ## Format durations
     duration_keys = list(all_durations.keys())
@@ -294,6 +362,21 @@ if __name__ == "__main__":
     plt.savefig(os.path.join(path,f"data_figure{now}.pdf"))
     plt.close()
 
+    ## Exact fleet concurrency (only available from usage tables): how long was spent at each number of concurrent instances.
+    if len(tablefiles) > 0:
+        fleet = load_usage_tables(path,tablefiles).concurrency()
+        logging.info("peak concurrency {}, average concurrency {}".format(fleet["peak"],fleet["average"]))
+        levels = np.array(list(fleet["histogram"].keys()))
+        hours = np.array(list(fleet["histogram"].values()))/3600
+        fig,ax = plt.subplots(figsize = (7,4))
+        ax.bar(levels,hours,log = True,edgecolor = "black")
+        ax.set_xlabel("Number of concurrent instances")
+        ax.set_ylabel("Total Hours")
+        ax.set_title("Fleet concurrency for NeuroCAAS web service,\n {} to {} (peak {}, mean {:.1f})".format(startdate,enddate,fleet["peak"],fleet["average"]),fontsize = 16)
+        plt.tight_layout()
+        plt.savefig(os.path.join(path,f"concurrency_figure{now}.pdf"))
+        plt.close()
+
 
     
 
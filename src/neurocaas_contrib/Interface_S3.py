@@ -3,13 +3,24 @@ Script to download a video from the relevant amazon S3 bucket into a temporary d
 '''
 import sys
 import os
+import io
 import boto3 
-from boto3.s3.transfer import S3Transfer 
+from boto3.s3.transfer import S3Transfer,TransferConfig,TransferManager
+from s3transfer.subscribers import BaseSubscriber
 import botocore 
 import threading
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from . import clients
 
-s3 = boto3.resource('s3')
-s3_client = boto3.client("s3")
+s3 = clients.lazy_resource("s3")
+s3_client = clients.lazy_client("s3")
+
+## settings for the shared transfer manager used by bulk transfers. Larger parts than the default (8 MB) mean fewer requests for large files. 
+default_chunksize = 8*1024*1024
+transfer_config = TransferConfig(multipart_threshold = 16*1024*1024,multipart_chunksize = 16*1024*1024,max_concurrency = 10)
+transfer_manager = None
+transfer_lock = threading.Lock()
 
 ## from https://stackoverflow.com/questions/41827963/track-download-progress-of-s3-file-using-boto3-and-callbacks
 class ProgressPercentage_d(object):
@@ -70,6 +81,17 @@ class ProgressPercentage_u(object):
                             percentage))
                 sys.stdout.flush()
 
+class ProgressSubscriber(BaseSubscriber):
+    """Adapts the progress callbacks above to the subscriber interface of the transfer manager. 
+
+    """
+    def __init__(self,callback):
+        self.callback = callback
+
+    def on_progress(self,future,bytes_transferred,**kwargs):
+        self.callback(bytes_transferred)
+
+
 def download(s3path,localpath,display = False):
     """Download function. Takes an s3 path to an object, and local object path as input.   
     :param s3path: full path to an object in s3. Assumes the s3://bucketname/key syntax. 
@@ -111,3 +133,216 @@ def upload(localpath,s3path,display = False):
         raise
 
 
+
+
+def get_transfer_manager():
+    """Get the transfer manager shared by bulk transfers. Transfers submitted to it share one pool of worker threads and connections. It is rebuilt if s3_client has been replaced. 
+
+    :return: boto3 TransferManager. 
+    """
+    global transfer_manager
+    with transfer_lock:
+        if transfer_manager is None or transfer_manager.client is not s3_client:
+            transfer_manager = TransferManager(s3_client,transfer_config)
+        return transfer_manager
+
+def get_etag(localpath,partsize = None):
+    """Calculate the etag that s3 would give a local file if it were uploaded in parts of the given size. 
+
+    :param localpath: path to a local file. 
+    :param partsize: (optional) size of parts in bytes. If not given, calculates the etag of a single part upload (the md5 hash of the file). 
+    :return: etag, without quotes. 
+    """
+    blocksize = 1024*1024
+    digests = []
+    with open(localpath,"rb") as f:
+        md5 = hashlib.md5()
+        filled = 0
+        for block in iter(lambda: f.read(blocksize if partsize is None else min(blocksize,partsize-filled)),b""):
+            md5.update(block)
+            filled += len(block)
+            if filled == partsize:
+                digests.append(md5)
+                md5 = hashlib.md5()
+                filled = 0
+        if filled > 0 or len(digests) == 0:
+            digests.append(md5)
+    if partsize is None:
+        return digests[0].hexdigest()
+    return "{}-{}".format(hashlib.md5(b"".join([d.digest() for d in digests])).hexdigest(),len(digests))
+
+def verify_download(localpath,size,etag):
+    """Check that a downloaded file matches the size and etag of the object it was downloaded from. Multipart etags can only be checked if the file was uploaded with the default part size of the aws cli and boto3, the part size of the shared transfer manager, or a whole number of MB per part; if none of these apply, only the size is checked. 
+
+    :param localpath: path to the downloaded file. 
+    :param size: size of the s3 object in bytes. 
+    :param etag: etag of the s3 object. If None, only the size is checked. 
+    """
+    localsize = os.path.getsize(localpath)
+    assert localsize == size, "size of {} ({} bytes) does not match s3 object ({} bytes)".format(localpath,localsize,size)
+    if etag is None:
+        return
+    etag = etag.strip('"')
+    if "-" not in etag:
+        assert get_etag(localpath) == etag, "checksum of {} does not match s3 object".format(localpath)
+        return
+    nparts = int(etag.split("-")[-1])
+    mb = 1024*1024
+    candidates = [default_chunksize,transfer_config.multipart_chunksize,-(-size//(nparts*mb))*mb]
+    candidates = [c for c in candidates if -(-size//c) == nparts]
+    if len(candidates) > 0:
+        assert any([get_etag(localpath,c) == etag for c in candidates]), "checksum of {} does not match s3 object".format(localpath)
+    else:    
+        print("Could not determine part size of {}, only checked size.".format(localpath))
+
+def get_md5_etag(head):
+    """Get the etag of an object, if it can be checked against a local copy. Objects encrypted with SSE-KMS or with customer provided keys have etags that are not md5 hashes of their contents. 
+
+    :param head: response of head_object for the object. 
+    :return: the etag, or None if it is not an md5 hash. 
+    """
+    if head.get("ServerSideEncryption","").startswith("aws:kms") or head.get("SSECustomerAlgorithm") is not None:
+        return None
+    return head["ETag"]
+
+def download_many(transfers,display = False,verify = True,cache = None,done = None):
+    """Download several objects concurrently over the shared transfer manager, so that the total time is close to that of the slowest single transfer. Each download is checked against the size and etag of its object. 
+
+    :param transfers: list of tuples (s3path, localpath), with paths in the same format as for download.
+    :param display: (optional) Defaults to false. If true, displays a progress bar for each download. 
+    :param verify: (optional) Defaults to true. If true, checks the size and checksum of downloaded files. Objects encrypted with SSE-KMS or customer provided keys do not have md5 etags, so only their size is checked.  
+    :param cache: (optional) a cache.InputCache. If given, objects found in the cache are placed from it instead of downloaded (and checked against the etag of the object if verify is true), and downloaded objects are added to the cache.   
+    :param done: (optional) a list. The dictionary describing each object (see return) is appended to it as soon as the object is in place, so that callers can tell which transfers completed if another one fails. 
+    :return: list of dictionaries giving the s3path, localpath, size, etag and versionid (or None) of each object, in the order given. 
+    """
+    manager = get_transfer_manager()
+
+    def fetch(transfer):
+        s3path,localpath = transfer
+        assert s3path.startswith("s3://")
+        bucketname,keyname = s3path.split("s3://")[-1].split("/",1)
+        try:
+            head = manager.client.head_object(Bucket = bucketname,Key = keyname)
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] == "404":
+                print("The object {} does not exist.".format(s3path))
+            raise
+        info = {"s3path":s3path,"localpath":localpath,"size":head["ContentLength"],"etag":head["ETag"].strip('"'),"versionid":head.get("VersionId")}
+        if cache is not None:
+            key = cache.get_key(head["ETag"],head["ContentLength"])
+            if cache.get(key,localpath,get_md5_etag(head) if verify else None):
+                print("Placed {} at {} from cache".format(s3path,localpath))    
+                if done is not None:
+                    done.append(info)
+                return info
+        ## in versioned buckets, pin the download to the version we checked. Otherwise, changes are caught by verification. 
+        extra_args = {}
+        if head.get("VersionId") is not None:
+            extra_args["VersionId"] = head["VersionId"]
+        subscribers = []
+        if display:
+            progress = ProgressPercentage_d(manager.client,bucketname,keyname,display = display)
+            subscribers = [ProgressSubscriber(progress)]
+        manager.download(bucketname,keyname,localpath,extra_args = extra_args,subscribers = subscribers).result()
+        if verify:
+            verify_download(localpath,head["ContentLength"],get_md5_etag(head))
+        if cache is not None:
+            cache.add(key,localpath)
+        print("Downloaded {} to {}".format(s3path,localpath))    
+        if done is not None:
+            done.append(info)
+        return info
+
+    if len(transfers) == 0:
+        return []
+    ## requests are bounded by the transfer manager, so more threads than that would only wait. 
+    with ThreadPoolExecutor(max_workers = min(len(transfers),transfer_config.max_concurrency)) as pool:
+        return list(pool.map(fetch,transfers))
+
+class S3ObjectReader(io.RawIOBase):
+    """Seekable, read-only file object for an s3 object, that reads with ranged GET requests instead of downloading the whole object. Each request reads ahead by at least blocksize bytes, and the last block is kept, so small sequential reads do not each make a request. Can be passed to zipfile.ZipFile to read members of an archive in s3 directly. Not thread safe: give each thread its own reader. 
+
+    """
+    def __init__(self,s3path,blocksize = 8*1024*1024,size = None):
+        """
+        :param s3path: full path to an object in s3. Assumes the s3://bucketname/key syntax. 
+        :param blocksize: (optional) minimum number of bytes to read per request. 
+        :param size: (optional) size of the object in bytes, if known. Otherwise, it is read with a HEAD request. 
+        """
+        assert s3path.startswith("s3://")
+        self.s3path = s3path
+        self.bucketname,self.keyname = s3path.split("s3://")[-1].split("/",1)
+        self.client = s3_client
+        if size is None:
+            size = self.client.head_object(Bucket = self.bucketname,Key = self.keyname)["ContentLength"]
+        self.size = size
+        self.blocksize = blocksize
+        self.position = 0
+        self.block_start = 0
+        self.block = b""
+        self.requests = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self,offset,whence = io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self.position+offset
+        elif whence == io.SEEK_END:
+            position = self.size+offset
+        else:    
+            raise ValueError("invalid whence ({})".format(whence))
+        if position < 0:
+            raise ValueError("negative seek position {}".format(position))
+        self.position = position
+        return self.position
+
+    def fetch(self,start,length):
+        """Read a range of the object into the block buffer. 
+
+        """
+        end = min(start+max(length,self.blocksize),self.size)-1
+        response = self.client.get_object(Bucket = self.bucketname,Key = self.keyname,Range = "bytes={}-{}".format(start,end))
+        self.block_start = start
+        self.block = response["Body"].read()
+        self.requests += 1
+
+    def readinto(self,buffer):
+        length = min(len(buffer),self.size-self.position)
+        if length <= 0:
+            return 0
+        offset = self.position-self.block_start
+        if offset < 0 or offset+length > len(self.block):
+            self.fetch(self.position,length)
+            offset = 0
+        buffer[:length] = self.block[offset:offset+length]
+        self.position += length
+        return length
+
+def upload_many(transfers,display = False):
+    """Upload several files concurrently over the shared transfer manager. Large files are uploaded in parts, which are also sent concurrently. 
+
+    :param transfers: list of tuples (localpath, s3path), with paths in the same format as for upload.
+    :param display: (optional) Defaults to false. If true, displays a progress bar for each upload. 
+    :return: total number of bytes uploaded. 
+    """
+    manager = get_transfer_manager()
+    futures = []
+    for localpath,s3path in transfers:
+        assert s3path.startswith("s3://")
+        bucketname,keyname = s3path.split("s3://")[-1].split("/",1)
+        subscribers = []
+        if display:
+            subscribers = [ProgressSubscriber(ProgressPercentage_u(localpath,display = display))]
+        futures.append(manager.upload(localpath,bucketname,keyname,subscribers = subscribers))
+    for future in futures:
+        future.result()
+    return sum([os.path.getsize(localpath) for localpath,s3path in transfers])
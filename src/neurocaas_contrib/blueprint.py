@@ -2,6 +2,7 @@
 import docker
 from collections import deque
 import json
+from . import clients
 
 class Blueprint(object):
     """Blueprint object to manage blueprint entry read/write.  
@@ -57,7 +58,7 @@ class Blueprint(object):
         if containername is None:
             return containername
         try:
-            client = docker.from_env()
+            client = clients.get_docker()
             cont = client.containers.get(containername)
             status = cont.status
             containernamestatus = f"{containername} ({status})"
@@ -0,0 +1,161 @@
+## Content-addressed cache of job inputs.
+## On warm or reused instances (and in local development), the same datasets and model files are often used by many jobs. Objects downloaded from s3 are kept in a cache directory, named by their etag and size, and placed in the io-dir of later jobs instead of being downloaded again.
+import os
+import shutil
+import stat
+import threading
+from .Interface_S3 import verify_download
+
+## default maximum size of the cache, in bytes.
+default_maxsize = 20*1024**3
+
+class InputCache(object):
+    """A directory of cached s3 objects, each stored under a key made from its etag and size, so that the same content is found again no matter what path it was registered under. Downloads are copied into the cache and made read-only there, so the job that downloaded an object keeps a writable file of its own. On a hit, the cached object is checked against the size (and optionally etag) it was stored under, then placed in the job's io-dir. 
+    Cached objects are hardlinked into place by default, so inputs found in the cache are read-only: jobs that need to modify an input in place should copy it first. Permissions do not stop root from writing through a link into the cache, so when running as root, cached objects are copied instead. When the cache grows past maxsize, the least recently used objects are evicted. Usage is tracked through file modification times, so several processes can share one cache directory.
+
+    """
+    def __init__(self,cachedir,maxsize = None,link = None):
+        """
+        :param cachedir: directory to keep cached objects in. Will be created if it does not exist.
+        :param maxsize: (optional) maximum total size of the cache in bytes. Defaults to the environment variable NEUROCAAS_CACHE_SIZE if set, and 20 GB otherwise.
+        :param link: (optional) if true, cached objects are hardlinked into place, and if false, they are copied. Defaults to linking unless running as root.
+        """
+        self.cachedir = os.path.abspath(cachedir)
+        os.makedirs(self.cachedir,exist_ok = True)
+        if maxsize is None:
+            maxsize = int(os.environ.get("NEUROCAAS_CACHE_SIZE",default_maxsize))
+        self.maxsize = maxsize
+        if link is None:
+            link = not (hasattr(os,"geteuid") and os.geteuid() == 0)
+        self.link = link
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+
+    @classmethod
+    def from_env(cls):
+        """Create a cache at the location given by the environment variable NEUROCAAS_CACHE_DIR.
+
+        :return: InputCache, or None if the variable is not set.
+        """
+        cachedir = os.environ.get("NEUROCAAS_CACHE_DIR")
+        if not cachedir:
+            return None
+        return cls(cachedir)
+
+    def get_key(self,etag,size):
+        """
+        :param etag: etag of an s3 object.
+        :param size: size of the s3 object in bytes.
+        :return: the name the object is cached under.
+        """
+        return "{}-{}".format(etag.strip('"'),size)
+
+    def get_path(self,key):
+        return os.path.join(self.cachedir,key)
+
+    def place(self,source,dest,link = True):
+        """Hardlink a file to a new location, replacing anything there. Falls back to copying if the two locations are on different filesystems.
+
+        :param link: if false, always copies.
+        """
+        if os.path.lexists(dest):
+            os.remove(dest)
+        if link:
+            try:
+                os.link(source,dest)
+                return
+            except OSError:
+                pass
+        shutil.copyfile(source,dest)
+
+    def check(self,key,path,etag = None):
+        """Check that a cached object still matches the key it was stored under.
+
+        :param key: the key of the object (see get_key).
+        :param path: path to the cached object.
+        :param etag: (optional) etag of the s3 object. If given, the checksum of the cached object is checked as well as its size.
+        :return: bool (True if the object matches).
+        """
+        size = int(key.rsplit("-",1)[-1])
+        if os.path.getsize(path) != size:
+            return False
+        if etag is not None:
+            try:
+                verify_download(path,size,etag)
+            except AssertionError:
+                return False
+        return True
+
+    def get(self,key,localpath,etag = None):
+        """Place a cached object at a local path, if it is in the cache. Cached objects that do not match their key are removed, and treated as missing.
+
+        :param key: the key of the object (see get_key).
+        :param localpath: path to place the object at.
+        :param etag: (optional) etag of the s3 object, to check the cached object against.
+        :return: bool (True if the object was found in the cache, False if not).
+        """
+        path = self.get_path(key)
+        try:
+            if not self.check(key,path,etag):
+                print("Cached object {} does not match its key, removing.".format(path))
+                os.remove(path)
+                raise FileNotFoundError(path)
+            ## mark the object as recently used.
+            os.utime(path)
+            self.place(path,localpath,self.link)
+        except FileNotFoundError: ## not cached, or evicted by another process.
+            with self.lock:
+                self.misses += 1
+            return False
+        with self.lock:
+            self.hits += 1
+            self.bytes_saved += os.path.getsize(localpath)
+        return True
+
+    def add(self,key,localpath):
+        """Copy a downloaded file into the cache, then evict old objects if the cache is too large. The downloaded file itself is left as it is.
+
+        :param key: the key of the object (see get_key).
+        :param localpath: path to the downloaded file.
+        """
+        path = self.get_path(key)
+        tmppath = "{}.tmp{}_{}".format(path,os.getpid(),threading.get_ident())
+        self.place(localpath,tmppath,link = False)
+        os.chmod(tmppath,stat.S_IRUSR|stat.S_IRGRP|stat.S_IROTH)
+        os.replace(tmppath,path)
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used objects until the cache is no larger than maxsize.
+
+        """
+        entries = []
+        for name in os.listdir(self.cachedir):
+            if ".tmp" in name:
+                continue
+            try:
+                info = os.stat(self.get_path(name))
+            except FileNotFoundError:
+                continue
+            entries.append((info.st_mtime,info.st_size,name))
+        total = sum([size for mtime,size,name in entries])
+        for mtime,size,name in sorted(entries):
+            if total <= self.maxsize:
+                break
+            try:
+                os.remove(self.get_path(name))
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def collect(self):
+        """Get the hit, miss and bytes saved counts since the last call, and reset them.
+
+        :return: dictionary with keys "hits", "misses" and "bytes_saved".
+        """
+        with self.lock:
+            stats = {"hits":self.hits,"misses":self.misses,"bytes_saved":self.bytes_saved}
+            self.hits,self.misses,self.bytes_saved = 0,0,0
+        return stats
@@ -27,6 +27,12 @@ if mode == "test":
     ## "separate for data storage during actual runs"
     storagename = ".neurocaas_contrib_storageloc_test.json" 
     storagepath = os.path.join(template_dir,storagename)
+    ## local index of usage logs. 
+    indexname = ".neurocaas_contrib_usage_test.db"
+    indexpath = os.path.join(template_dir,indexname)
+    ## local cache of lambda logs. 
+    logcachename = ".neurocaas_contrib_logcache_test"
+    logcachepath = os.path.join(template_dir,logcachename)
 
 else:    
     ## configuration file settings:
@@ -34,6 +40,10 @@ else:
     configpath = os.path.join(os.path.expanduser("~"),configname)
     storagename = ".neurocaas_contrib_storageloc.json" 
     storagepath = os.path.join(os.path.expanduser("~"),storagename)
+    indexname = ".neurocaas_contrib_usage.db"
+    indexpath = os.path.join(os.path.expanduser("~"),indexname)
+    logcachename = ".neurocaas_contrib_logcache"
+    logcachepath = os.path.join(os.path.expanduser("~"),logcachename)
 
 def save_ami_to_cli(ami,ctx):
     """Save a dictionary representing the development history to the cli's config file.
@@ -549,8 +559,8 @@ def monitor(ctx):
     """Job monitoring functions.
     """
 
-    from .monitor import calculate_parallelism, get_user_logs, postprocess_jobdict, JobMonitor,setup_polling
-    moddict = {"calculate_parallelism":calculate_parallelism,"get_user_logs":get_user_logs,"postprocess_jobdict":postprocess_jobdict,"JobMonitor":JobMonitor,"setup_polling":setup_polling}
+    from .monitor import calculate_parallelism, get_user_logs, postprocess_jobdict, JobMonitor,setup_polling,JobLedger,UsageIndex
+    moddict = {"calculate_parallelism":calculate_parallelism,"get_user_logs":get_user_logs,"postprocess_jobdict":postprocess_jobdict,"JobMonitor":JobMonitor,"setup_polling":setup_polling,"JobLedger":JobLedger,"UsageIndex":UsageIndex}
     ctx.obj["monitormod"] = moddict 
     return
 
@@ -565,21 +575,47 @@ def monitor(ctx):
         type = click.STRING,
         help = "name of the s3 bucket we want to get data for",
         default = None)
+@click.option("-x",
+        "--index",
+        help = "if true, bring the local usage index up to date (see ingest), and report from it instead of reading every log from s3.",
+        is_flag = True)
+@click.option("-i",
+        "--indexpath",
+        type = click.Path(dir_okay = False,resolve_path = True),
+        default = indexpath,
+        show_default = True,
+        help = "path to the usage index database.")
 @click.pass_obj
-def visualize_parallelism(blueprint,path,stackname):
+def visualize_parallelism(blueprint,path,stackname,index,indexpath):
     if stackname is None:
         analysis_name = convert_folder_to_stackname(blueprint["location"],blueprint["analysis_name"]) 
     else:    
         analysis_name = stackname    
-    user_dict = blueprint["monitormod"]["get_user_logs"](analysis_name)
-    for user,userinfo in user_dict.items():
-        parallelised = blueprint["monitormod"]["calculate_parallelism"](analysis_name,userinfo,user)
+    if index:
+        usage_index = open_usage_index(blueprint,indexpath,[analysis_name])
+        user_dict = usage_index.get_user_logs(analysis_name)
+        ledger = usage_index.get_ledger(analysis_name)
+        usage_index.close()
+    else:    
+        user_dict = blueprint["monitormod"]["get_user_logs"](analysis_name)
+        ## read all logs once, and compute per-user reports from the resulting ledger.
+        ledger = blueprint["monitormod"]["JobLedger"].from_user_logs(analysis_name,user_dict)
+    for user in user_dict.keys():
+        parallelised = ledger.get_parallelism(user)
         #postprocessed = blueprint["monitormod"]["postprocess_jobdict"](parallelised)
         postprocessed = parallelised
         now = str(datetime.datetime.now())
         write_path = os.path.join(path,f"{analysis_name}_{user}_{now}_parallel_logs.json")    
         with open(write_path,"w") as f:
             json.dump(postprocessed,f,indent = 4)
+    ## save the columnar usage table as well, for reuse by figures/parallelized.py. The table covers the whole history of the stack, so it replaces the one from any previous run. 
+    now = str(datetime.datetime.now())
+    ledger.table.save(os.path.join(path,f"{analysis_name}_usage_table.npy"))
+    ## exact concurrency of instances, for the whole stack and per user/job.
+    concurrency = {"stack":ledger.table.concurrency(),"user":ledger.table.concurrency("user"),"jobpath":ledger.table.concurrency("jobpath")}
+    with open(os.path.join(path,f"{analysis_name}_{now}_concurrency.json"),"w") as f:
+        json.dump(concurrency,f,indent = 4)
+    click.echo("peak concurrent instances: {}, average while busy: {:.2f}".format(concurrency["stack"]["peak"],concurrency["stack"]["average"]))
     
 @monitor.command(help = "see users of a given analysis.")
 @click.option("-s",
@@ -587,18 +623,67 @@ def visualize_parallelism(blueprint,path,stackname):
         type = click.STRING,
         default = None,
         help = "name of the stack folder that you want to get job manager requests for.")
+@click.option("-x",
+        "--index",
+        help = "if true, bring the local usage index up to date (see ingest), and report from it instead of reading every log from s3.",
+        is_flag = True)
+@click.option("-i",
+        "--indexpath",
+        type = click.Path(dir_okay = False,resolve_path = True),
+        default = indexpath,
+        show_default = True,
+        help = "path to the usage index database.")
 @click.pass_obj
-def see_users(blueprint,stackname):
+def see_users(blueprint,stackname,index,indexpath):
     if stackname is None:
         analysis_name = blueprint["analysis_name"] 
     else:
         analysis_name = convert_folder_to_stackname(blueprint["location"],stackname)    
     #user_dict = get_user_logs(analysis_name)
-    user_dict = blueprint["monitormod"]["get_user_logs"](analysis_name)
+    if index:
+        usage_index = open_usage_index(blueprint,indexpath,[analysis_name])
+        user_dict = usage_index.get_user_logs(analysis_name)
+        usage_index.close()
+    else:    
+        user_dict = blueprint["monitormod"]["get_user_logs"](analysis_name)
     userlist = [u+ ": "+str(us) for u,us in user_dict.items()]
     formatted = "\n".join(userlist)
     click.echo(formatted)
 
+@monitor.command(help = "update the local usage index with new logs from one or more stacks.")
+@click.option("-s",
+        "--stackname",
+        type = click.STRING,
+        multiple = True,
+        help = "name of the stack folder that you want to index logs for. Can be given multiple times.")
+@click.option("-i",
+        "--indexpath",
+        type = click.Path(dir_okay = False,resolve_path = True),
+        default = indexpath,
+        show_default = True,
+        help = "path to the usage index database.")
+@click.pass_obj
+def ingest(blueprint,stackname,indexpath):
+    if len(stackname) == 0:
+        stacknames = [blueprint["analysis_name"]]
+    else:    
+        stacknames = [convert_folder_to_stackname(blueprint["location"],s) for s in stackname]
+    open_usage_index(blueprint,indexpath,stacknames).close()
+
+def open_usage_index(blueprint,path,stacknames):
+    """Open the local usage index, and bring it up to date with the logs of the given stacks. 
+
+    :param blueprint: the click context object, with the monitor module loaded.
+    :param path: path to the index database. 
+    :param stacknames: names of the stacks to update. 
+    :return: the UsageIndex. 
+    """
+    usage_index = blueprint["monitormod"]["UsageIndex"](path)
+    for analysis_name in stacknames:
+        count = usage_index.ingest(analysis_name)
+        click.echo("{}: indexed {} new or updated logs, removed {} deleted logs.".format(analysis_name,count,usage_index.removed))
+    return usage_index
+
 @monitor.command(help = "print recent job manager requests.")    
 @click.option("-s",
         "--stackname",
@@ -615,8 +700,12 @@ def see_users(blueprint,stackname):
         type = click.INT,
         help = "the index of request you want to get (0 = most recent)",
         default = 0)
+@click.option("-f",
+        "--follow",
+        help = "if true, print new log events as they arrive (starting where the last follow left off) until interrupted.",
+        is_flag = True)
 @click.pass_obj
-def describe_job_manager_request(blueprint,stackname,hours,index):
+def describe_job_manager_request(blueprint,stackname,hours,index,follow):
     """UNTESTED
 
     """
@@ -624,8 +713,11 @@ def describe_job_manager_request(blueprint,stackname,hours,index):
         stackname = blueprint["analysis_name"] 
     else:    
         stackname = convert_folder_to_stackname(blueprint["location"],stackname)    
-    jm = blueprint["monitormod"]["JobMonitor"](stackname)    
-    jm.print_log(hours=hours,index=index)
+    jm = blueprint["monitormod"]["JobMonitor"](stackname,cache_dir = logcachepath)    
+    if follow:
+        jm.follow(hours=hours)
+    else:    
+        jm.print_log(hours=hours,index=index)
 
 @monitor.command(help = "print certificate file for submission. can give submitpath or groupname and timestamp.")    
 @click.option("-s",
@@ -768,8 +860,14 @@ def describe_datasets(blueprint,stackname,submitpath):
         help = "cutoff for logs (c-end)",
         default = 0
         )
+@click.option("-e",
+        "--end",
+        type = click.INT,
+        help = "end for logs (c-e). By default, print to the last line.",
+        default = None
+        )
 @click.pass_obj
-def describe_datastatus(blueprint,stackname,submitpath,groupname,timestamp,dataname,cutoff):
+def describe_datastatus(blueprint,stackname,submitpath,groupname,timestamp,dataname,cutoff,end):
     """UNTESTED
 
     """
@@ -786,7 +884,12 @@ def describe_datastatus(blueprint,stackname,submitpath,groupname,timestamp,datan
         datastatus= jm.get_datastatus_values(groupname,timestamp,dataname)
     try:
         text = datastatus.rawfile.pop("std")
-        list_text = [text[str(i)] for i in range(cutoff,len(text))]
+        if "std_chunks" in datastatus.rawfile:
+            ## chunked format: fetch only the chunks covering the requested lines. 
+            text = datastatus.get_lines(cutoff,end)
+            datastatus.rawfile.pop("std_chunks")
+        ## line indices may not start at zero, or be contiguous, if only recent lines were recorded. 
+        list_text = [text[key] for key in sorted(text,key = int) if int(key) >= cutoff and (end is None or int(key) < end)]
         formattext = "".join(list_text)
 
         formatted = [str(key)+": "+str(value) for key,value in datastatus.rawfile.items()]
@@ -831,17 +934,27 @@ def read_yaml(path,field,default = None):
 @scripting.command(help ="extract zipped folder into the same directory, and echo basename of the folder that is extracted.")
 @click.option("-z",
         "--zippath",
-        help = "path to zip file",
-        type = click.Path(exists = True,file_okay = True,readable = True,resolve_path = True)
+        help = "path to zip file. Can also be an s3 path (s3://bucket/key), to extract directly from s3 without downloading the archive first.",
+        type = click.STRING
         )
 @click.option("-o",
         "--outpath",
-        help = "directory in which to place the extracted directory- default to same directory.",
+        help = "directory in which to place the extracted directory- default to same directory (or the current directory for s3 paths).",
         type = click.Path(exists = True,dir_okay = True,readable = True,resolve_path = True),
         default = None
         )
-def parse_zip(zippath,outpath):
-    output = parse_zipfile(zippath,outpath)
+@click.option("-w",
+        "--workers",
+        help = "number of threads to extract members of the zip file with.",
+        type = click.INT,
+        default = 1
+        )
+def parse_zip(zippath,outpath,workers):
+    if not zippath.startswith("s3://"):
+        zippath = os.path.abspath(zippath)
+        if not os.path.exists(zippath):
+            raise click.BadParameter("Path '{}' does not exist.".format(zippath),param_hint = "'-z' / '--zippath'")
+    output = parse_zipfile(zippath,outpath,workers)
     click.echo(output)
 
 
@@ -873,15 +986,20 @@ def workflow(ctx):
         "--path",
         help = "location where we will store and register data.",
         type = click.Path(exists = True,file_okay = False, dir_okay= True, resolve_path = True))
+@click.option("-c",
+        "--cachedir",
+        help = "directory to cache inputs downloaded from s3 in, to reuse them in later jobs. Defaults to the environment variable NEUROCAAS_CACHE_DIR if set.",
+        default = None,
+        type = click.Path(file_okay = False, dir_okay= True, resolve_path = True))
 @click.pass_obj
-def initialize_job(obj,path):
+def initialize_job(obj,path,cachedir):
     """Initialize data storage location, and write to a storage file: 
 
     """
     storage = {}
     storage["path"] = path 
     ## create scriptmanager: 
-    ncsm = NeuroCAASScriptManager(path)
+    ncsm = NeuroCAASScriptManager(path,cachedir = cachedir)
     with open(storagepath,"w") as f:
         json.dump(storage,f)
         
@@ -1101,6 +1219,38 @@ def get_file(obj,name,outputpath,force,display):
     kwargs["display"] = display   
     ncsm.get_file(**kwargs)
 
+@workflow.command(help = "get all registered inputs (dataset, config and files) at once, downloading them concurrently.")
+@click.option("-o",
+        "--outputpath",
+        help = "path to write all inputs to.",
+        default = None)
+@click.option("-f",
+        "--force",
+        help = "if true, will redownload even if exists at intended output location",
+        is_flag = True)
+@click.option("-d",
+        "--display",
+        help = "if true, will show download progress",
+        is_flag = True)
+@click.option("-n",
+        "--no-verify",
+        help = "if true, will not check the size and checksum of downloads",
+        is_flag = True)
+@click.pass_obj
+def get_all(obj,outputpath,force,display,no_verify):
+    """Gets all registered inputs. 
+
+    """
+    path = obj["storage"]["path"]
+    ncsm = NeuroCAASScriptManager.from_registration(path)
+    kwargs = {}
+    if outputpath is not None:
+        kwargs["path"] = outputpath
+    kwargs["force"] = force   
+    kwargs["display"] = display   
+    kwargs["verify"] = not no_verify
+    ncsm.stage_all(**kwargs)
+
 @workflow.command(help = "put a file into the result directory in s3")
 @click.option("-r",
         "--resultpath",
@@ -1122,6 +1272,32 @@ def put_result(obj,resultpath,display):
     kwargs["display"] = display   
     ncsm.put_result(**kwargs)
 
+@workflow.command(help = "put a directory into the result directory in s3, uploading files concurrently and skipping files that have not changed since the last upload.")
+@click.option("-r",
+        "--resultdir",
+        help = "local location of result directory",
+        type = click.Path(exists = True,file_okay = False,dir_okay = True,resolve_path = True))
+@click.option("-f",
+        "--force",
+        help = "if true, will upload all files, even if they have not changed since the last upload",
+        is_flag = True)
+@click.option("-d",
+        "--display",
+        help = "if true, will show upload progress",
+        is_flag = True)
+@click.pass_obj
+def put_results(obj,resultdir,force,display):
+    """puts a local directory at the registered s3 location. 
+
+    """
+    path = obj["storage"]["path"]
+    ncsm = NeuroCAASScriptManager.from_registration(path)
+    kwargs = {}
+    kwargs["localdir"] = resultdir
+    kwargs["force"] = force   
+    kwargs["display"] = display   
+    ncsm.put_results_dir(**kwargs)
+
 @workflow.command(help = "get the name of the dataset you registered")    
 @click.pass_obj
 def get_dataname(obj):
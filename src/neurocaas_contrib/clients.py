@@ -0,0 +1,119 @@
+## Shared registry of AWS and docker clients.
+## Clients are expensive to construct (boto3 loads service models and resolves endpoints, docker may contact the daemon), and most commands only use a few of them. Modules therefore declare their clients as lazy proxies at import time: each client is built the first time it is used, and cached here so that all modules share it.
+import os
+import threading
+
+registry = {}
+lock = threading.Lock()
+
+def get(name,factory):
+    """Get the object registered under a given name, building it with the given factory on first use.
+
+    :param name: name of the object in the registry.
+    :param factory: function with no arguments that builds the object.
+    :return: the registered object.
+    """
+    with lock:
+        if name not in registry:
+            registry[name] = factory()
+        return registry[name]
+
+def built():
+    """Get the names of the objects that have been built so far.
+
+    :return: list of names.
+    """
+    with lock:
+        return list(registry.keys())
+
+def reset():
+    """Remove all objects from the registry, so that they are rebuilt on next use.
+
+    """
+    with lock:
+        registry.clear()
+
+def build_boto3(kind,service,kwargs):
+    """Build a boto3 client or resource.
+
+    :param kind: "client" or "resource".
+    :param service: name of the aws service.
+    :param kwargs: additional keyword arguments to boto3.
+    :return: boto3 client or resource.
+    """
+    import boto3
+    from botocore.exceptions import NoRegionError
+    factory = getattr(boto3,kind)
+    try:
+        return factory(service,**kwargs)
+    except NoRegionError: ## if building on readthedocs, read the region in from environment variables:
+        return factory(service,region_name = os.environ["REGION"],**kwargs)
+
+def build_docker():
+    import docker
+    return docker.from_env()
+
+def get_client(service,name = None,**kwargs):
+    """Get the shared boto3 client for a service.
+
+    :param service: name of the aws service.
+    :param name: (optional) name to register the client under. Give a name if passing keyword arguments, to keep clients with different configurations apart.
+    :return: boto3 client.
+    """
+    return get(name or "client:{}".format(service),lambda: build_boto3("client",service,kwargs))
+
+def get_resource(service,name = None,**kwargs):
+    """Get the shared boto3 resource for a service. See get_client.
+
+    """
+    return get(name or "resource:{}".format(service),lambda: build_boto3("resource",service,kwargs))
+
+def get_docker():
+    """Get the shared docker client.
+
+    """
+    return get("docker",build_docker)
+
+class LazyClient(object):
+    """Proxy for an object in the registry. The object is built on first attribute access, and all attribute access is forwarded to it. Assign one of these at module level wherever a client used to be built at import time.
+
+    """
+    def __init__(self,name,factory):
+        """
+        :param name: name of the object in the registry.
+        :param factory: function with no arguments that builds the object.
+        """
+        object.__setattr__(self,"_name",name)
+        object.__setattr__(self,"_factory",factory)
+
+    def _get(self):
+        return get(self._name,self._factory)
+
+    def __getattr__(self,attr):
+        return getattr(self._get(),attr)
+
+    def __setattr__(self,attr,value):
+        setattr(self._get(),attr,value)
+
+    def __repr__(self):
+        return "LazyClient({})".format(self._name)
+
+def lazy_client(service,name = None,**kwargs):
+    """Get a lazy proxy for the shared boto3 client for a service. See get_client.
+
+    """
+    name = name or "client:{}".format(service)
+    return LazyClient(name,lambda: build_boto3("client",service,kwargs))
+
+def lazy_resource(service,name = None,**kwargs):
+    """Get a lazy proxy for the shared boto3 resource for a service. See get_client.
+
+    """
+    name = name or "resource:{}".format(service)
+    return LazyClient(name,lambda: build_boto3("resource",service,kwargs))
+
+def lazy_docker():
+    """Get a lazy proxy for the shared docker client.
+
+    """
+    return LazyClient("docker",build_docker)
@@ -13,6 +13,7 @@ import pathlib
 import docker
 from .log import NeuroCAASCertificate,NeuroCAASDataStatus
 from .connect import SSHConnection,FTPConnection
+from . import clients
 
 if "pytest" in sys.modules:
     mode = "test"
@@ -23,12 +24,18 @@ subdirs = ["configs","inputs","logs","results"]
 
 #cfn_client = boto3.client("cloudformation")
 
-docker_client = docker.from_env()
-if docker_client.api.base_url == "http://localhost:2375":
-    docker_host = "remote"
-    ## Open connection to remote via paramiko:
-else: 
-    docker_host = "local"
+docker_client = clients.lazy_docker()
+
+def get_docker_host():
+    """Check if the docker daemon is local, or a remote daemon reached through a forwarded port. 
+
+    :return: "remote" or "local".
+    """
+    if docker_client.api.base_url == "http://localhost:2375":
+        ## Open connection to remote via paramiko:
+        return "remote"
+    else: 
+        return "local"
 
 if mode == "std":
     default_tag = "latest"
@@ -408,6 +415,7 @@ class NeuroCAASImage(object):
         rawstatus = datastatus.container.status
         time.sleep(loginterval)
         datastatus.update_file()
+        datastatus.finish_usage(os.path.join(logjobpath,"DATASET_NAME-{}_USAGE.json".format(dataname)))
         status = datastatus.rawfile["status"]
         updatedict = {
             "t" : datetime.datetime.now().strftime("%Y_%m_%d_%H_%M_%S"),
@@ -419,6 +427,7 @@ class NeuroCAASImage(object):
         datastatus.write_local(os.path.join(logjobpath,"DATASET_NAME-{}_STATUS.json".format(dataname)))
         certificate.update_instance_info(updatedict)
         certificate.write_local(os.path.join(logjobpath,"certificate.txt"))
+        datastatus.close()
         env.sync_get()
 
 class NeuroCAASEnv(object):
@@ -1,4 +1,13 @@
 import datetime
+import time
+import copy
+import atexit
+import gzip
+import codecs
+import threading
+import tempfile
+import weakref
+from collections import deque
 import subprocess
 import shlex
 import psutil
@@ -6,18 +15,18 @@ from collections import OrderedDict
 import pdb
 import re
 import json
+import hashlib
 import os
-import docker
 import sys
-import boto3
+from . import clients
 from urllib.parse import urlparse
-from botocore.exceptions import ClientError
+from botocore.exceptions import ClientError,ParamValidationError
 import traceback
 
 filepath = os.path.realpath(__file__)
-client = docker.from_env()
+client = clients.lazy_docker()
 
-s3_resource = boto3.resource("s3")
+s3_resource = clients.lazy_resource("s3")
 divider = "================"
 localdata_dict = {
         "certificate_base":os.path.join(os.path.dirname(filepath),"template_mats/certificate.txt"),
@@ -38,11 +47,12 @@ def find_linebreaks(tup):
     """
     return tup[1] == divider
 
-def load_file_s3(bucket_name, key):
-    """ """
+def load_file_s3(bucket_name, key, return_etag = False):
+    """ Load the contents of a file in s3 as a string. If return_etag is true, returns a tuple (content,etag) instead. """
     try:
         file_object = s3_resource.Object(bucket_name, key)
-        raw_content = file_object.get()['Body'].read() 
+        response = file_object.get()
+        raw_content = response['Body'].read() 
     except ValueError as ve:
         print("Error loading config file. Error is: {}".format(ve))
         raise ValueError
@@ -50,13 +60,127 @@ def load_file_s3(bucket_name, key):
         e = ce.response["Error"]["Code"]
         print("Encountered AWS Error: {}".format(e))
         raise ValueError
+    if return_etag:
+        return raw_content.decode("utf-8"),response["ETag"]
     return raw_content.decode("utf-8")
 
+class UploadQueue(object):
+    """Uploads objects to s3 from a single background thread, so that callers never wait on the network. Only the latest version of each key is kept: if a key is submitted again before it has been uploaded, the earlier version is dropped, and the key moves to the back of the queue. Keys are otherwise uploaded in the order they were submitted. Failed uploads are retried with exponential backoff, unless a newer version of the key has been submitted in the meantime. Call flush to wait until everything submitted so far has been uploaded, and to find out if any uploads failed. The module level upload_queue is drained when the interpreter exits. 
+
+    """
+    def __init__(self,retries = 4,backoff = 1):
+        """
+        :param retries: number of times to retry a failed upload before giving up. 
+        :param backoff: number of seconds to wait before the first retry. Doubles with each retry. 
+        """
+        self.retries = retries
+        self.backoff = backoff
+        ## key -> (upload, number of failed attempts, earliest time of the next attempt). 
+        self.pending = OrderedDict()
+        self.inflight = 0
+        self.uploads = 0 ## number of uploads made. 
+        self.coalesced = 0 ## number of uploads dropped because a newer version was submitted. 
+        self.errors = [] ## uploads that failed after all retries, since the last flush. 
+        self.cond = threading.Condition()
+        self.stopped = False
+        self.thread = None
+
+    def submit(self,key,upload):
+        """Submit an upload. 
+
+        :param key: identifier of the object being uploaded, i.e. (bucket,key). 
+        :param upload: function with no arguments that performs the upload. 
+        """
+        with self.cond:
+            if key in self.pending:
+                self.pending.pop(key)
+                self.coalesced += 1
+            self.pending[key] = (upload,0,0)
+            if self.thread is None or not self.thread.is_alive():
+                self.stopped = False
+                self.thread = threading.Thread(target = self.run,daemon = True)
+                self.thread.start()
+            self.cond.notify_all()
+
+    def next_ready(self):
+        """Get the first pending upload that is not waiting to be retried. 
+
+        :return: tuple (key, (upload, attempts, ready time)), or the number of seconds until an upload is ready. 
+        """
+        now = time.time()
+        for key,item in self.pending.items():
+            if item[2] <= now:
+                return key,item
+        return min([item[2] for item in self.pending.values()])-now
+
+    def run(self):
+        while True:
+            with self.cond:
+                while True:
+                    if len(self.pending) == 0:
+                        if self.stopped:
+                            return
+                        self.cond.wait()
+                        continue
+                    ready = self.next_ready()
+                    if isinstance(ready,tuple):
+                        break
+                    self.cond.wait(ready)
+                key,(upload,attempts,readytime) = ready
+                self.pending.pop(key)
+                self.inflight += 1
+            try:
+                upload()
+                failed = None
+            except Exception as e: ## failed uploads should not stop later ones. 
+                failed = e
+            with self.cond:
+                self.inflight -= 1
+                if failed is None:
+                    self.uploads += 1
+                elif key in self.pending: ## a newer version will be uploaded instead. 
+                    pass
+                elif attempts < self.retries:
+                    self.pending[key] = (upload,attempts+1,time.time()+self.backoff*2**attempts)
+                else:    
+                    print("Upload of {} failed after {} attempts: {}".format(key,attempts+1,failed))
+                    self.errors.append((key,failed))
+                self.cond.notify_all()
+
+    def flush(self,timeout = None):
+        """Wait until all submitted uploads have been made (or have failed after all retries). 
+
+        :param timeout: (optional) maximum number of seconds to wait. 
+        :return: True if all uploads were made, False if we timed out, or if any upload failed since the last flush. 
+        """
+        with self.cond:
+            done = self.cond.wait_for(lambda: len(self.pending) == 0 and self.inflight == 0,timeout)
+            failed = len(self.errors) > 0
+            self.errors = []
+        return done and not failed
+
+    def close(self,timeout = 60):
+        """Upload everything that is pending, and stop the background thread. 
+
+        :param timeout: maximum number of seconds to wait for pending uploads. 
+        """
+        done = self.flush(timeout)
+        with self.cond:
+            if not done:
+                print("Upload queue closed with {} uploads pending.".format(len(self.pending)))
+            self.stopped = True
+            self.cond.notify_all()
+        return done
+
+upload_queue = UploadQueue()
+atexit.register(upload_queue.close)
+
 class WriteObj(object):
     """Wrapper to handle cases where we want to write to local or to s3. If s3, acts like an s3 resource object. If local, acts like a standard file object.
+    If given an UploadQueue, writes to s3 are made asynchronously through that queue (except conditional writes, which need the result).
 
     """
-    def __init__(self,init_dict):
+    def __init__(self,init_dict,queue = None):
         """Initialization determines whether we will write to local or remote. The init_dict should have the following format: 
         {
             loc:["s3","local"],
@@ -65,22 +189,32 @@ class WriteObj(object):
             key:"key"
         }
         :param init_dict: Initialization dictionary. If loc = s3, bucket and key parameters are required. If loc = local, localpath is required. 
+        :param queue: (optional) an UploadQueue to make writes to s3 through. 
         """
         assert init_dict["loc"] in ["s3","local"], "Location argument must be 's3' or 'local'"
         self.init_dict = init_dict
+        self.queue = queue
         if self.init_dict["loc"] is "s3":
             assert self.init_dict.get("bucket",False) and self.init_dict.get("key","False"),"Params bucket,key must be specified. "
         elif self.init_dict["loc"] is "local":
             assert self.init_dict.get("localpath",False),"Param localpath must be specified. "
 
-    def put(self,stringbody): 
+    def put(self,stringbody,if_match = None): 
         """String to put at the object represented by this instance. 
 
         :param stringbody: a string representing the body of this object.
+        :param if_match: (optional) if given and writing to s3, only write if the object's current ETag matches this one. Raises a ClientError (PreconditionFailed) otherwise, or a ParamValidationError if the installed version of botocore does not support conditional writes. 
+        :return: the ETag of the written object if writing to s3 synchronously.
         """
-        if self.init_dict["loc"] == "s3":
+        if self.init_dict["loc"] == "s3" and self.queue is not None and if_match is None:
+            self.put_async(stringbody.encode("utf-8"))
+        elif self.init_dict["loc"] == "s3":
             writeobj = s3_resource.Object(self.init_dict["bucket"],self.init_dict["key"])
-            writeobj.put(Body=stringbody.encode("utf-8"))
+            if if_match is None:
+                response = writeobj.put(Body=stringbody.encode("utf-8"))
+            else:    
+                response = writeobj.put(Body=stringbody.encode("utf-8"),IfMatch = if_match)
+            return response.get("ETag")
         elif self.init_dict["loc"] == "local":
             with open(self.init_dict["localpath"],"wb") as f:
                 f.write(stringbody.encode("utf-8"))
@@ -90,12 +224,85 @@ class WriteObj(object):
 
         :param dictbody: a dictionary representing the body of this object.
         """
-        if self.init_dict["loc"] == "s3":
+        if self.init_dict["loc"] == "s3" and self.queue is not None:
+            self.put_async(json.dumps(dictbody,indent = 4).encode("utf-8"))
+        elif self.init_dict["loc"] == "s3":
             writeobj = s3_resource.Object(self.init_dict["bucket"],self.init_dict["key"])
             writeobj.put(Body=json.dumps(dictbody,indent = 4).encode("utf-8"))
         elif self.init_dict["loc"] == "local":
             with open(self.init_dict["localpath"],"w") as f:
                 json.dump(dictbody,f,indent = 4)
+
+    def put_bytes(self,body): 
+        """Bytes to put at the object represented by this instance.  
+
+        :param body: bytes representing the body of this object.
+        """
+        if self.init_dict["loc"] == "s3" and self.queue is not None:
+            self.put_async(body)
+        elif self.init_dict["loc"] == "s3":
+            writeobj = s3_resource.Object(self.init_dict["bucket"],self.init_dict["key"])
+            writeobj.put(Body=body)
+        elif self.init_dict["loc"] == "local":
+            os.makedirs(os.path.dirname(os.path.abspath(self.init_dict["localpath"])),exist_ok = True)
+            with open(self.init_dict["localpath"],"wb") as f:
+                f.write(body)
+
+    def put_async(self,body):
+        """Submit bytes to be put at the s3 object represented by this instance through the upload queue. The body is captured now, so it is safe to keep modifying the source of the body. 
+
+        :param body: bytes representing the body of this object. 
+        """
+        bucket,key = self.init_dict["bucket"],self.init_dict["key"]
+        self.queue.submit((bucket,key),lambda: s3_resource.Object(bucket,key).put(Body = body))
+
+    def flush(self,timeout = None):
+        """Wait for asynchronous writes to be made. 
+
+        :param timeout: (optional) maximum number of seconds to wait. 
+        :return: True if all writes were made. 
+        """
+        if self.queue is None:
+            return True
+        return self.queue.flush(timeout)
+
+    def get_bytes(self): 
+        """Get the current contents of the object represented by this instance. 
+
+        :return: bytes. 
+        """
+        if self.init_dict["loc"] == "s3":
+            self.flush()
+            return s3_resource.Object(self.init_dict["bucket"],self.init_dict["key"]).get()["Body"].read()
+        elif self.init_dict["loc"] == "local":
+            with open(self.init_dict["localpath"],"rb") as f:
+                return f.read()
+
+    def sibling(self,suffix):
+        """Get a WriteObj for an object at the same location as this one, with a suffix appended to its key (or local path). 
+
+        :param suffix: string to append. 
+        :return: WriteObj. 
+        """
+        init_dict = copy.copy(self.init_dict)
+        if init_dict["loc"] == "s3":
+            init_dict["key"] = init_dict["key"]+suffix
+        elif init_dict["loc"] == "local":    
+            init_dict["localpath"] = str(init_dict["localpath"])+suffix
+        return WriteObj(init_dict,self.queue)
+
+    def relative(self,relpath):
+        """Get a WriteObj for an object in the same directory (or s3 prefix) as this one. 
+
+        :param relpath: path of the object, relative to the directory containing this one. 
+        :return: WriteObj. 
+        """
+        init_dict = copy.copy(self.init_dict)
+        if init_dict["loc"] == "s3":
+            init_dict["key"] = os.path.join(os.path.dirname(init_dict["key"]),relpath)
+        elif init_dict["loc"] == "local":    
+            init_dict["localpath"] = os.path.join(os.path.dirname(str(init_dict["localpath"])),relpath)
+        return WriteObj(init_dict,self.queue)
        
 class NeuroCAASLogObject(object):
     """Abstract base class for logging objects. Defines an init method that does the following:   
@@ -158,16 +365,24 @@ class NeuroCAASLogObject(object):
         return rawfile    
 
     def reload(self):
-        """Reload from either s3, or the local writepath. 
+        """Reload from either s3, or the local writepath. Waits for any asynchronous writes of this object to be made first. 
 
         """
         if self.writeobj.init_dict["loc"] == "s3":
+            self.writeobj.flush()
             rawfile = self.load_init_s3(self.bucket_name,self.path)
         elif self.writeobj.init_dict["loc"] == "local":    
             rawfile = self.load_reinit_local()
             
         return rawfile    
 
+    def enable_async(self,queue = None):
+        """Make writes of this object to s3 asynchronously, through an upload queue (see UploadQueue). 
+
+        :param queue: (optional) the UploadQueue to use. By default, the module level upload_queue, which is drained when the interpreter exits. 
+        """
+        self.writeobj.queue = upload_queue if queue is None else queue
+
     def validate_path(self,s3_path):
         """Validates that the path given is a correctly formatted S3 URI.
         """
@@ -187,8 +402,18 @@ class NeuroCAASLogObject(object):
         """
         raise NotImplementedError()
 
+def get_dataset_key(dataname):
+    """Get a name for a dataset that is unique within a job, and safe to use in file names and s3 keys. Made from the basename of the dataset (for readability) and a hash of its full path, so that datasets with the same basename in different folders do not collide. 
+
+    :param dataname: name of the dataset (its key in s3). 
+    :return: string. 
+    """
+    basename = re.sub(r"[^A-Za-z0-9._-]","_",os.path.basename(dataname))
+    return "{}-{}".format(basename,hashlib.sha1(dataname.encode("utf-8")).hexdigest()[:10])
+
 class NeuroCAASCertificate(NeuroCAASLogObject):
     """Per-submission log file that captures the setup of resources on neurocaas, and provides basic summary information about each instance started by the job as it runs. Captures the git commit of the neurocaas blueprint version to ensure reproducibility. 
+    The certificate is parsed once (on load or reload) into a header (up to and including the first divider), an ordered list of dataset rows (between the dividers) and a footer (from the second divider on). Rows are indexed by dataname, so updating a row takes constant time regardless of the number of datasets, and the certificate is only rendered back to text when written. 
 
     """
     def __init__(self,s3_path,write_localpath=localdata_dict["certificate_update"],parse = True):
@@ -201,8 +426,9 @@ class NeuroCAASCertificate(NeuroCAASLogObject):
         """
         super().__init__(s3_path,write_localpath)
         self.assign_template()
+        self.header,self.rows,self.footer,self.writedict = None,None,None,None
         if parse:
-            self.certdict,self.writedict,self.writearea = self.process_rawcert(self.rawfile)
+            self.parse(self.rawfile)
 
     def load_init_s3(self,bucketname,path):
         """Load in file to use as initialization for this logging object.   
@@ -210,7 +436,7 @@ class NeuroCAASCertificate(NeuroCAASLogObject):
         :param path: The name of the key within the s3 bucket corresponding to the initialization object. 
         :return: Return the content of the s3 file without further processing. 
         """
-        content = load_file_s3(bucketname,path)
+        content,self.etag = load_file_s3(bucketname,path,return_etag = True)
         return content
 
     def load_reinit_local(self):
@@ -221,6 +447,64 @@ class NeuroCAASCertificate(NeuroCAASLogObject):
             rawcert = f.read()
         return rawcert    
 
+    def get_shard_writeobj(self,dataname):
+        """Get a WriteObj for the shard of this certificate corresponding to a given dataset. Shards are small json files holding the latest instance info for one dataset, stored in a certificate_shards folder next to the certificate, so that instances can update their own line without rewriting the certificate. 
+
+        :param dataname: name of the dataset. 
+        :return: WriteObj. 
+        """
+        shardname = "DATASET_NAME:{}.json".format(get_dataset_key(dataname))
+        if self.writeobj.init_dict["loc"] == "s3":
+            key = os.path.join(os.path.dirname(self.path),"certificate_shards",shardname)
+            return WriteObj({"loc":"s3","bucket":self.bucket_name,"key":key},self.writeobj.queue)
+        else:    
+            sharddir = os.path.join(os.path.dirname(self.writeobj.init_dict["localpath"]),"certificate_shards")
+            os.makedirs(sharddir,exist_ok = True)
+            return WriteObj({"loc":"local","localpath":os.path.join(sharddir,shardname)})
+
+    def write_shard(self,updatedict):
+        """Write the instance info for one dataset to its shard. 
+
+        :param updatedict: A dictionary giving the values of the instance info (see update_instance_info). 
+        """
+        self.get_shard_writeobj(updatedict.get("n","N/A")).put_json(updatedict)
+
+    def load_shards(self):
+        """Load all shards written for this certificate. 
+
+        :return: list of shard contents (dictionaries), sorted by shard name. 
+        """
+        shards = []
+        if self.writeobj.init_dict["loc"] == "s3":
+            prefix = os.path.join(os.path.dirname(self.path),"certificate_shards/")
+            keys = sorted([obj.key for obj in s3_resource.Bucket(self.bucket_name).objects.filter(Prefix = prefix)])
+            for key in keys:
+                if key.endswith(".json"):
+                    try:
+                        shards.append(json.loads(load_file_s3(self.bucket_name,key)))
+                    except (ClientError,ValueError) as e: ## deleted since listing, or partially written. load_file_s3 raises ClientErrors as ValueErrors.
+                        print("Could not read certificate shard {}, skipping: {}".format(key,repr(e)))
+        else:    
+            sharddir = os.path.join(os.path.dirname(self.writeobj.init_dict["localpath"]),"certificate_shards")
+            if os.path.exists(sharddir):
+                for shardname in sorted(os.listdir(sharddir)):
+                    with open(os.path.join(sharddir,shardname),"r") as f:
+                        shards.append(json.load(f))
+        return shards                
+
+    def merge_shards(self):
+        """Materialize the certificate view: apply the instance info in all shards to this certificate, and update the raw file accordingly. Does not write the certificate. 
+
+        :return: the number of shards merged. 
+        """
+        if self.rows is None:
+            self.parse(self.rawfile)
+        shards = self.load_shards()    
+        for shard in shards:
+            self.update_instance_info(shard,reload = False)
+        self.rawfile = self.render()    
+        return len(shards)
+
     def reload(self):
         """Reload certificate from designated location, and reprocess. 
         returns rawfile as expected. 
@@ -228,7 +512,7 @@ class NeuroCAASCertificate(NeuroCAASLogObject):
         rawfile = self.rawfile
         try:
             self.rawfile = super().reload()
-            self.certdict,self.writedict,self.writearea = self.process_rawcert(self.rawfile)
+            self.parse(self.rawfile)
         except FileNotFoundError:    
             print("No file to reload from, returning current.")
         return self.rawfile
@@ -247,30 +531,50 @@ class NeuroCAASCertificate(NeuroCAASLogObject):
             rawcert = f.read()
         return rawcert 
         
-    def process_rawcert(self,cert):
-        """Takes the raw certificate and preprocesses it for easier handling. In particular, separates it into line breaks, identifies the parts of the file that we should write to, and identifies individual lines by their corresponding data. Will assign values to the self.certlines and self.writedict attributes. 
+    def parse(self,cert):
+        """Parse the raw certificate into a header, dataset rows and footer, and index rows by the dataname they record.  
 
         :param cert: raw data containing certificate file.
-        :return: tuple (certdict, writedict, writearea) of dictionaries and a range object. First entry has line numbers as keys and content of those lines as values.Second entry has line numbers as keys, and a dictionary of format {"dataname":dataname,"line":text} as value. Third entry indicates the range of lines where we can write. 
         """
-        certlines = self.rawfile.split("\n")
-        certdict = {ci:cl for ci,cl in enumerate(certlines)}
-        linebreak_locs = dict(filter(find_linebreaks,certdict.items()))
+        certlines = cert.split("\n")
+        linebreak_locs = [i for i,line in enumerate(certlines) if line == divider]
         assert len(linebreak_locs) == 2,"This divider should indicate only the start and end of the actively updated status." 
-        interval = sorted(linebreak_locs.keys())
-        writearea = range(interval[0]+1,interval[1])
-        writedict = {}
-        for i in writearea:
-            text = certdict[i]
+        self.header = certlines[:linebreak_locs[0]+1]
+        self.rows = certlines[linebreak_locs[0]+1:linebreak_locs[1]]
+        self.footer = certlines[linebreak_locs[1]:]
+        self.writedict = {}
+        for ri,text in enumerate(self.rows):
             m = re.search(r'DATANAME: (.*?) |',text)
             if m.group(1) is not None:
                 dataname = m.group(1)
             else:    
                 dataname = "groupname/inputs/dataname.ext"
-            writedict[dataname] = {"linenb":i,"dataname":dataname,"line":text} 
-        return (certdict,writedict,writearea)
+            self.writedict[dataname] = {"linenb":len(self.header)+ri,"dataname":dataname,"line":text} 
+
+    @property
+    def writearea(self):
+        """The range of line numbers of dataset rows. 
+
+        """
+        return range(len(self.header),len(self.header)+len(self.rows))
+
+    @property
+    def certdict(self):
+        """Dictionary with line numbers as keys and the content of those lines as values. Built on each access.  
 
-    def update_instance_info(self,updatedict,loc=0):
+        """
+        return {ci:cl for ci,cl in enumerate(self.header+self.rows+self.footer)}
+
+    def process_rawcert(self,cert):
+        """Takes the raw certificate and preprocesses it for easier handling. In particular, separates it into line breaks, identifies the parts of the file that we should write to, and identifies individual lines by their corresponding data. 
+
+        :param cert: raw data containing certificate file.
+        :return: tuple (certdict, writedict, writearea) of dictionaries and a range object. First entry has line numbers as keys and content of those lines as values.Second entry has line numbers as keys, and a dictionary of format {"dataname":dataname,"line":text} as value. Third entry indicates the range of lines where we can write. 
+        """
+        self.parse(cert)
+        return (self.certdict,self.writedict,self.writearea)
+
+    def update_instance_info(self,updatedict,loc=0,reload=True):
         """Updates the info on an instance in the certificate. Update takes the form of a dictionary, with the following entries, where all values are strings.:
         {
             "n": datasetname,
@@ -284,9 +588,11 @@ class NeuroCAASCertificate(NeuroCAASLogObject):
 
         :param updatedict: A dictionary giving the values to update individual parameters. 
         :param loc: (optional) The relative line number that this update should be written to. Default is 0.
+        :param reload: (optional) If true (default), reload the certificate from its location before updating. Set to false to update the in-memory certificate only (see CertificateWriter). 
         """
         ## First filter the given keys, and determine if any are missing:
-        self.reload()
+        if reload:
+            self.reload()
         given_keys = updatedict.keys()
         all_keys = ["n","s","t","r","u"]
         for key in given_keys:
@@ -295,14 +601,15 @@ class NeuroCAASCertificate(NeuroCAASLogObject):
             if key not in given_keys:
                 updatedict[key] = "N/A"
         formatted = self.dataset_template.format(**updatedict)
+        if self.rows is None:
+            self.parse(self.rawfile)
         ## Now determine where to write this:
         datainfo_given = self.writedict.get(updatedict["n"],False)
         try:
             if datainfo_given is False:
-                write_index = self.writearea[loc]
+                self.rows[loc] = formatted
             else: 
-                write_index = self.writedict[datainfo_given["dataname"]]["linenb"]
-            self.certdict[write_index] = formatted  
+                self.rows[datainfo_given["linenb"]-len(self.header)] = formatted
         except IndexError:
             raise IndexError("The argument loc you gave is not compatible with the certificate (not in write area)")
 
@@ -319,32 +626,585 @@ class NeuroCAASCertificate(NeuroCAASLogObject):
 
         #self.writeobj = WriteObj({"loc":"s3","bucket":bucket_name,"key":path})
 
-    def write(self):    
+    def write(self,if_match = None):    
         """Writes the contents of the file as dictated by the self.writeobj attribute. If writeobj is s3 (default), the updated certificate will be written to the path at self.s3_path. If not (s3 not reachable for any reason) will be written to the file ./template_mats/certificate_update.txt for inspection. If you intend to write to a different file location, use the method write_local instead. 
 
+        :param if_match: (optional) only write if the certificate in s3 still has this ETag (see WriteObj.put). 
         """
-        ## First sort lines:
-        sort_line_tuples = sorted(self.certdict.items(),key = lambda x: x[0])
-        sorted_lines = [s[1] for s in sort_line_tuples]
-        body = "\n".join(sorted_lines)
-        self.writeobj.put(body)
+        etag = self.writeobj.put(self.render(),if_match)
+        if etag is not None:
+            self.etag = etag
+
+    def render(self):
+        """Render the certificate as text. 
+
+        :return: the certificate, as a string. 
+        """
+        if self.rows is None:
+            return self.rawfile
+        return "\n".join(self.header+self.rows+self.footer)
 
     def write_local(self,path):    
         """Writes the contents of the file as dictated by the self.writeobj attribute locally. 
 
         :param path: Local path where we should write the contents of this file. 
         """
-        ## First sort lines:
-        sort_line_tuples = sorted(self.certdict.items(),key = lambda x: x[0])
-        sorted_lines = [s[1] for s in sort_line_tuples]
-        body = "\n".join(sorted_lines)
+        body = self.render()
         with open(path, "wb") as f:
             f.write(body.encode("utf-8"))
 
+class CoalescingWriter(object):
+    """Write-behind wrapper around a log object (anything with a write method). Updates are applied to the log object in memory and marked as dirty, and the log object is only written when at least min_interval seconds have passed since the last write, or when its status changes. Call flush when finished to write any remaining updates. 
+
+    """
+    def __init__(self,logobj,min_interval = 60,clock = time.time):
+        """
+        :param logobj: the log object to write (i.e. NeuroCAASCertificate or NeuroCAASDataStatusLegacy). 
+        :param min_interval: minimum number of seconds between writes, unless the status changes. 
+        :param clock: function returning the current time in seconds. 
+        """
+        self.logobj = logobj
+        self.min_interval = min_interval
+        self.clock = clock
+        self.dirty = False
+        self.status = None
+        ## the last status seen for each key.
+        self.statuses = {}
+        self.last_write = None
+        self.writes = 0
+
+    def touch(self,status = None,key = None):
+        """Mark the log object as updated, and write it if it is due. 
+
+        :param status: (optional) the current status. Writes immediately if it differs from the status at the last call (with the same key). 
+        :param key: (optional) what the status refers to, if the log object tracks more than one status (i.e. the dataset name for a certificate). 
+        :return: True if the log object was written. 
+        """
+        self.dirty = True
+        transition = status != self.statuses.get(key)
+        self.statuses[key] = status
+        self.status = status
+        if transition or self.last_write is None or self.clock()-self.last_write >= self.min_interval:
+            return self.flush()
+        return False
+
+    def write(self):
+        self.logobj.write()
+
+    def flush(self):
+        """Write the log object if there are updates that have not been written yet. 
+
+        :return: True if the log object was written. 
+        """
+        if not self.dirty:
+            return False
+        self.write()
+        self.writes += 1
+        self.dirty = False
+        self.last_write = self.clock()
+        return True
+
+class CertificateWriter(CoalescingWriter):
+    """Write-behind wrapper around a NeuroCAASCertificate. Instance updates are applied in memory without reloading the certificate. How updates are written depends on the mode:
+    - "shared": the certificate is reloaded once (to pick up lines written by other instances), pending updates are applied on top of it, and the result is written. 
+    - "conditional": as in shared, but the write is conditional on the certificate not having changed since it was reloaded (by ETag). If another instance wrote in between, the write is retried. 
+    - "sharded": only the shard for each updated dataset is written. Shards are merged into the certificate when it is read (see NeuroCAASCertificate.merge_shards), and on finish the certificate itself is updated with a conditional write. 
+
+    """
+    modes = ["shared","conditional","sharded"]
+    def __init__(self,certificate,min_interval = 60,clock = time.time,mode = "shared",retries = 10):
+        """
+        :param certificate: a NeuroCAASCertificate object. 
+        :param min_interval: minimum number of seconds between writes, unless the status changes. 
+        :param clock: function returning the current time in seconds. 
+        :param mode: one of "shared","conditional" or "sharded". 
+        :param retries: number of times to retry conditional writes. 
+        """
+        assert mode in self.modes, "mode must be one of {}".format(self.modes)
+        super().__init__(certificate,min_interval,clock)
+        self.mode = mode
+        self.retries = retries
+        self.pending = OrderedDict()
+        ## updates written to shards but not yet to the certificate itself. 
+        self.shard_updates = OrderedDict()
+
+    def update_instance_info(self,updatedict,loc = 0):
+        """Equivalent to NeuroCAASCertificate.update_instance_info, but coalesces writes. Writes immediately when the status (entry "s") of the dataset being updated changes.  
+
+        :param updatedict: A dictionary giving the values to update individual parameters. 
+        :param loc: (optional) The relative line number that this update should be written to. Default is 0.
+        :return: True if the certificate was written. 
+        """
+        updatedict = copy.copy(updatedict)
+        self.logobj.update_instance_info(updatedict,loc,reload = False)
+        self.pending[(updatedict["n"],loc)] = updatedict
+        return self.touch(updatedict["s"],(updatedict["n"],loc))
+
+    def reload_and_apply(self,updates):
+        try:
+            self.logobj.reload()
+        except ValueError:    
+            print("Could not reload certificate, writing current.")
+        for (n,loc),updatedict in updates:
+            self.logobj.update_instance_info(copy.copy(updatedict),loc,reload = False)
+
+    def write_conditional(self,updates):
+        """Reload, apply updates and write, conditional on the certificate not having changed since the reload. If the installed version of botocore does not support conditional writes, falls back to an unconditional write (as in shared mode). 
+
+        :param updates: list of ((dataname,loc),updatedict) pairs. 
+        """
+        for attempt in range(self.retries+1):
+            self.reload_and_apply(updates)
+            try:
+                self.logobj.write(if_match = getattr(self.logobj,"etag",None))
+                return
+            except ParamValidationError: ## IfMatch is not a parameter of PutObject in older versions of botocore. 
+                print("Conditional writes not supported, writing certificate unconditionally.")
+                self.logobj.write()
+                return
+            except ClientError as e:
+                if e.response["Error"]["Code"] in ["PreconditionFailed","412","ConditionalRequestConflict"] and attempt < self.retries:
+                    continue
+                raise
+
+    def write(self):
+        updates = list(self.pending.items())
+        self.pending.clear()
+        if self.mode == "shared":
+            self.reload_and_apply(updates)
+            self.logobj.write()
+        elif self.mode == "conditional":
+            self.write_conditional(updates)
+        elif self.mode == "sharded":
+            for (n,loc),updatedict in updates:
+                self.logobj.write_shard(updatedict)
+            self.shard_updates.update(updates)
+
+    def flush(self,finish = False):
+        """Write the certificate if there are updates that have not been written yet. 
+
+        :param finish: if true and in sharded mode, also update the certificate itself with all the updates made by this writer. 
+        :return: True if the certificate was written. 
+        """
+        written = super().flush()
+        if finish and self.mode == "sharded" and len(self.shard_updates) > 0:
+            self.write_conditional(list(self.shard_updates.items()))
+            self.shard_updates.clear()
+        return written
+
+class PsutilSource(object):
+    """Resource usage source for the ResourceSampler, based on psutil. Never blocks: cpu percentages are measured relative to the previous call. If given a process id, reports usage for that process and all of its children. Otherwise, reports usage for the machine as a whole. 
+
+    """
+    def __init__(self,pid = None):
+        """
+        :param pid: (optional) id of the process to report usage for. 
+        """
+        self.pid = pid
+        self.processes = {}
+        if pid is None:
+            psutil.cpu_percent(None)
+
+    def get_processes(self):
+        """Get the process being tracked and its children, reusing psutil Process objects so that cpu percentages are measured across calls. 
+
+        """
+        try:
+            root = self.processes.get(self.pid) or psutil.Process(self.pid)
+            current = [root]+root.children(recursive = True)
+        except psutil.NoSuchProcess: ## the process has exited. 
+            self.processes = {}
+            return []
+        self.processes = {p.pid:self.processes.get(p.pid,p) for p in current}
+        return list(self.processes.values())
+
+    def __call__(self):
+        """
+        :return: dictionary with cpu_percent, memory_mb, and cumulative disk_read_bytes, disk_write_bytes, net_recv_bytes and net_sent_bytes counters (None if not available). 
+        """
+        sample = dict.fromkeys(["disk_read_bytes","disk_write_bytes","net_recv_bytes","net_sent_bytes"])
+        if self.pid is None:
+            sample["cpu_percent"] = psutil.cpu_percent(None)
+            sample["memory_mb"] = psutil.virtual_memory().used/1e6
+            disk = psutil.disk_io_counters()
+            if disk is not None:
+                sample["disk_read_bytes"],sample["disk_write_bytes"] = disk.read_bytes,disk.write_bytes
+        else:    
+            cpu,memory,read,written = 0,0,0,0
+            for process in self.get_processes():
+                try:
+                    with process.oneshot():
+                        cpu += process.cpu_percent(None)
+                        memory += process.memory_info().rss
+                        io = process.io_counters()
+                        read += io.read_bytes
+                        written += io.write_bytes
+                except (psutil.NoSuchProcess,psutil.AccessDenied,AttributeError):
+                    continue
+            sample["cpu_percent"] = cpu
+            sample["memory_mb"] = memory/1e6
+            sample["disk_read_bytes"],sample["disk_write_bytes"] = read,written
+        net = psutil.net_io_counters()
+        if net is not None:
+            sample["net_recv_bytes"],sample["net_sent_bytes"] = net.bytes_recv,net.bytes_sent
+        return sample
+
+class DockerStatsSource(object):
+    """Resource usage source for the ResourceSampler, based on the docker stats stream of a container. Each call blocks until docker reports the next set of stats (about once per second), so this source should be sampled with an interval of 0. 
+
+    """
+    def __init__(self,container):
+        """
+        :param container: docker container object to get stats for. 
+        """
+        self.container = container
+        self.stream = None
+
+    def __call__(self):
+        """
+        :return: dictionary in the same format as PsutilSource. 
+        """
+        if self.stream is None:
+            self.stream = self.container.stats(stream = True)
+        try:
+            stats = json.loads(next(self.stream).decode("utf-8"))
+        except StopIteration:
+            ## the stream ends when the container stops. 
+            self.stream = None
+            raise
+        ## Taken from https://github.com/TomasTomecek/sen/blob/master/sen/util.py#L175, itself taken from docker 
+        cpu_stats,precpu_stats = stats["cpu_stats"],stats.get("precpu_stats",{})
+        cpu_delta = cpu_stats["cpu_usage"]["total_usage"]-precpu_stats.get("cpu_usage",{}).get("total_usage",0)
+        system_delta = cpu_stats.get("system_cpu_usage",0)-precpu_stats.get("system_cpu_usage",0)
+        online_cpus = cpu_stats.get("online_cpus",len(cpu_stats["cpu_usage"].get("percpu_usage") or [None]))
+        sample = dict.fromkeys(["disk_read_bytes","disk_write_bytes","net_recv_bytes","net_sent_bytes"])
+        sample["cpu_percent"] = (cpu_delta/system_delta)*online_cpus*100 if system_delta > 0 else 0
+        ## If the container is not in the "running" state, usage will not be reported. 
+        sample["memory_mb"] = stats.get("memory_stats",{}).get("usage",0)/1e6
+        blkio = (stats.get("blkio_stats") or {}).get("io_service_bytes_recursive") or []
+        sample["disk_read_bytes"] = sum([entry["value"] for entry in blkio if entry["op"].lower() == "read"])
+        sample["disk_write_bytes"] = sum([entry["value"] for entry in blkio if entry["op"].lower() == "write"])
+        networks = stats.get("networks") or {}
+        sample["net_recv_bytes"] = sum([net["rx_bytes"] for net in networks.values()])
+        sample["net_sent_bytes"] = sum([net["tx_bytes"] for net in networks.values()])
+        return sample
+
+class ResourceSampler(object):
+    """Samples resource usage from a source (see PsutilSource and DockerStatsSource) in a background thread, so that logging never waits on usage measurements. Cumulative disk and network counters are converted into rates. Keeps a rolling time series of at most maxsamples points: when it fills up, neighbouring points are averaged together and the time step between points doubles, so the history always covers the whole job. Also keeps running min/mean/max values for each metric over all samples. 
+
+    """
+    metrics = ["cpu_percent","memory_mb","disk_read_mbps","disk_write_mbps","net_recv_mbps","net_sent_mbps"]
+    counters = {"disk_read_mbps":"disk_read_bytes","disk_write_mbps":"disk_write_bytes","net_recv_mbps":"net_recv_bytes","net_sent_mbps":"net_sent_bytes"}
+    def __init__(self,source,interval = 1,maxsamples = 300,clock = time.time):
+        """
+        :param source: callable returning a dictionary of usage measurements (see PsutilSource). 
+        :param interval: number of seconds to wait between samples. 
+        :param maxsamples: maximum number of points in the history. 
+        :param clock: function giving the current time in seconds. 
+        """
+        self.source = source
+        self.interval = interval
+        self.maxsamples = maxsamples
+        self.clock = clock
+        self.latest = None
+        self.prev = None
+        self.count = 0
+        self.stats = {metric:{"min":None,"max":None,"sum":0,"count":0} for metric in self.metrics}
+        self.history = []
+        self.stride = 1 ## number of samples averaged into each point of the history.
+        self.pending = None
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target = self.run,daemon = True)
+        self.thread.start()
+        return self
+
+    def stop(self,timeout = 5):
+        self.stopped.set()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join(timeout)
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.sample()
+                wait = self.interval
+            except Exception: ## the source may be unavailable for a while (i.e. a container that has not started yet).
+                wait = max(self.interval,1)
+            self.stopped.wait(wait)
+
+    def sample(self):
+        """Take a sample from the source, and record it. 
+
+        :return: the recorded values. 
+        """
+        raw = self.source()
+        t = self.clock()
+        values = {"cpu_percent":raw.get("cpu_percent"),"memory_mb":raw.get("memory_mb")}
+        for metric,counter in self.counters.items():
+            values[metric] = None
+            if self.prev is not None and raw.get(counter) is not None and self.prev[1].get(counter) is not None and t > self.prev[0]:
+                values[metric] = max(raw[counter]-self.prev[1][counter],0)/(t-self.prev[0])/1e6
+        self.prev = (t,raw)
+        self.record(t,values)
+        return values
+
+    def record(self,t,values):
+        """Record a set of values in the running statistics and history. 
+
+        :param t: time of the sample. 
+        :param values: dictionary from metrics to values (None if not measured). 
+        """
+        with self.lock:
+            self.latest = values
+            self.count += 1
+            for metric,value in values.items():
+                if value is None:
+                    continue
+                stats = self.stats[metric]
+                stats["min"] = value if stats["min"] is None else min(stats["min"],value)
+                stats["max"] = value if stats["max"] is None else max(stats["max"],value)
+                stats["sum"] += value
+                stats["count"] += 1
+            if self.pending is None:
+                self.pending = {"t":t,"n":0,"values":{},"counts":{}}
+            self.add_point(self.pending,{"t":t,"n":1,"values":values,"counts":{metric:1 for metric,value in values.items() if value is not None}})
+            if self.pending["n"] >= self.stride:
+                self.history.append(self.pending)
+                self.pending = None
+            if len(self.history) >= self.maxsamples:
+                self.downsample()
+
+    @staticmethod
+    def add_point(point,other):
+        """Average the values of another point into a point of the history, weighting each metric by the number of samples in which it was measured. 
+
+        """
+        for metric,value in other["values"].items():
+            if value is None:
+                continue
+            count = point["counts"].get(metric,0)
+            total = count+other["counts"][metric]
+            current = point["values"].get(metric)
+            point["values"][metric] = value if current is None else (current*count+value*other["counts"][metric])/total
+            point["counts"][metric] = total
+        point["n"] += other["n"]
+
+    def downsample(self):
+        """Halve the number of points in the history by averaging neighbouring points. 
+
+        """
+        merged = []
+        for i in range(0,len(self.history)-1,2):
+            point = self.history[i]
+            self.add_point(point,self.history[i+1])
+            merged.append(point)
+        if len(self.history) % 2:
+            ## we only downsample right after completing a point, so there is no pending point to lose. 
+            self.pending = self.history[-1]
+        self.history = merged
+        self.stride *= 2
+
+    def get_latest(self):
+        with self.lock:
+            return self.latest
+
+    def get_history(self):
+        """
+        :return: list of points, each a dictionary with the time of its first sample "t", the number of samples averaged "n", and the average of each metric. 
+        """
+        with self.lock:
+            points = self.history+([self.pending] if self.pending is not None else [])
+            return [dict(t = p["t"],n = p["n"],**p["values"]) for p in points]
+
+    def summary(self):
+        """Summarize each metric over the job so far. min, mean and max are computed over all samples, and p95 over the history. 
+
+        :return: dictionary from metrics to dictionaries with keys min, mean, p95, max.  
+        """
+        history = self.get_history()
+        summary = {}
+        with self.lock:
+            for metric,stats in self.stats.items():
+                if stats["count"] == 0:
+                    continue
+                values = sorted([p[metric] for p in history if p.get(metric) is not None])
+                p95 = values[min(int(0.95*len(values)),len(values)-1)] if len(values) > 0 else None
+                summary[metric] = {"min":stats["min"],"mean":stats["sum"]/stats["count"],"p95":p95,"max":stats["max"]}
+        return summary
+
+    def report(self):
+        """
+        :return: dictionary with the summary of each metric and the downsampled history. 
+        """
+        return {"samples":self.count,
+                "interval":self.interval,
+                "stride":self.stride,
+                "summary":self.summary(),
+                "history":self.get_history()}
+
+class EventStream(object):
+    """Append-only stream of job events, written next to the certificate and status files of a job. Events are compact dictionaries with a type ("status", "usage" or "log"), the time "t" and an index "i" that counts the events of this writer. Events are buffered in memory, and each flush uploads the buffered events as a new JSON lines object at events/{writer}/{index of first event}.jsonl, so objects are never rewritten. Each writer (i.e. each dataset) has its own sequence of objects, so that writers never conflict. Readers can consume events incrementally by keeping track of the next index for each writer (see monitor.get_events), and reconstruct the certificate and status views with apply_events. 
+
+    """
+    def __init__(self,writeobj,writer):
+        """
+        :param writeobj: WriteObj for any object in the job's log directory (i.e. the status file). 
+        :param writer: name of this writer. Should be unique within the job. 
+        """
+        self.writeobj = writeobj
+        self.writer = writer
+        self.count = 0 ## events emitted so far. 
+        self.buffer = []
+
+    @staticmethod
+    def get_chunkname(writer,first):
+        return "events/{}/{:09d}.jsonl".format(writer,first)
+
+    @staticmethod
+    def parse_chunkname(key):
+        """Get the writer and index of the first event from the name of an event object. 
+
+        :param key: key or path of the object.
+        :return: tuple (writer, first index). 
+        """
+        writer,name = key.split("/")[-2:]
+        return writer,int(name.split(".")[0])
+
+    def emit(self,eventtype,**fields):
+        """Add an event to the buffer. 
+
+        :param eventtype: type of the event. 
+        :param fields: values to record. 
+        :return: the event. 
+        """
+        event = {"i":self.count,"t":datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ"),"type":eventtype,"writer":self.writer}
+        event.update(fields)
+        self.buffer.append(event)
+        self.count += 1
+        return event
+
+    def flush(self):
+        """Upload buffered events as a new object. 
+
+        :return: the number of events uploaded. 
+        """
+        if len(self.buffer) == 0:
+            return 0
+        body = "".join([json.dumps(event,separators = (",",":"))+"\n" for event in self.buffer])
+        self.writeobj.relative(self.get_chunkname(self.writer,self.buffer[0]["i"])).put_bytes(body.encode("utf-8"))
+        uploaded = len(self.buffer)
+        self.buffer = []
+        return uploaded
+
+def apply_events(events,states = None):
+    """Compact a sequence of events into the current state of each dataset in a job. Can be applied incrementally: pass the states returned by a previous call, along with events that are newer than those it was given. 
+
+    :param events: list of events, in the order they were emitted by each writer. 
+    :param states: (optional) states from a previous call. Updated in place. 
+    :return: dictionary from writer to a dictionary with the latest status fields, the latest usage sample under "usage", and the output chunks written so far under "std_chunks".
+    """
+    if states is None:
+        states = OrderedDict()
+    for event in events:
+        state = states.setdefault(event["writer"],{"std_chunks":{"lines":0,"chunks":[]}})
+        fields = {k:v for k,v in event.items() if k not in ["i","type","writer"]}
+        if event["type"] == "status":
+            state.update(fields)
+        elif event["type"] == "usage":
+            state["usage"] = fields
+        elif event["type"] == "log":
+            chunk = {k:fields[k] for k in ["suffix","first","count"]}
+            state["std_chunks"]["chunks"].append(chunk)
+            state["std_chunks"]["lines"] = chunk["first"]+chunk["count"]
+    return states
+
+def render_certificate(states,certificate):
+    """Write the state of each dataset into a certificate, in memory. Datasets that do not have a line in the certificate yet are given lines in order. 
+
+    :param states: dictionary from writer to dataset states (see apply_events).
+    :param certificate: a NeuroCAASCertificate. 
+    :return: the text of the certificate. 
+    """
+    for loc,state in enumerate(states.values()):
+        updatedict = {
+            "n":state.get("input","N/A"),
+            "s":state.get("status","N/A"),
+            "t":state.get("t","N/A"),
+            "r":state.get("last_line","N/A"),
+            "u":"{} %".format(state["usage"]["cpu_percent"]) if "usage" in state else "N/A"}
+        certificate.update_instance_info(updatedict,loc,reload = False)
+    certificate.rawfile = certificate.render()
+    return certificate.rawfile
+
+def render_datastatus(state,datastatus):
+    """Write the state of a dataset into a datastatus object, in memory. The output is referenced through "std_chunks" (see NeuroCAASDataStats.enable_chunking), and the last lines of output are fetched from the chunks. 
+
+    :param state: state of a dataset (see apply_events). 
+    :param datastatus: a NeuroCAASDataStats object. 
+    :return: the rawfile of the datastatus object. 
+    """
+    for key in datastatus.writeorder:
+        if key in state:
+            datastatus.rawfile[key] = state[key]
+    if "usage" in state:
+        datastatus.rawfile["cpu_usage"] = "{} %".format(state["usage"]["cpu_percent"])
+        datastatus.rawfile["memory_usage"] = "{} MB".format(state["usage"]["memory_mb"])
+    datastatus.rawfile["std_chunks"] = state["std_chunks"]
+    if "std_chunks" not in datastatus.writeorder:
+        datastatus.writeorder.append("std_chunks")
+    lines = state["std_chunks"]["lines"]
+    datastatus.rawfile["std"] = datastatus.get_lines(max(lines-getattr(datastatus,"tail_lines",100),0),lines)
+    return datastatus.rawfile
+
 class NeuroCAASDataStats(NeuroCAASLogObject):
     """Base class for original and docker based DataStatus log objects. 
 
     """
+    events = None
+    sampler = None
+    def get_usage_source(self):
+        """Get the source of resource usage measurements used when no sampler has been started explicitly. 
+
+        """
+        return PsutilSource()
+
+    def start_sampler(self,source = None,interval = 1,maxsamples = 300):
+        """Start sampling resource usage in the background. If a sampler is already running, it is stopped first.
+
+        :param source: (optional) source of usage measurements. By default, given by get_usage_source. 
+        :param interval: number of seconds between samples. 
+        :param maxsamples: maximum number of points in the usage history. 
+        :return: the ResourceSampler. 
+        """
+        if self.sampler is not None:
+            self.sampler.stop()
+        if source is None:
+            source = self.get_usage_source()
+        self.sampler = ResourceSampler(source,interval,maxsamples).start()
+        return self.sampler
+
+    def finish_usage(self,path = None):
+        """Stop the resource sampler, record the final usage summary, and write a usage report with the full usage history. The report is written next to the status file (at {status file}.usage.json), or to a local file if given. 
+
+        :param path: (optional) local path to write the report to. 
+        :return: the report, or None if resources were never sampled. 
+        """
+        if self.sampler is None:
+            return None
+        self.sampler.stop()
+        report = self.sampler.report()
+        self.rawfile["usage_summary"] = report["summary"]
+        if path is None:
+            self.writeobj.sibling(".usage.json").put_json(report)
+        else:    
+            with open(path,"w") as f:
+                json.dump(report,f,indent = 4)
+        return report
+
     def load_init_s3(self,bucketname,path):
         """Load in file to use as initialization for this logging object. Should be a dictionary.   
         :param bucketname: The name of the s3 bucket we are reading from.
@@ -371,14 +1231,136 @@ class NeuroCAASDataStats(NeuroCAASLogObject):
             rawfile = json.load(f)
         return rawfile 
 
+    def enable_chunking(self,logfile,tail_lines = 100):
+        """Switch to the chunked datastatus format. The status file becomes a small summary, where "std" only holds the last tail_lines lines of output. The full output is read incrementally from a local log file, and uploaded as an append-only sequence of gzip compressed JSONL chunks (one {"i":line index,"line":text} record per line) next to the status file, at {status file}.chunks/{chunk number}.jsonl.gz. Each write uploads only the output produced since the last write. Chunks are listed in the "std_chunks" entry of the summary, and can be read back by line range with get_lines. 
+
+        :param logfile: local file that the full output is written to. 
+        :param tail_lines: the number of recent lines to keep in the summary.
+        """
+        self.chunk_source = logfile
+        self.chunk_offset = 0 
+        self.chunk_closed = False
+        self.tail_lines = tail_lines
+        self.rawfile["std_chunks"] = {"lines":0,"chunks":[]}
+        if "std_chunks" not in self.writeorder:
+            self.writeorder.append("std_chunks")
+
+    def enable_events(self,writer = None):
+        """Also record this object as an append-only stream of events (see EventStream). Every write emits a status event if any status field (or the last line of output) changed, a usage event with the latest resource sample, and a log event for each output chunk written (if chunking is enabled). 
+
+        :param writer: (optional) name of the event writer. Defaults to the key of the input dataset (see get_dataset_key), which is unique within the job. 
+        :return: the EventStream. 
+        """
+        if writer is None:
+            writer = get_dataset_key(self.rawfile["input"])
+        self.events = EventStream(self.writeobj,writer)
+        self.last_status_event = None
+        return self.events
+
+    def emit_events(self):
+        """Emit events describing changes since the last write, and upload them. 
+
+        """
+        std = self.rawfile.get("std",{})
+        keys = sorted(std,key = int)
+        status = {key:self.rawfile[key] for key in ["instance","command","input","status","reason","job_start","job_finish"] if key in self.rawfile}
+        status["last_line"] = std[keys[-1]].strip() if len(keys) > 0 else "N/A"
+        if status != self.last_status_event:
+            self.events.emit("status",**status)
+            self.last_status_event = status
+        if self.sampler is not None and self.sampler.get_latest() is not None:
+            self.events.emit("usage",**self.sampler.get_latest())
+        self.events.flush()
+
+    def close_chunks(self):
+        """Mark the chunk source as finished, so that the next write also uploads a trailing line that does not end in a newline. 
+
+        """
+        self.chunk_closed = True
+
+    def read_new_lines(self):
+        """Read complete lines written to the chunk source since the last call (or all remaining output, if close_chunks has been called). 
+
+        :return: list of lines. 
+        """
+        try:
+            with open(self.chunk_source,"rb") as f:
+                f.seek(self.chunk_offset)
+                data = f.read()
+        except FileNotFoundError:
+            return []
+        if self.chunk_closed and len(data) > 0 and not data.endswith(b"\n"):
+            data = data+b"\n"
+            self.chunk_offset -= 1 
+        end = data.rfind(b"\n")
+        if end < 0:
+            return []
+        self.chunk_offset += end+1
+        return data[:end].decode("utf-8",errors = "replace").split("\n")
+
+    def write_chunk(self):
+        """Upload output produced since the last chunk as a new chunk object, and record it in the summary. 
+
+        :return: the number of lines uploaded. 
+        """
+        lines = self.read_new_lines()
+        if len(lines) == 0:
+            return 0
+        chunks = self.rawfile["std_chunks"]
+        first = chunks["lines"]
+        body = "\n".join([json.dumps({"i":first+i,"line":line}) for i,line in enumerate(lines)])+"\n"
+        suffix = ".chunks/{:06d}.jsonl.gz".format(len(chunks["chunks"]))
+        self.writeobj.sibling(suffix).put_bytes(gzip.compress(body.encode("utf-8")))
+        chunks["chunks"].append({"suffix":suffix,"first":first,"count":len(lines)})
+        chunks["lines"] = first+len(lines)
+        return len(lines)
+
+    def get_lines(self,start = 0,end = None):
+        """Read a range of output lines from the chunks recorded in the summary, fetching only the chunks that overlap the range. 
+
+        :param start: index of the first line to get. 
+        :param end: (optional) index after the last line to get. By default, get all lines to the end. 
+        :return: dictionary from line indices (as strings) to lines, in the same format as the "std" entry. 
+        """
+        chunks = self.rawfile["std_chunks"]
+        if end is None:
+            end = chunks["lines"]
+        lines = {}
+        for chunk in chunks["chunks"]:
+            if chunk["first"]+chunk["count"] <= start or chunk["first"] >= end:
+                continue
+            body = gzip.decompress(self.writeobj.sibling(chunk["suffix"]).get_bytes()).decode("utf-8")
+            for record in body.splitlines():
+                entry = json.loads(record)
+                if start <= entry["i"] < end:
+                    lines[str(entry["i"])] = entry["line"]+"\n"
+        return lines            
+
+    def trim_std(self):
+        """Keep only the last tail_lines entries of std in the summary. 
+
+        """
+        std = self.rawfile.get("std",{})
+        keys = sorted(std,key = int)[-self.tail_lines:] if self.tail_lines > 0 else []
+        self.rawfile["std"] = {k:std[k] for k in keys}
         
     def write(self):    
         """Writes the contents of rawfile as dictated by the self.writeobj attribute. Will sort entries with an ordereddict according to the attribute self.writeorder. If writeobj is s3 (default), the updated certificate will be written to the path at self.s3_path. If not (s3 not reachable for any reason) will be written to the file ./template_mats/certificate_update.txt for inspection. If you intend to write to a different file location, use the method write_local instead. 
+        If chunking is enabled (see enable_chunking), new output is uploaded as a chunk first, and only the tail of the output is kept in the status file. 
 
         """
-        ## First sort entries:
+        if getattr(self,"chunk_source",None) is not None:
+            nchunks = len(self.rawfile["std_chunks"]["chunks"])
+            self.write_chunk()
+            self.trim_std()
+            if self.events is not None:
+                for chunk in self.rawfile["std_chunks"]["chunks"][nchunks:]:
+                    self.events.emit("log",**chunk)
+        if self.events is not None:
+            self.emit_events()
+        ## First sort entries, skipping any that have not been recorded:
         od = OrderedDict([
-               (key,self.rawfile[key]) for key in self.writeorder])
+               (key,self.rawfile[key]) for key in self.writeorder if key in self.rawfile])
         self.writeobj.put_json(od)
 
     def write_local(self,path):    
@@ -386,9 +1368,9 @@ class NeuroCAASDataStats(NeuroCAASLogObject):
 
         :param path: Local path where we should write the contents of this file. 
         """
-        ## First sort entries:
+        ## First sort entries, skipping any that have not been recorded:
         od = OrderedDict([
-               (key,self.rawfile[key]) for key in self.writeorder])
+               (key,self.rawfile[key]) for key in self.writeorder if key in self.rawfile])
         with open(path, "w") as f:
             json.dump(od,f,indent = 4)
 
@@ -407,13 +1389,13 @@ class NeuroCAASDataStatusLegacy(NeuroCAASDataStats):
                    "reason",
                    "memory_usage",
                    "cpu_usage",
+                   "usage_summary",
                    "job_start",
                    "job_finish",
+                   "result_uploads",
                    "std"]
-        ## Initialize the cpu usage stats with 0 
-        self.prev_cpu = 0
-        self.prev_system = 0
-
+        ## local file with statistics of result uploads made while the job runs (see record_uploads). 
+        self.uploads_path = None
         super().__init__(s3_path,write_localpath)
 
     def get_stdout(self,filename):
@@ -425,17 +1407,21 @@ class NeuroCAASDataStatusLegacy(NeuroCAASDataStats):
         return lines    
 
     def get_usage(self):    
-        """Outputs usage statistics for the machine as a whole .
+        """Outputs the latest usage statistics from the resource sampler, without waiting for a new measurement. Unless a sampler has been started for a specific process with start_sampler, reports usage for the machine as a whole. 
         :returns: Output dictionary with the following form:
             outdict = {
             "cpu_total":cpu_percent,
-            "memory_total_mb":memory_total_mb
+            "memory_total_mb":memory_used_mb
             }
         """        
-        cpu = psutil.cpu_percent(0.5)
-        memory = psutil.virtual_memory().total >> 20  ## check this in linux. 
-        outdict = {"cpu_total":cpu,
-                "memory_total_mb":str(memory)}
+        if self.sampler is None:
+            self.start_sampler()
+        latest = self.sampler.get_latest()
+        if latest is None:
+            ## psutil measurements do not block, so we can take the first one here. 
+            latest = self.sampler.sample()
+        outdict = {"cpu_total":latest["cpu_percent"],
+                "memory_total_mb":"{:.1f}".format(latest["memory_mb"])}
         return outdict
 
     def get_status(self,starttime,finishtime=None,exit_code=None):
@@ -464,21 +1450,29 @@ class NeuroCAASDataStatusLegacy(NeuroCAASDataStats):
             custom_status["finishtime"] = finishtime 
         return custom_status    
 
-    def update_file(self,stdfile,starttime,finishtime=None,exit_code=None):
+    def update_file(self,stdfile,starttime,finishtime=None,exit_code=None,tail=None):
         """Gets updates to status, usage, and stdout/err and aggregates them to be output together.   
 
+        :param tail: (optional) tuple (index of first line, list of lines) with the recent output of the process, if the caller already keeps it in memory. If given, stdfile is not read.  
         """
-        writelines = self.get_stdout(stdfile)
-        writedict = {str(i):line for i,line in enumerate(writelines)}
+        if tail is None:
+            tail = (0,self.get_stdout(stdfile))
+        offset,writelines = tail
+        ## lines are indexed by their position in the full log. 
+        writedict = {str(offset+i):line for i,line in enumerate(writelines)}
         statusdict = self.get_status(starttime,finishtime,exit_code)
         usage = self.get_usage()
         self.rawfile["status"] = statusdict["status"]
         self.rawfile["reason"] = statusdict["error"]
         self.rawfile["cpu_usage"] = "{} %".format(usage["cpu_total"])
         self.rawfile["memory_usage"] = "{} MB".format(usage["memory_total_mb"])
+        self.rawfile["usage_summary"] = self.sampler.summary()
         self.rawfile["job_start"] = statusdict["starttime"]
         self.rawfile["job_finish"] = statusdict["finishtime"]
         self.rawfile["std"] = writedict
+        if self.uploads_path is not None and os.path.exists(self.uploads_path):
+            with open(self.uploads_path,"r") as f:
+                self.rawfile["result_uploads"] = json.load(f)
         ## Remove keys from legacy usage to avoid confusion
         for key in ["stderr","stdout"]:
             try:
@@ -486,6 +1480,126 @@ class NeuroCAASDataStatusLegacy(NeuroCAASDataStats):
             except KeyError:
                 pass
 
+    def record_uploads(self,uploads):
+        """Record statistics of result uploads (see scripting.NeuroCAASScriptManager.put_results_dir), and write the status file, keeping all of its other contents. 
+
+        :param uploads: dictionary of upload statistics. 
+        """
+        self.rawfile["result_uploads"] = uploads
+        self.writeorder += [key for key in self.rawfile if key not in self.writeorder]
+        self.write()
+        self.writeobj.flush()
+
+def remove_file(path):
+    """Remove a file, if it still exists. 
+
+    :param path: path of the file to remove. 
+    """
+    try:
+        os.remove(path)
+    except FileNotFoundError:    
+        pass
+
+class LogFollower(object):
+    """Follows the output of a docker container in a background thread, using a single streaming logs(stream = True, follow = True) request instead of fetching the whole log history on every update. Keeps a bounded ring buffer of the most recent lines, and spools the full log to a local file. Lines are numbered from the start of the log, so the ring buffer can be reported with absolute line indices. If following fails, the exception is kept in self.error. 
+
+    """
+    replacedict = {"\t":"    ","\r":""}
+    def __init__(self,container,spoolpath = None,maxlines = 1000,interval = 1,remove_spool = False):
+        """
+        :param container: docker container object to follow. 
+        :param spoolpath: (optional) path of a local file to write the full log to. Truncated when following starts. 
+        :param maxlines: the number of recent lines to keep in memory. 
+        :param interval: number of seconds to wait before retrying if the container has not started yet. 
+        :param remove_spool: if true, the spool file is deleted when the follower is closed, garbage collected, or the interpreter exits. 
+        """
+        self.container = container
+        self.spoolpath = spoolpath
+        self.error = None
+        self.lines = deque(maxlen = maxlines)
+        self.count = 0 ## total number of complete lines seen. 
+        self.partial = ""
+        ## chunks of the stream can end partway through a multibyte character. 
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors = "replace")
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        if self.spoolpath is not None:
+            open(self.spoolpath,"w").close()
+        if self.spoolpath is not None and remove_spool:
+            self.remove_spool = weakref.finalize(self,remove_file,self.spoolpath)
+        else:    
+            self.remove_spool = None
+        self.thread = threading.Thread(target = self.follow,daemon = True)
+        self.thread.start()
+
+    def add(self,text):
+        """Add text from the log stream. Complete lines are added to the ring buffer and spool. 
+
+        :param text: decoded log output. May contain partial lines.  
+        """
+        for it in self.replacedict.items():
+            text = text.replace(*it)
+        text = self.partial+text
+        lines = text.split("\n")
+        with self.lock:
+            self.partial = lines.pop()
+            self.lines.extend(lines)
+            self.count += len(lines)
+        if self.spoolpath is not None and len(lines) > 0 and not self.closed():
+            with open(self.spoolpath,"a") as f:
+                f.write("\n".join(lines)+"\n")
+
+    def follow(self):
+        try:
+            self.follow_stream()
+        except Exception as e: ## e.g. the docker daemon goes away. Recorded so that it can be reported with the output. 
+            self.error = e
+        finally:    
+            self.stopped.set()
+
+    def follow_stream(self):
+        while not self.stopped.is_set():
+            for chunk in self.container.logs(stream = True,follow = True):
+                self.add(self.decoder.decode(chunk))
+                if self.stopped.is_set():
+                    return
+            ## the stream ends when the container stops. If it had not started yet, try again. 
+            try:
+                self.container.reload()
+                waiting = self.container.status == "created" and self.count == 0 and self.partial == ""
+            except Exception:
+                waiting = False
+            if not waiting:
+                break
+            self.stopped.wait(self.interval)
+        self.add(self.decoder.decode(b"",final = True))
+
+    def stop(self):
+        self.stopped.set()
+
+    def closed(self):
+        return self.remove_spool is not None and not self.remove_spool.alive
+
+    def close(self,timeout = 5):
+        """Stop following, and delete the spool file if it is temporary (see remove_spool). 
+
+        :param timeout: number of seconds to wait for the background thread to stop. 
+        """
+        self.stop()
+        self.thread.join(timeout)
+        if self.remove_spool is not None:
+            self.remove_spool()
+
+    def tail(self):
+        """Get the most recent lines, including any partial line at the end.
+
+        :return: tuple (index of the first line returned, list of lines). 
+        """
+        with self.lock:
+            lines = list(self.lines)+[self.partial]
+            return self.count-len(self.lines),lines
+
 class NeuroCAASDataStatus(NeuroCAASDataStats):
     """Per-instance log file that captures details about each individual dataset analysis run: entire history of messages printed to stdout/stderr, the exit code, any error information, etc. Written as a json file for convenience. Takes a running docker container and does everything needed to parse out relevant arguments from it. This includes the output to stdout and stderr, the current cpu usage and memory usage, the  docker container object that we will be querying for relevant status information. Note that this file is also assumed to be initialized by a lambda generated file, so we should treat it like the certificate file with similar failsafes to fall back on local processing. We inherit an init method from NeuroCAASLogObject to enable this. 
 
@@ -493,7 +1607,7 @@ class NeuroCAASDataStatus(NeuroCAASDataStats):
     :param container: docker container object that we will be querying for relevant status information. 
 
     """
-    def __init__(self,s3_path,container,write_localpath=localdata_dict["datastatus_update"]):
+    def __init__(self,s3_path,container,write_localpath=localdata_dict["datastatus_update"],spoolpath=None,maxlines=1000):
         ## This is the order in which the json file's elements should be listed.
         self.writeorder = [
                    "instance",
@@ -503,60 +1617,62 @@ class NeuroCAASDataStatus(NeuroCAASDataStats):
                    "reason",
                    "memory_usage",
                    "cpu_usage",
+                   "usage_summary",
                    "job_start",
                    "job_finish",
                    "std"]
-        ## Initialize the cpu usage stats with 0 
-        self.prev_cpu = 0
-        self.prev_system = 0
-
         super().__init__(s3_path,write_localpath)
         self.container = container
+        if spoolpath is None:
+            fd,spoolpath = tempfile.mkstemp(prefix = "neurocaas_{}_".format(getattr(container,"name","container")),suffix = "_stdout.log")
+            os.close(fd)
+            self.follower = LogFollower(container,spoolpath,maxlines,remove_spool = True)
+        else:    
+            self.follower = LogFollower(container,spoolpath,maxlines)
+        ## index of the first line returned by get_stdout. 
+        self.std_offset = 0
 
     def get_stdout(self):
-        """Get the current output to container.logs() and format without escape characters.
+        """Get the most recent output of the container (up to maxlines lines), formatted without escape characters. The full log is spooled to the file at self.follower.spoolpath (a temporary file unless a spoolpath was given, deleted on close). If the container's logs could not be followed, the error is reported as the last line. 
 
         :returns: Most recent logs, formatted as a list of strings. 
         """
-        ## Set up the way we will handle escape characters to format stdout:
-        replacedict = {"\t":"    ","\r":""}
-        logs = self.container.logs().decode("utf-8")
-        for it in replacedict.items():
-            logs = logs.replace(*it)
-        logs_lines = logs.split("\n")    
+        self.std_offset,logs_lines = self.follower.tail()
+        if self.follower.error is not None:
+            logs_lines.append("Error following container logs: {}".format(repr(self.follower.error)))
         return logs_lines
 
+    def close(self):
+        """Stop following the container's logs and sampling its usage, and delete the temporary stdout spool.  
+
+        """
+        self.follower.close()
+        if self.sampler is not None:
+            self.sampler.stop()
+
     def get_usage(self):
         """Get the current usage information for the container. Unfortunately, docker does not itself calculate cpu percentages for you. We will take the raw, high level usage stats and return them as a dictionary.  
         NOTE: It's very difficult to find confirmation that these numbers are reported in bytes, but that is the assumption given the way that other commands (i.e. docker run) work. 
 
+        Usage is sampled from the docker stats stream in the background (see ResourceSampler), so this returns the latest measurement without waiting for docker. 
+
         :return: dictionary containing output statistics
         """
-        current_usage_stats = json.loads(next(self.container.stats()).decode("utf-8"))
-        ## Taken from https://github.com/TomasTomecek/sen/blob/master/sen/util.py#L175, itself taken from docker 
-        cpu_usage = current_usage_stats["cpu_stats"]["cpu_usage"]["total_usage"]
-        if cpu_usage is not 0:
-            system_usage = current_usage_stats["cpu_stats"]["system_cpu_usage"]
-            cpu_delta = cpu_usage - self.prev_cpu
-            system_delta = system_usage - self.prev_system
-            online_cpus = online_cpus = current_usage_stats["cpu_stats"].get("online_cpus", len(current_usage_stats["cpu_stats"]["cpu_usage"]["percpu_usage"]))
-            cpu_percent = (cpu_delta/system_delta)*online_cpus*100
-        else:
-            cpu_percent = 0
-
-
-        try:
-            memory_total_stats = current_usage_stats["memory_stats"]["usage"]
-            memory_total_mb = memory_total_stats/1e6
-        except KeyError:
+        if self.sampler is None:
+            self.start_sampler(interval = 0)
+        latest = self.sampler.get_latest()
+        if latest is None or not latest["memory_mb"]:
             ### If the container is not in the "running" state, usage will not be reported. 
-            memory_total_mb = "N/A"
+            return {"cpu_total":0 if latest is None else latest["cpu_percent"],"memory_total_mb":"N/A"}
         outdict = {
-            "cpu_total":cpu_percent,
-            "memory_total_mb":memory_total_mb
+            "cpu_total":latest["cpu_percent"],
+            "memory_total_mb":latest["memory_mb"]
                 }
         return outdict 
 
+    def get_usage_source(self):
+        return DockerStatsSource(self.container)
+
     def get_status(self):
         """Get the current status of the container. This should be gotten by running the client.api.inspect method. 
 
@@ -599,13 +1715,15 @@ class NeuroCAASDataStatus(NeuroCAASDataStats):
 
         """
         writelines = self.get_stdout()
-        writedict = {str(i):line for i,line in enumerate(writelines)}
+        ## lines are indexed by their position in the full log. 
+        writedict = {str(self.std_offset+i):line for i,line in enumerate(writelines)}
         statusdict = self.get_status()
         usage = self.get_usage()
         self.rawfile["status"] = statusdict["status"]
         self.rawfile["reason"] = statusdict["error"]
         self.rawfile["cpu_usage"] = "{} %".format(usage["cpu_total"])
         self.rawfile["memory_usage"] = "{} MB".format(usage["memory_total_mb"])
+        self.rawfile["usage_summary"] = self.sampler.summary()
         self.rawfile["job_start"] = statusdict["starttime"]
         self.rawfile["job_finish"] = statusdict["finishtime"]
         self.rawfile["std"] = writedict
@@ -7,25 +7,31 @@ import numpy as np
 import logging
 import boto3
 import sys
-import localstack_client.session
+import random
+import itertools
+import queue
+import threading
+from botocore.config import Config
+from boto3.s3.transfer import TransferConfig,TransferManager
 from botocore.exceptions import ClientError,NoRegionError
+from concurrent.futures import ThreadPoolExecutor,wait,FIRST_COMPLETED
 import json
+import sqlite3
 from datetime import timedelta
 import time
 from datetime import datetime as datetime
 import os
 import polling2
-from .log import NeuroCAASCertificate,NeuroCAASDataStatusLegacy
+from .log import NeuroCAASCertificate,NeuroCAASDataStatusLegacy,EventStream,apply_events,render_certificate,render_datastatus
+from . import clients
 
-s3_client = boto3.client("s3")
-s3_resource = boto3.resource("s3")
+## Number of concurrent requests used when reading many small log objects. The s3 client connection pool is sized to match, so that all worker threads can share the same client. 
+max_workers = 32
+s3_client = clients.lazy_client("s3",name = "client:s3:pooled",config = Config(max_pool_connections = max_workers))
+s3_resource = clients.lazy_resource("s3")
 
-try:
-    cfn_client = boto3.client("cloudformation")
-    logs_client = boto3.client("logs")
-except NoRegionError: ## Handle ReadTheDocs Build.    
-    cfn_client = boto3.client("cloudformation",region_name = os.environ["REGION"])
-    logs_client = boto3.client("logs",region_name = os.environ["REGION"])
+cfn_client = clients.lazy_client("cloudformation")
+logs_client = clients.lazy_client("logs")
 
 
 jobprefix = "job__{s}_{t}" # parametrized by stackname, timestamp. 
@@ -112,44 +118,203 @@ def load_json(bucket_name, key):
         raw_content = file_object.get()['Body'].read().decode('utf-8')
         json_content = json.loads(raw_content)
     except ValueError as ve:
-        raise ValueError("[JOB TERMINATE REASON] Could not load config file. From parser: {}".format(ve))
+        raise ValueError("Could not parse s3://{}/{} as json. From parser: {}".format(bucket_name,key,ve))
 
     ## Transfer type 
     return json_content 
 
+## Error codes that indicate we are being throttled by S3, and should retry after waiting. 
+throttle_codes = ["SlowDown","Throttling","ThrottlingException","RequestLimitExceeded","TooManyRequestsException","ServiceUnavailable","503"]
+
+def get_json_retry(bucket_name,key,retries = 5,backoff = 0.2):
+    """Load the contents of a json file stored in S3, retrying with exponential backoff (and jitter) if S3 throttles the request. Uses the module level s3 client, which is safe to share between threads (unlike s3 resource objects). 
+
+    :param bucket_name: the name of the bucket where the json file lives. 
+    :param key: the path to the json object. 
+    :param retries: the number of times to retry a throttled request before giving up. 
+    :param backoff: base wait time in seconds. Doubles with every retry. 
+    :return: json content: the content of the json file. 
+    :rtype: dict
+    """
+    for attempt in range(retries+1):
+        try:
+            raw_content = s3_client.get_object(Bucket = bucket_name,Key = key)["Body"].read().decode("utf-8")
+            break
+        except ClientError as e:
+            if e.response["Error"]["Code"] in throttle_codes and attempt < retries:
+                time.sleep(backoff*(2**attempt)*(1+random.random()))
+            else:    
+                raise
+    try:
+        json_content = json.loads(raw_content)
+    except ValueError as ve:
+        raise ValueError("Could not parse log s3://{}/{} as json. From parser: {}".format(bucket_name,key,ve))
+    return json_content
+
+def load_json_concurrent(bucket_name,keys,workers = max_workers,retries = 5,report = True):
+    """Load many json files stored in S3 concurrently. Requests are issued from a bounded thread pool sharing one s3 client, and parsed contents are yielded as soon as they arrive (not in the order given). The number of requests in flight at any one time is bounded, so that memory use does not grow with the number of keys. 
+
+    :param bucket_name: the name of the bucket where the json files live. 
+    :param keys: an iterable of paths to json objects. 
+    :param workers: the number of requests to run concurrently. 
+    :param retries: the number of times to retry each throttled request.
+    :param report: if true, prints the throughput (objects/s) once all objects have been loaded. 
+    :return: generator of tuples (key, json content). 
+    """
+    keys = iter(keys)
+    window = 4*workers
+    count = 0
+    start = time.time()
+    with ThreadPoolExecutor(max_workers = workers) as executor:
+        inflight = {}
+        def submit(n):
+            for key in keys:
+                inflight[executor.submit(get_json_retry,bucket_name,key,retries)] = key
+                n -= 1
+                if n == 0:
+                    break
+        submit(window)
+        while inflight:
+            done,pending = wait(inflight,return_when = FIRST_COMPLETED)
+            for future in done:
+                key = inflight.pop(future)
+                count += 1
+                yield key,future.result()
+            submit(window-len(inflight))
+    if report:
+        elapsed = time.time()-start
+        print("Loaded {} objects in {:.2f}s ({:.1f} objects/s)".format(count,elapsed,count/max(elapsed,1e-9)),file = sys.stderr)
+
+class CostSummary():
+    """Running cost counter for a group, stored in s3 next to the group's instance reports (at logs/{group}/cost_summary). Holds the total cost of all reports folded in so far, the LastModified time of the most recently folded report (watermark) and the keys and ETags of reports at that watermark, and the reports that were unfinished (missing a start or end time) when folded in, together with their contribution to the total. On update, the group's reports are listed, and only reports modified after the watermark are read and folded in: new reports are added to the total, and unfinished reports that have since changed have their contribution corrected. Finished reports are assumed not to change. 
+
+    """
+    def __init__(self,group,total = 0.,count = 0,watermark = None,watermark_keys = None,open_reports = None):
+        """
+        :param group: the name of the group. 
+        :param total: total cost of reports folded in so far.  
+        :param count: number of reports folded in so far.
+        :param watermark: LastModified time of the most recently modified report folded in (datetime). 
+        :param watermark_keys: dictionary giving the ETags of the reports with LastModified equal to the watermark. As LastModified times have a resolution of one second, these are used to detect reports rewritten at the watermark.  
+        :param open_reports: dictionary of unfinished reports, giving their contribution to the total. 
+        """
+        self.group = group
+        self.total = total
+        self.count = count
+        self.watermark = watermark
+        self.watermark_keys = watermark_keys if watermark_keys is not None else {}
+        self.open_reports = open_reports if open_reports is not None else {}
+
+    @staticmethod
+    def get_key(group):
+        """The key at which a group's cost summary is stored. Has no extension so that it is not mistaken for an instance report when listing logs.
+
+        :param group: the name of the group.
+        """
+        return "logs/{}/cost_summary".format(group)
+
+    def to_dict(self):
+        return {
+                "group":self.group,
+                "total":self.total,
+                "count":self.count,
+                "watermark":self.watermark.isoformat() if self.watermark is not None else None,
+                "watermark_keys":self.watermark_keys,
+                "open_reports":self.open_reports
+                }
+
+    @classmethod
+    def from_dict(cls,summary):
+        watermark = datetime.fromisoformat(summary["watermark"]) if summary["watermark"] is not None else None
+        return cls(summary["group"],summary["total"],summary["count"],watermark,summary["watermark_keys"],summary["open_reports"])
+
+    @classmethod
+    def load(cls,bucket_name,group):
+        """Load a group's cost summary from s3, or create an empty one if none exists. 
+
+        :param bucket_name: the name of the bucket where logs are stored. 
+        :param group: the name of the group. 
+        """
+        try:
+            return cls.from_dict(get_json_retry(bucket_name,cls.get_key(group)))
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ["NoSuchKey","404"]:
+                return cls(group)
+            raise
+
+    def is_changed(self,obj):
+        """Check if a report has been modified since the watermark.
+
+        :param obj: dictionary with the report's Key, LastModified and ETag (as given by list_objects_v2).
+        """
+        return self.watermark is None or obj["LastModified"] > self.watermark or (obj["LastModified"] == self.watermark and self.watermark_keys.get(obj["Key"]) != obj["ETag"])
+
+    def list_changed(self,bucket_name):
+        """List reports modified since the watermark. All of the group's reports are listed on every call: instance ids are not issued in sorted order, so new reports can appear anywhere in the listing. 
+
+        :param bucket_name: the name of the bucket where logs are stored. 
+        :return: dictionary of changed reports, giving their Key, LastModified and ETag. 
+        """
+        prefix = "logs/{}/i-".format(self.group)
+        changed = {}
+        paginator = s3_client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket = bucket_name,Prefix = prefix):
+            for obj in page.get("Contents",[]):
+                if self.is_changed(obj):
+                    changed[obj["Key"]] = obj
+        return changed
+
+    def update(self,bucket_name):
+        """Fold in reports that have been modified since the watermark (see list_changed). Reports are folded in sorted key order. 
+
+        :param bucket_name: the name of the bucket where logs are stored. 
+        :return: the number of reports read.  
+        """
+        changed = self.list_changed(bucket_name)
+        if len(changed) == 0:
+            return 0
+        reports = dict(load_json_concurrent(bucket_name,changed.keys(),report = False))
+        for key in sorted(reports.keys()):
+            usage_dict = reports[key]
+            cost = get_instance_cost(usage_dict)
+            if key in self.open_reports:
+                self.total += cost-self.open_reports.pop(key)
+            else:    
+                self.total += cost
+                self.count += 1
+            if usage_dict["start"] is None or usage_dict["end"] is None:
+                self.open_reports[key] = cost
+        new_watermark = max([obj["LastModified"] for obj in changed.values()])
+        if self.watermark is None or new_watermark > self.watermark:
+            self.watermark = new_watermark
+            self.watermark_keys = {}
+        self.watermark_keys.update({k:obj["ETag"] for k,obj in changed.items() if obj["LastModified"] == self.watermark})
+        return len(reports)
+
+    def write(self,bucket_name):
+        """Write this summary to s3. Failures are reported but not raised, as the summary can always be rebuilt from the reports. 
+
+        :param bucket_name: the name of the bucket where logs are stored. 
+        :return: True if the write succeeded.
+        """
+        try:
+            s3_client.put_object(Bucket = bucket_name,Key = self.get_key(self.group),Body = json.dumps(self.to_dict()).encode("utf-8"))
+            return True
+        except ClientError as e:
+            print("could not write cost summary for {}: {}".format(self.group,e.response["Error"]))
+            return False
+
 def get_analysis_cost(path,bucket_name):
-    """ Given a username and the name of a bucket to look in, gets the cost incurred so far by a given group (as recorded in logs)  
+    """ Given a username and the name of a bucket to look in, gets the cost incurred so far by a given group (as recorded in logs). Uses the group's CostSummary, so that only reports written since the last call are read.   
 
     """
     group_name = path
     assert len(group_name) > 0; "[JOB TERMINATE REASON] Can't locate the group that triggered analysis, making it impossible to determine incurred cost."
-    logfolder_path = "logs/{}/".format(group_name)
-    full_reportpath = os.path.join(logfolder_path,"i-")
-    ## now get all of the computereport filenames:
-    all_files = ls_name(bucket_name,full_reportpath)
-
-    ## for each, we extract the contents:
-    jobdata = {}
-    cost = 0
-    ## now calculate the cost:
-    for jobfile in all_files:
-        instanceid = jobfile.split(full_reportpath)[1].split(".json")[0]
-        jobdata = load_json(bucket_name,jobfile)
-        price = jobdata["price"]
-        start = jobdata["start"]
-        end = jobdata["end"]
-        try:
-            starttime = datetime.strptime(start, "%Y-%m-%dT%H:%M:%SZ")
-            endtime = datetime.strptime(end, "%Y-%m-%dT%H:%M:%SZ")
-            diff = endtime-starttime
-            duration = abs(diff.seconds)
-            instcost = price*duration/3600.
-        except TypeError:
-            ## In rare cases it seems one or the other of these things don't actually have entries. This is a problem. for now, charge for the hour:
-            instcost = price
-        cost+= instcost
-
-    return cost
+    summary = CostSummary.load(bucket_name,group_name)
+    if summary.update(bucket_name) > 0:
+        summary.write(bucket_name)
+
+    return summary.total
     
 ## Job history (imported from neurocaas/ncap_iac/ncap_blueprints/dev_utils/track_usage.py)
 form = "%Y-%m-%dT%H:%M:%SZ"
@@ -192,11 +357,11 @@ def get_jobs(dict_files):
 def sort_activity_by_users(dict_files,userlist):
     """
     When given the raw response output + list of usernames, returns a dictionary of files organized by that username. Passes on debugging logs and logs that are currently active. 
-    :param dict_files: raw output of list objects api. 
+    :param dict_files: raw output of list objects api. "Contents" can be any iterable of object summaries (i.e. a generator streaming a listing).
     :param userlist: a list of usernames for whom we will assign jobs. 
     :return: userdict, a dictionary indexed by user names, with values giving lists of jobs attributed to that user.
     """
-    activity = [li["Key"] for li in dict_files["Contents"] if li["Key"].endswith(".json")]
+    activity = (li["Key"] for li in dict_files["Contents"] if li["Key"].endswith(".json"))
     userdict = {name:[] for name in userlist}
     for a in activity:
         user = os.path.basename(os.path.dirname(a))
@@ -210,47 +375,85 @@ def sort_activity_by_users(dict_files,userlist):
                 userdict[user].append(a)
     return userdict
 
-def get_user_logs(bucket_name):
+def list_log_prefixes(bucket_name,prefix = "logs/"):
+    """Lists one level of the logs folder with a delimiter, returning the prefixes of each user's log folder and any objects stored directly in the logs folder.  
+
+    :param bucket_name: the name of the s3 bucket we are looking for
+    :param prefix: the folder to list. 
+    :return: tuple (list of user prefixes, list of object summaries at the top level) 
     """
-    returns a list of s3 paths corresponding to logged users inside a bucket.
+    prefixes = []
+    contents = []
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket = bucket_name,Prefix = prefix,Delimiter = "/"):
+        prefixes.extend([p["Prefix"] for p in page.get("CommonPrefixes",[])])
+        contents.extend(page.get("Contents",[]))
+    return prefixes,contents
+
+def iter_log_objects(bucket_name,prefixes,workers = max_workers):
+    """Lists the objects under a set of prefixes concurrently (one paginated listing per prefix), and yields object summaries as pages arrive. Pages are passed through a bounded queue, so that the full listing is never held in memory.  
 
     :param bucket_name: the name of the s3 bucket we are looking for
+    :param prefixes: list of prefixes to list. 
+    :param workers: the number of prefixes to list concurrently. 
+    :return: generator of object summaries (dictionaries with Key, ETag, LastModified, etc.) 
+    """
+    if len(prefixes) == 0:
+        return
+    pages = queue.Queue(maxsize = 2*workers)
+    stop = threading.Event()
+    def list_prefix(prefix):
+        paginator = s3_client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket = bucket_name,Prefix = prefix):
+            contents = page.get("Contents",[])
+            while not stop.is_set():
+                try:
+                    pages.put(contents,timeout = 0.1)
+                    break
+                except queue.Full:
+                    continue
+            if stop.is_set():
+                return
+
+    with ThreadPoolExecutor(max_workers = min(workers,len(prefixes))) as executor:
+        futures = [executor.submit(list_prefix,prefix) for prefix in prefixes]
+        try:
+            while True:
+                try:
+                    contents = pages.get(timeout = 0.1)
+                except queue.Empty:
+                    if all(f.done() for f in futures) and pages.empty():
+                        break
+                    continue
+                yield from contents
+        finally:
+            ## if the consumer stops early or listing fails, release any blocked workers. 
+            stop.set()
+    for f in futures:
+        f.result()
+
+def get_user_logs(bucket_name):
     """
+    returns a list of s3 paths corresponding to logged users inside a bucket. User folders are discovered with a delimited listing, and then listed concurrently. Keys are streamed into sort_activity_by_users, so the full listing is never held in memory. 
 
-    keepgoing = True
-    list_counter = 0
-    checktruncated = False
-    all_contents = []
+    :param bucket_name: the name of the s3 bucket we are looking for
+    """
     try:
         print(bucket_name)
-        l = s3_client.list_objects_v2(Bucket=bucket_name,Prefix = "logs",MaxKeys=1000)
-        all_contents+=l["Contents"]
+        prefixes,contents = list_log_prefixes(bucket_name)
     except ClientError as e:
         print(e.response["Error"])
         raise
-    
-    while l["IsTruncated"]: 
-        if 'NextContinuationToken' not in l:
-            print(f'NextContinuationToken is not in response while IsTruncated = {l["IsTruncated"]}',
-                 file=sys.stderr)
-            sys.exit(1)
-
-        l = s3_client.list_objects_v2(Bucket=bucket_name,Prefix = "logs",MaxKeys=1000,
-            ContinuationToken=l['NextContinuationToken'])
-        all_contents+=l["Contents"]
-        list_counter += 1
-        print(f'list {list_counter}', file=sys.stderr)
-
-    if checktruncated:
-        print("WARNING: not listed all results.")
-    else:
-        print("Listed all results.")
 
     ## Get Users
-
-    l["Contents"] = all_contents
-    users = get_users(l)
-    users_dict = sort_activity_by_users(l,users)
+    users = [os.path.basename(p[:-1]) for p in prefixes]
+    users = [u for u in users if u not in ["active","debug"]]
+
+    def stream():
+        yield from contents
+        yield from iter_log_objects(bucket_name,prefixes)
+    users_dict = sort_activity_by_users({"Contents":stream()},users)
+    print("Listed all results.")
     return users_dict
 
 def get_duration(start,end):
@@ -269,72 +472,388 @@ def get_month(start):
     return time.month
 
 
-def calculate_usage(bucket_name,usage_list,user):
+def get_instance_cost(usage_dict):
+    """Get the cost incurred by a single instance from its log. 
+
+    :param usage_dict: the contents of an instance log. 
+    :return: cost in dollars.
     """
-    gets the json files containing the usage for a particular user, and returns the total (number of hours, cost, and number of jobs run) per month.
-    :param bucket_name: string giving the s3 bucket we are reading into.
-    :param usage_list: a list of job logs, for a particular user authorized to use this analysis. 
-    :param user: the user to whom we should assign this usage. 
+    try:
+        starttime = datetime.strptime(usage_dict["start"], form)
+        endtime = datetime.strptime(usage_dict["end"], form)
+        diff = endtime-starttime
+        duration = abs(diff.seconds)
+        instcost = usage_dict["price"]*duration/3600.
+    except TypeError:
+        ## In rare cases it seems one or the other of these things don't actually have entries. This is a problem. for now, charge for the hour:
+        instcost = usage_dict["price"]
+    return instcost    
+
+def parse_times(timestrings):
+    """Vectorized conversion of timestamps formatted as in instance logs (e.g. 2020-05-17T01:21:05Z) to numpy datetime64 values. Missing timestamps (None) are converted to NaT.
+
+    :param timestrings: an iterable of timestamp strings or None. 
+    :return: numpy array of dtype datetime64[s].
     """
+    return np.array([t.rstrip("Z") if t is not None else "NaT" for t in timestrings],dtype = "datetime64[s]")
 
+def sweep_concurrency(starts,ends,groups = None):
+    """Sweep-line over a set of time intervals, giving the exact number of intervals active at every point in time. Interval endpoints are sorted once (O(n log n)), and concurrency is the running sum of +1 (start) and -1 (end) events. Intervals that touch (one ends when the next starts) are not counted as concurrent. If groups are given, a separate timeline is computed for each group in the same pass. 
+
+    :param starts: array of interval start times (datetime64 or numeric).
+    :param ends: array of interval end times. Intervals that do not have positive length are ignored.
+    :param groups: (optional) array of integer group labels, one per interval. 
+    :return: tuple of arrays (groups,times,levels) sorted by group and time, where levels[i] gives the number of intervals of group groups[i] active from times[i] until the next event of the same group.  
+    """
+    def as_numeric(t):
+        t = np.asarray(t)
+        return t.astype("datetime64[s]").astype(np.int64) if t.dtype.kind == "M" else t
+    starts,ends = as_numeric(starts),as_numeric(ends)
+    if groups is None:
+        groups = np.zeros(len(starts),dtype = np.int64)
+    groups = np.asarray(groups)
+    keep = ends > starts
+    times = np.concatenate([starts[keep],ends[keep]])
+    deltas = np.concatenate([np.ones(np.sum(keep),dtype = np.int64),-np.ones(np.sum(keep),dtype = np.int64)])
+    eventgroups = np.concatenate([groups[keep],groups[keep]])
+    ## sort by group, then time, with ends before starts at the same time. 
+    order = np.lexsort((deltas,times,eventgroups))
+    ## each group's events sum to zero, so a single running sum restarts at every group boundary.
+    return eventgroups[order],times[order],np.cumsum(deltas[order])
+
+def concurrency_stats(groups,times,levels,ngroups = 1):
+    """Summarize concurrency timelines produced by sweep_concurrency. 
+
+    :param groups: group labels of events, as returned by sweep_concurrency.
+    :param times: times of events, as returned by sweep_concurrency.
+    :param levels: concurrency after each event, as returned by sweep_concurrency.
+    :param ngroups: the number of groups. 
+    :return: list of dictionaries (one per group) with keys "peak" (maximum number of concurrent intervals), "busy" (total time with at least one interval active), "average" (time-weighted average concurrency while busy) and "histogram" (dictionary giving the total time spent at each concurrency level).  
+    """
+    if len(times) > 0:
+        ## time each level is held for (zero at the last event of each group). 
+        held = np.zeros(len(times))
+        same = groups[1:] == groups[:-1]
+        held[:-1] = np.where(same,np.diff(times),0)
+        width = int(levels.max())+1
+        hist = np.bincount(groups*width+levels,weights = held,minlength = ngroups*width).reshape(ngroups,width)
+        peak = np.zeros(ngroups,dtype = np.int64)
+        np.maximum.at(peak,groups,levels)
+    else:    
+        width = 1
+        hist = np.zeros((ngroups,width))
+        peak = np.zeros(ngroups,dtype = np.int64)
+    busy = hist[:,1:].sum(axis = 1)
+    weighted = (hist*np.arange(width)).sum(axis = 1)
+    stats = []
+    for g in range(ngroups):
+        stats.append({
+            "peak":int(peak[g]),
+            "busy":float(busy[g]),
+            "average":float(weighted[g]/busy[g]) if busy[g] > 0 else 0.,
+            "histogram":{int(l):float(hist[g,l]) for l in range(1,width) if hist[g,l] > 0}
+            })
+    return stats
+
+def get_first_datapath(usage_dict):
+    """Get the path of the (first) dataset analyzed by an instance, as recorded in its log. 
+
+    :param usage_dict: the contents of an instance log. 
+    :return: string, empty if no datapath was recorded. 
+    """
+    datapath = usage_dict.get("datapath")
+    if type(datapath) is list:
+        datapath = datapath[0] if len(datapath) > 0 else None
+    return str(datapath) if datapath is not None else ""
+
+class UsageTable():
+    """Columnar representation of instance logs, stored as a numpy structured array with one row per instance (sorted by the key of the instance log). Has columns key, user, stack, jobpath, datapath (the first dataset analyzed, or an empty string if not recorded), instance, price, start and end, where start and end are datetime64 values (NaT if not recorded). Rollups over this table are computed as vectorized group-bys instead of per-record loops. Tables can be saved to disk with the save method, and reloaded with UsageTable.load.
+
+    """
+    columns = ["key","user","stack","jobpath","datapath","instance","price","start","end"]
     months = ["January","February","March","April","May","June","July","August","September","October","November","December"]
-    monthly_cost = {months[i]:0 for i in range(12)}
-    monthly_time = {months[i]:0 for i in range(12)}
-    usage_compiled = {"username":user,"cost":monthly_cost,"duration":monthly_time}
-
-    for job in usage_list:
-        usage_dict = load_json(bucket_name,job)
-        if None in [usage_dict["start"],usage_dict["end"]]:
-            continue
-        duration = get_duration(usage_dict["start"],usage_dict["end"])
-        month = get_month(usage_dict["start"])
-        cost = (usage_dict["price"]/3600)*duration
-        usage_compiled["cost"][months[month]] += cost
-        usage_compiled["duration"][months[month]] += duration
-
-    return usage_compiled
 
-def calculate_parallelism(bucket_name,usage_list,user):
-    """calculates the paralellism of user's usage. How much of the total running job time was spent on jobs running together? 
+    def __init__(self,data):
+        """
+        :param data: a numpy structured array with fields given by UsageTable.columns.
+        """
+        assert list(data.dtype.names) == self.columns, "table must have fields {}".format(self.columns)
+        self.data = data
+
+    @classmethod
+    def from_logs(cls,keys,usage_dicts,users):
+        """Build a table from parallel lists of instance log keys, contents and users. 
+
+        :param keys: list of keys of instance logs in s3. 
+        :param usage_dicts: list of the contents of those instance logs. 
+        :param users: list of the users to whom each log is assigned. 
+        """
+        order = np.argsort(np.array(keys,dtype = str),kind = "stable")
+        columns = {
+                "key":np.array(keys,dtype = str),
+                "user":np.array([str(u) for u in users],dtype = str),
+                "stack":np.array([str(u.get("databucket")) for u in usage_dicts],dtype = str),
+                "jobpath":np.array([u["jobpath"] for u in usage_dicts],dtype = str),
+                "datapath":np.array([get_first_datapath(u) for u in usage_dicts],dtype = str),
+                "instance":np.array([u["instance-id"] for u in usage_dicts],dtype = str),
+                "price":np.array([u["price"] for u in usage_dicts],dtype = float),
+                "start":parse_times([u["start"] for u in usage_dicts]),
+                "end":parse_times([u["end"] for u in usage_dicts]),
+                }
+        data = np.empty(len(keys),dtype = [(c,columns[c].dtype) for c in cls.columns])
+        for c in cls.columns:
+            data[c] = columns[c]
+        return cls(data[order])
+
+    @classmethod
+    def load(cls,path):
+        """Load a table previously written with the save method. 
+
+        :param path: path to a .npy file. 
+        """
+        return cls(np.load(path,allow_pickle = False))
+
+    def save(self,path):
+        """Save this table to disk as a .npy file. 
+
+        :param path: path to write to. 
+        """
+        np.save(path,self.data,allow_pickle = False)
+
+    def __len__(self):
+        return len(self.data)
+
+    def select(self,user = None):
+        """Get the rows of the table belonging to a particular user.
+
+        :param user: (optional) if given, only return rows assigned to this user. 
+        :return: a UsageTable. 
+        """
+        if user is None:
+            return self
+        return UsageTable(self.data[self.data["user"] == user])
+
+    def valid(self):
+        """Boolean mask of rows for which both start and end times were recorded.
+
+        """
+        return ~np.isnat(self.data["start"]) & ~np.isnat(self.data["end"])
+
+    def durations(self):
+        """Duration of each instance in seconds (NaN if start or end was not recorded). 
+
+        """
+        durations = (self.data["end"]-self.data["start"]).astype(float)
+        durations[~self.valid()] = np.nan
+        return durations
+
+    def costs(self):
+        """Cost of each instance in dollars, following the conventions of get_instance_cost: instances that do not have both start and end times are charged for one hour. 
+
+        """
+        seconds = np.mod((self.data["end"]-self.data["start"]).astype("timedelta64[s]").astype(np.int64),86400)
+        costs = self.data["price"]*seconds/3600.
+        valid = self.valid()
+        costs[~valid] = self.data["price"][~valid]
+        return costs
+
+    def monthly(self):
+        """Total cost and duration of instances per month of the year in which they started. Instances that do not have both start and end times are excluded. 
+
+        :return: tuple of arrays (cost,duration), each of length 12. 
+        """
+        valid = self.valid()
+        month = self.data["start"][valid].astype("datetime64[M]").astype(np.int64) % 12
+        durations = self.durations()[valid]
+        cost = np.bincount(month,weights = (self.data["price"][valid]/3600)*durations,minlength = 12)
+        duration = np.bincount(month,weights = durations,minlength = 12)
+        return cost,duration
+
+    def get_usage(self,user):
+        """Get the total cost and duration of a particular user's usage per month, formatted as in calculate_usage. 
+
+        :param user: the user whose usage we should compile. 
+        """
+        cost,duration = self.select(user).monthly()
+        return {
+                "username":user,
+                "cost":{m:cost[i] for i,m in enumerate(self.months)},
+                "duration":{m:duration[i] for i,m in enumerate(self.months)}
+                }
+
+    def group_totals(self,column):
+        """Total cost, duration and instance count grouped by the values of a given column. 
+
+        :param column: name of the column to group by (e.g. user, stack or jobpath).
+        :return: dictionary indexed by column value, with values giving dictionaries of cost, duration and instance count.   
+        """
+        groups,inverse = np.unique(self.data[column],return_inverse = True)
+        cost = np.bincount(inverse,weights = self.costs(),minlength = len(groups))
+        duration = np.bincount(inverse,weights = np.nan_to_num(self.durations()),minlength = len(groups))
+        instances = np.bincount(inverse,minlength = len(groups))
+        return {str(g):{"cost":cost[i],"duration":duration[i],"instances":int(instances[i])} for i,g in enumerate(groups)}
+
+    def user_totals(self):
+        """Total cost, duration and instance count per user. 
+
+        """
+        return self.group_totals("user")
+
+    def job_parallelism(self):
+        """Number of instances launched by each job. 
+
+        :return: dictionary indexed by jobpath. 
+        """
+        jobs,counts = np.unique(self.data["jobpath"],return_counts = True)
+        return {str(j):int(c) for j,c in zip(jobs,counts)}
+
+    def concurrency(self,column = None):
+        """Exact concurrency of instances over time, computed with a sweep-line over instance start and end times. Instances without both start and end times are excluded. 
+
+        :param column: (optional) name of a column to group by (e.g. jobpath, user or stack). If not given, statistics are computed over the whole table.
+        :return: dictionary of statistics as described in concurrency_stats, or a dictionary of these indexed by column value if column is given.  
+        """
+        valid = self.valid()
+        data = self.data[valid]
+        if column is None:
+            return concurrency_stats(*sweep_concurrency(data["start"],data["end"]))[0]
+        names,inverse = np.unique(data[column],return_inverse = True)
+        stats = concurrency_stats(*sweep_concurrency(data["start"],data["end"],inverse),ngroups = len(names))
+        return {str(n):stats[i] for i,n in enumerate(names)}
+
+class JobLedger():
+    """In-memory ledger of the instance logs kept in the logs folder of an analysis bucket. Each log is read from S3 once, and instances are grouped by the job (jobpath) that launched them. Usage, cost and parallelism reports are all computed from the ledger, so that generating several reports does not require rereading logs. Start, end, price and duration information is kept in a columnar UsageTable (see the table attribute).  
 
     """
-    by_job = {}
-    job_rfs = {}
-    for inst in usage_list:
-        rf_start = RangeFinder()
-        rf_end = RangeFinder()
-        usage_dict = load_json(bucket_name,inst)
-        if all([usage_dict[state] is None for state in ["start","end"]]):
-            logging.warning("skipping something for user {}".format(user))
-            print("skipping something for user {}".format(user))
-            continue
+    def __init__(self):
+        ## Instance logs, indexed by their key in s3. 
+        self.instances = {}
+        ## User to whom each instance log is assigned, indexed by key in s3. 
+        self.users = {}
+        ## Keys of instance logs, grouped by jobpath.
+        self.jobs = {}
+        self._table = None
+
+    @classmethod
+    def from_user_logs(cls,bucket_name,user_dict):
+        """Build a ledger from the output of get_user_logs, reading all of the given logs in one pass. 
+
+        :param bucket_name: string giving the s3 bucket we are reading from.
+        :param user_dict: a dictionary indexed by user names, with values giving lists of instance logs attributed to that user. 
+        """
+        ledger = cls()
+        key_users = {key:user for user,keys in user_dict.items() for key in keys}
+        ledger.ingest(bucket_name,key_users.keys(),key_users)
+        return ledger
 
-        job = usage_dict["jobpath"]
-        try:
+    def ingest(self,bucket_name,keys,user = None):
+        """Read instance logs from s3 and add them to the ledger. Logs that are already in the ledger are not read again. 
+
+        :param bucket_name: string giving the s3 bucket we are reading from.
+        :param keys: an iterable of keys to instance logs. 
+        :param user: the user to whom we should assign these logs. Can also be a dictionary mapping each key to a user. 
+        """
+        new_keys = [key for key in keys if key not in self.instances]
+        for key,usage_dict in load_json_concurrent(bucket_name,new_keys):
+            if isinstance(user,dict):
+                self.add(key,usage_dict,user[key])
+            else:    
+                self.add(key,usage_dict,user)
+
+    def add(self,key,usage_dict,user = None):
+        """Add a single instance log to the ledger. 
+
+        :param key: the key of the instance log in s3. 
+        :param usage_dict: the contents of the instance log. 
+        :param user: the user to whom we should assign this log. 
+        """
+        self.instances[key] = usage_dict    
+        self.users[key] = user
+        self.jobs.setdefault(usage_dict["jobpath"],[]).append(key)
+        self._table = None
+
+    @property
+    def table(self):
+        """UsageTable built from the contents of the ledger. Rebuilt only when new logs have been added.
+
+        """
+        if self._table is None:
+            keys = list(self.instances.keys())
+            self._table = UsageTable.from_logs(keys,[self.instances[k] for k in keys],[self.users[k] for k in keys])
+        return self._table    
+
+    def get_keys(self,user = None):
+        """Get the keys of instance logs in the ledger, in sorted order. 
+
+        :param user: (optional) if given, only return logs assigned to this user. 
+        """
+        return sorted(key for key,u in self.users.items() if user is None or u == user)
+
+    def get_usage(self,user):
+        """Get the total cost and duration of a particular user's usage per month. 
+
+        :param user: the user whose usage we should compile. 
+        :return: dictionary with the username, and the cost and duration per month. 
+        """
+        return self.table.get_usage(str(user))
+
+    def get_cost(self,user):
+        """Get the total cost incurred by a user (as recorded in logs). 
+
+        :param user: the user whose cost we should calculate. 
+        :return: cost in dollars. 
+        """
+        totals = self.table.user_totals()
+        return totals.get(str(user),{"cost":0})["cost"]
+
+    def get_parallelism(self,user,include_nones = False):
+        """Organizes a user's instances into the jobs that launched them. For each job, records the instances, their durations, the last time an instance started, and the first time an instance ended.  
+
+        :param user: the user whose jobs we should organize. 
+        :param include_nones: if true, include instances that have neither a start nor an end time. 
+        :return: dictionary indexed by jobpath. 
+        """
+        table = self.table.select(str(user))
+        durations = table.durations()
+        by_job = {}
+        job_rfs = {}
+        for key,duration in zip(table.data["key"],durations):
+            usage_dict = dict(self.instances[key])
+            if all([usage_dict[state] is None for state in ["start","end"]]) and not include_nones:
+                logging.warning("skipping something for user {}".format(user))
+                print("skipping something for user {}".format(user))
+                continue
+
+            job = usage_dict["jobpath"]
+            if job not in by_job:
+                job_rfs[job] = {"rf_start":RangeFinder(),"rf_end":RangeFinder()}
+                by_job[job] = {"instances":[],"durations":{}}
             job_rfs[job]["rf_start"].update(usage_dict["start"])
             job_rfs[job]["rf_end"].update(usage_dict["end"])
             by_job[job]["instances"].append(usage_dict)
-            try:
-                by_job[job]["durations"][usage_dict["instance-id"]] = get_duration(usage_dict["start"],usage_dict["end"])
-            except TypeError:    
-                by_job[job]["durations"][usage_dict["instance-id"]] = None
+            by_job[job]["durations"][usage_dict["instance-id"]] = None if np.isnan(duration) else float(duration)
             by_job[job]["laststart"] = job_rfs[job]["rf_start"].endtime
             by_job[job]["firstend"] = job_rfs[job]["rf_end"].starttime
+        return by_job    
 
-        except KeyError:    
-            job_rfs[job] = {"rf_start":RangeFinder(),"rf_end":RangeFinder()}
-            job_rfs[job]["rf_start"].update(usage_dict["start"])
-            job_rfs[job]["rf_end"].update(usage_dict["end"])
-            by_job[job] = {"instances":[usage_dict]}
-            #####by_job[job]["instances"] = [usage_dict]
-            try:
-                by_job[job]["durations"] = {usage_dict["instance-id"]:get_duration(usage_dict["start"],usage_dict["end"])}
-            except TypeError:    
-                by_job[job]["durations"] = {usage_dict["instance-id"]:None}
-            by_job[job]["laststart"] = job_rfs[job]["rf_start"].endtime
-            by_job[job]["firstend"] = job_rfs[job]["rf_end"].starttime
+def calculate_usage(bucket_name,usage_list,user):
+    """
+    gets the json files containing the usage for a particular user, and returns the total (number of hours, cost, and number of jobs run) per month.
+    :param bucket_name: string giving the s3 bucket we are reading into.
+    :param usage_list: a list of job logs, for a particular user authorized to use this analysis. 
+    :param user: the user to whom we should assign this usage. 
+    """
+    ledger = JobLedger()
+    ledger.ingest(bucket_name,usage_list,user)
+    return ledger.get_usage(user)
 
-    return by_job
+def calculate_parallelism(bucket_name,usage_list,user):
+    """calculates the paralellism of user's usage. How much of the total running job time was spent on jobs running together? 
+
+    """
+    ledger = JobLedger()
+    ledger.ingest(bucket_name,usage_list,user)
+    return ledger.get_parallelism(user)
 
 def postprocess_jobdict(by_job):
     """Given a dictionary where the keys are job names, and the values are dictionaries with metadata about that job, looks in particular for jobs where some of the time entries have been neglected. If just the Start time has been neglected, replaces that with the last recorded start time as an esimate, and fills in the corresponding duration. If the whole job has no start or end times, remove it.     
@@ -360,56 +879,260 @@ def calculate_parallelism_nones(bucket_name,usage_list,user):
     """ Organizes individual runs into jobs, enven if none. 
 
     """
-    by_job = {}
-    job_rfs = {}
-    for inst in usage_list:
-        rf_start = RangeFinder()
-        rf_end = RangeFinder()
-        usage_dict = load_json(bucket_name,inst)
-        if all([usage_dict[state] is None for state in ["start","end"]]):
-            pass
+    ledger = JobLedger()
+    ledger.ingest(bucket_name,usage_list,user)
+    return ledger.get_parallelism(user,include_nones = True)
 
-        job = usage_dict["jobpath"]
-        try:
-            job_rfs[job]["rf_start"].update(usage_dict["start"])
-            job_rfs[job]["rf_end"].update(usage_dict["end"])
-            by_job[job]["instances"].append(usage_dict)
-            try:
-                by_job[job]["durations"][usage_dict["instance-id"]] = get_duration(usage_dict["start"],usage_dict["end"])
-            except TypeError:    
-                by_job[job]["durations"][usage_dict["instance-id"]] = None
-            by_job[job]["laststart"] = job_rfs[job]["rf_start"].endtime
-            by_job[job]["firstend"] = job_rfs[job]["rf_end"].starttime
+class UsageIndex():
+    """Local SQLite index of the instance logs kept in the logs folder of analysis buckets. Logs are keyed by stack and s3 key, and stored with their ETag, LastModified time, user and content. For each stack we additionally keep a watermark (the most recent LastModified time ingested), so that repeated ingestion only reads objects that have changed since the last run. Each ingestion lists the whole logs folder, so logs that have been deleted from s3 are removed from the index as well. Reports can then be generated from the index without rereading the logs folder. 
 
-        except KeyError:    
-            job_rfs[job] = {"rf_start":RangeFinder(),"rf_end":RangeFinder()}
-            job_rfs[job]["rf_start"].update(usage_dict["start"])
-            job_rfs[job]["rf_end"].update(usage_dict["end"])
-            by_job[job] = {"instances":[usage_dict]}
-            #####by_job[job]["instances"] = [usage_dict]
-            try:
-                by_job[job]["durations"] = {usage_dict["instance-id"]:get_duration(usage_dict["start"],usage_dict["end"])}
-            except TypeError:    
-                by_job[job]["durations"] = {usage_dict["instance-id"]:None}
-            by_job[job]["laststart"] = job_rfs[job]["rf_start"].endtime
-            by_job[job]["firstend"] = job_rfs[job]["rf_end"].starttime
+    """
+    def __init__(self,path):
+        """
+        :param path: path to the sqlite database file. Will be created if it does not exist. 
+        """
+        self.path = path
+        self.removed = 0 ## number of deleted logs removed by the last ingestion. 
+        self.conn = sqlite3.connect(path)
+        with self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS logs (stack TEXT, key TEXT, etag TEXT, last_modified TEXT, user TEXT, content TEXT, PRIMARY KEY (stack,key))")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS watermarks (stack TEXT PRIMARY KEY, last_modified TEXT)")
 
-    return by_job
+    def close(self):
+        self.conn.close()
+
+    def get_watermark(self,stack):
+        """Get the most recent LastModified time ingested for a stack.  
+
+        :param stack: name of the stack (bucket). 
+        :return: datetime, or None if the stack has not been ingested. 
+        """
+        row = self.conn.execute("SELECT last_modified FROM watermarks WHERE stack = ?",(stack,)).fetchone()
+        if row is None:
+            return None
+        return datetime.fromisoformat(row[0])
+
+    def list_logs(self,stack):
+        """List the instance logs in the logs folder of a stack's bucket.
+
+        :param stack: name of the stack (bucket). 
+        :return: generator of object summaries (dictionaries with Key, ETag and LastModified)
+        """
+        prefixes,contents = list_log_prefixes(stack)
+        for obj in itertools.chain(contents,iter_log_objects(stack,prefixes)):
+            if obj["Key"].endswith(".json"):
+                yield obj
+
+    def ingest(self,stack):
+        """Bring the index up to date with the logs folder of a stack's bucket. Only objects modified since the stored watermark whose ETag differs from the indexed version are read. Indexed logs that are no longer listed are removed (their number is stored in self.removed). 
+
+        :param stack: name of the stack (bucket). 
+        :return: the number of logs read. 
+        """
+        watermark = self.get_watermark(stack)
+        etags = dict(self.conn.execute("SELECT key,etag FROM logs WHERE stack = ?",(stack,)).fetchall())
+        new_watermark = watermark
+        to_fetch = {}
+        listed = set()
+        for obj in self.list_logs(stack):
+            listed.add(obj["Key"])
+            if new_watermark is None or obj["LastModified"] > new_watermark:
+                new_watermark = obj["LastModified"]
+            if watermark is not None and obj["LastModified"] < watermark:
+                continue
+            if etags.get(obj["Key"]) == obj["ETag"]:
+                continue
+            to_fetch[obj["Key"]] = obj
+        deleted = [key for key in etags if key not in listed]
+        count = 0    
+        with self.conn:
+            self.conn.executemany("DELETE FROM logs WHERE stack = ? AND key = ?",[(stack,key) for key in deleted])
+            self.removed = len(deleted)
+            for key,usage_dict in load_json_concurrent(stack,to_fetch.keys()):
+                user = os.path.basename(os.path.dirname(key))
+                self.conn.execute("INSERT OR REPLACE INTO logs VALUES (?,?,?,?,?,?)",(stack,key,to_fetch[key]["ETag"],to_fetch[key]["LastModified"].isoformat(),user,json.dumps(usage_dict)))
+                count += 1
+            if new_watermark is not None:    
+                self.conn.execute("INSERT OR REPLACE INTO watermarks VALUES (?,?)",(stack,new_watermark.isoformat()))
+        return count    
+
+    def get_user_logs(self,stack):
+        """Index equivalent of get_user_logs: returns the keys of instance logs for a stack, organized by user. Passes on debugging logs and logs that are currently active.
+
+        :param stack: name of the stack (bucket). 
+        :return: userdict, a dictionary indexed by user names, with values giving lists of jobs attributed to that user.
+        """
+        userdict = {}
+        for key,user in self.conn.execute("SELECT key,user FROM logs WHERE stack = ? ORDER BY key",(stack,)):
+            if user in ["active","debug"]:
+                continue
+            userdict.setdefault(user,[]).append(key)
+        return userdict    
+
+    def get_ledger(self,stack):
+        """Build a JobLedger from the logs indexed for a stack, without reading from s3. 
+
+        :param stack: name of the stack (bucket). 
+        :return: JobLedger
+        """
+        ledger = JobLedger()
+        for key,user,content in self.conn.execute("SELECT key,user,content FROM logs WHERE stack = ?",(stack,)):
+            if user in ["active","debug"]:
+                continue
+            ledger.add(key,json.loads(content),user)
+        return ledger    
 
 class LambdaMonitor():
     """Base class for lambda monitoring. Has specific subtypes for main and sub lambdas
 
     """
-    def __init__(self,stackname):
+    ## length of the log windows cached on disk, and how long to wait after a window closes before caching it (cloudwatch ingestion can lag). 
+    window_ms = 3600*1000
+    settle_ms = 10*60*1000
+
+    def __init__(self,stackname,cache_dir = None):
         """
+        :param stackname: name of the stack to monitor.
+        :param cache_dir: (optional) directory in which to cache log events on disk. If given, log events from closed hour-long windows are stored here and served locally on repeated queries, and the cursor used by follow is persisted here. 
         """
         self.stackname = stackname
         self.lambda_pid = self.get_lambda_id()
         self.log_group = "/aws/lambda/{}".format(self.lambda_pid)
+        if cache_dir is not None:
+            self.cache_dir = os.path.join(cache_dir,self.log_group.strip("/").replace("/","_"))
+            os.makedirs(self.cache_dir,exist_ok = True)
+        else:    
+            self.cache_dir = None
+
+    def fetch_events(self,start,end):
+        """Fetch all log events in a time range with filter_log_events, following nextToken through all pages. 
+
+        :param start: start of the range (ms since epoch). 
+        :param end: end of the range (ms since epoch). 
+        :returns: a list of events (dictionaries with logStreamName, timestamp, message and eventId).
+        """
+        events = []
+        kwargs = {"logGroupName":self.log_group,"startTime":int(start),"endTime":int(end)}
+        while True:
+            response = logs_client.filter_log_events(**kwargs)
+            events.extend([{k:e[k] for k in ["logStreamName","timestamp","message","eventId"]} for e in response["events"]])
+            if response.get("nextToken") is None:
+                break
+            kwargs["nextToken"] = response["nextToken"]
+        return events    
+
+    def get_window(self,window_start,now):
+        """Get the log events in the hour-long window starting at window_start. Windows that closed long enough ago are read from (and written to) the on-disk cache.
+
+        :param window_start: start of the window (ms since epoch), aligned to window_ms. 
+        :param now: current time (ms since epoch). 
+        :returns: a list of events. 
+        """
+        window_end = window_start+self.window_ms
+        cacheable = self.cache_dir is not None and window_end+self.settle_ms < now
+        if cacheable:
+            cachefile = os.path.join(self.cache_dir,"{}.json".format(window_start))
+            try:
+                with open(cachefile,"r") as f:
+                    return json.load(f)
+            except (FileNotFoundError,ValueError):
+                pass
+        events = self.fetch_events(window_start,window_end-1)
+        if cacheable:
+            with open(cachefile,"w") as f:
+                json.dump(events,f)
+        return events        
+
+    def get_events(self,hours = 1):
+        """Get the log events from the last {hours} hours, in chronological order. The range is split into hour-long windows so that closed windows can be cached. 
+
+        :param hours: the number of hours to start collecting logs in.  
+        :returns: a list of events.
+        """
+        now = int(datetime.today().timestamp()*1000)
+        start = now-int(hours*3600*1000)
+        events = []
+        for window_start in range(start-start%self.window_ms,now,self.window_ms):
+            events.extend(self.get_window(window_start,now))
+        events = [e for e in events if start <= e["timestamp"] <= now]    
+        events.sort(key = lambda e:e["timestamp"])
+        return events
+
+    def parse_events(self,events):
+        """Group log events by logstream in the same format as parse_response. 
+
+        :param events: a list of events in chronological order. 
+        :returns: a list of dictionaries, containing logs for requests in reverse chronological order. 
+        """
+        streamdict = {}
+        for e in events:
+            streamdict.setdefault(e["logStreamName"],[]).append(e["message"])
+        ## order streams by their most recent event. 
+        last = {e["logStreamName"]:e["timestamp"] for e in events}
+        logstreams = sorted(streamdict.keys(),key = lambda s:last[s],reverse = True)
+        return [{s:" ".join(streamdict[s])} for s in logstreams]
 
     def get_logs(self,hours = 1):
         """Get the lambda logs indicating NeuroCAAS job processing for the last {hours} hours. 
         The result will be returned as a list of dictionaries, with the key indicating the request id, and the value the lines of text included. 
+        :param hours: the number of hours to start collecting logs in.  
+        :returns: a list of dictionaries, containing logs for requests in reverse chronological order. 
+        """
+        return self.parse_events(self.get_events(hours))
+
+    def load_cursor(self):
+        """Load the cursor used by follow from the cache directory. 
+
+        :returns: dictionary with the timestamp of the last event seen, and the ids of events seen at that timestamp, or None if there is no cursor. 
+        """
+        if self.cache_dir is None:
+            return None
+        try:
+            with open(os.path.join(self.cache_dir,"cursor.json"),"r") as f:
+                return json.load(f)
+        except (FileNotFoundError,ValueError):
+            return None
+
+    def save_cursor(self,cursor):
+        if self.cache_dir is None:
+            return
+        with open(os.path.join(self.cache_dir,"cursor.json"),"w") as f:
+            json.dump(cursor,f)
+
+    def follow(self,hours = 1,interval = 2,max_polls = None,callback = None):
+        """Live tail mode: repeatedly fetch log events newer than a cursor and pass them on as they arrive. The cursor (timestamp of the last event seen, and the ids of events at that timestamp) is persisted in the cache directory, so that following again later only fetches events that have not been seen yet.  
+
+        :param hours: if there is no saved cursor, start from this many hours ago. 
+        :param interval: number of seconds to wait between fetches. 
+        :param max_polls: (optional) stop after this many fetches. By default, follows until interrupted. 
+        :param callback: (optional) function called on each new event. By default, prints the logstream and message.
+        """
+        if callback is None:
+            callback = lambda e: print("[{}] {}".format(e["logStreamName"],e["message"].rstrip()))
+        cursor = self.load_cursor()
+        if cursor is None:
+            cursor = {"timestamp":int((datetime.today()-timedelta(hours = hours)).timestamp()*1000),"event_ids":[]}
+        polls = 0    
+        try:
+            while max_polls is None or polls < max_polls:
+                now = int(datetime.today().timestamp()*1000)
+                events = sorted(self.fetch_events(cursor["timestamp"],now),key = lambda e:e["timestamp"])
+                for e in events:
+                    if e["timestamp"] == cursor["timestamp"] and e["eventId"] in cursor["event_ids"]:
+                        continue
+                    callback(e)
+                    if e["timestamp"] > cursor["timestamp"]:
+                        cursor = {"timestamp":e["timestamp"],"event_ids":[]}
+                    cursor["event_ids"].append(e["eventId"])
+                self.save_cursor(cursor)
+                polls += 1
+                if max_polls is None or polls < max_polls:
+                    time.sleep(interval)
+        except KeyboardInterrupt:
+            self.save_cursor(cursor)
+
+    def get_logs_insights(self,hours = 1):
+        """Get the lambda logs for the last {hours} hours with a CloudWatch Insights query. Formatted as in get_logs.
         Code from :https://stackoverflow.com/questions/59240107/how-to-query-cloudwatch-logs-using-boto3-in-python
         :param hours: the number of hours to start collecting logs in.  
         :returns: a list of dictionaries, containing logs for requests in reverse chronological order. 
@@ -519,8 +1242,20 @@ class JobMonitor(LambdaMonitor):
         foldername = jobprefix.format(s=self.stackname,t=submitdict["timestamp"])
         fullpath = os.path.join("s3://",self.stackname,groupname,"results",foldername,"logs","certificate.txt")
         cert = NeuroCAASCertificate(fullpath,parse = False)
+        self.merge_certificate_shards(cert)
         return cert
 
+    def merge_certificate_shards(self,cert):
+        """Merge per-dataset certificate shards written by running instances into a certificate read from s3, so that it shows the latest status of each dataset.
+
+        :param cert: a NeuroCAASCertificate object. 
+        """
+        if cert.writeobj.init_dict["loc"] == "s3":
+            try:
+                cert.merge_shards()
+            except (AssertionError,ValueError,ClientError) as e:
+                print("Could not merge certificate shards: {}".format(e))
+
     def get_certificate_values(self,timestamp,groupname):
         """Get the certificate file given only the timestamp and groupname of a job (useful if running as dev). 
 
@@ -533,6 +1268,7 @@ class JobMonitor(LambdaMonitor):
         fullpath = os.path.join("s3://",self.stackname,groupname,"results",foldername,"logs","certificate.txt")
         print(fullpath)
         cert = NeuroCAASCertificate(fullpath,parse = False)
+        self.merge_certificate_shards(cert)
         return cert
         
     def get_datasets(self,submitfile):    
@@ -575,25 +1311,109 @@ class JobMonitor(LambdaMonitor):
         status = NeuroCAASDataStatusLegacy(fullpath)
         return status
 
-def get_logfiles(bucketname,pathprefix,outputpath):        
-    """Given a path to a directory, get the logfiles contained in "s3://bucketname/pathprefix/logs/{certificate.txt,DATASET_NAME:{}_STATUS.txt}", and write them to "outputpath/logs/{}". 
+    def get_job_events(self,groupname,timestamp,offsets = None):
+        """Get the events of a job (see log.EventStream) that are newer than the given offsets (see get_events). 
+
+        :param groupname: name of the group where we're going look for jobs. 
+        :param timestamp: timestamp field of a submit file. 
+        :param offsets: (optional) dictionary from event writers to the index of the next event to read. 
+        :return: tuple (list of new events, updated offsets).
+        """
+        foldername = jobprefix.format(s=self.stackname,t=timestamp)
+        return get_events(self.stackname,os.path.join(groupname,"results",foldername,"logs"),offsets)
+
+    def compact_events(self,groupname,timestamp,write = True):
+        """Rebuild the certificate and datastatus views of a job from its event stream. 
+
+        :param groupname: name of the group where we're going look for jobs. 
+        :param timestamp: timestamp field of a submit file. 
+        :param write: if true, write the rebuilt views back to s3. 
+        :return: tuple (NeuroCAASCertificate, dictionary from event writers to NeuroCAASDataStatusLegacy objects). 
+        """
+        events,offsets = self.get_job_events(groupname,timestamp)
+        states = apply_events(events)
+        cert = NeuroCAASCertificate(os.path.join("s3://",self.stackname,groupname,"results",jobprefix.format(s=self.stackname,t=timestamp),"logs","certificate.txt"))
+        render_certificate(states,cert)
+        statuses = {}
+        for writer,state in states.items():
+            ## writers are named by dataset key, but datastatus files by the basename of the dataset. 
+            dataset = os.path.basename(state["input"]) if "input" in state else writer
+            status = self.get_datastatus_values(groupname,timestamp,dataset)
+            render_datastatus(state,status)
+            statuses[writer] = status
+        if write:
+            cert.write()
+            for status in statuses.values():
+                status.write()
+        return cert,statuses
+
+def get_events(bucketname,logprefix,offsets = None):
+    """Read the events of a job (see log.EventStream) incrementally. Only event objects that contain events at or after the given offsets are downloaded. 
+
+    :param bucketname: name of the bucket where the job is. 
+    :param logprefix: prefix of the log directory of the job (i.e. group/results/job__stack_timestamp/logs). 
+    :param offsets: (optional) dictionary from event writers to the index of the next event to read. Defaults to reading all events. 
+    :return: tuple (list of new events ordered by time, updated offsets).
+    """
+    offsets = dict(offsets or {})
+    paginator = s3_client.get_paginator("list_objects_v2")
+    chunks = {}
+    for page in paginator.paginate(Bucket = bucketname,Prefix = os.path.join(logprefix,"events/")):
+        for obj in page.get("Contents",[]):
+            writer,first = EventStream.parse_chunkname(obj["Key"])
+            chunks.setdefault(writer,[]).append((first,obj["Key"]))
+    to_read = []
+    for writer,writer_chunks in chunks.items():
+        writer_chunks.sort()
+        start = offsets.get(writer,0)
+        for j,(first,key) in enumerate(writer_chunks):
+            ## events in this object end where the next object starts.
+            if j+1 < len(writer_chunks) and writer_chunks[j+1][0] <= start:
+                continue
+            to_read.append(key)
+    def read(key):
+        body = s3_client.get_object(Bucket = bucketname,Key = key)["Body"].read().decode("utf-8")
+        return [json.loads(line) for line in body.splitlines() if line]
+    events = []
+    with ThreadPoolExecutor(max_workers = max_workers) as executor:
+        for chunk_events in executor.map(read,to_read):
+            events.extend([e for e in chunk_events if e["i"] >= offsets.get(e["writer"],0)])
+    for event in events:
+        offsets[event["writer"]] = max(offsets.get(event["writer"],0),event["i"]+1)
+    events.sort(key = lambda e: (e["t"],e["writer"],e["i"]))
+    return events,offsets
+
+def get_logfiles(bucketname,pathprefix,outputpath,manifest = None):        
+    """Given a path to a directory, get the logfiles contained in "s3://bucketname/pathprefix/logs/{certificate.txt,DATASET_NAME:{}_STATUS.txt}", and write them to "outputpath/logs/{}". Subfolders of logs (event chunks, datastatus chunks and certificate shards) are not downloaded. If a manifest is given, only logs whose ETag has changed since the last call (or that are missing locally) are downloaded.  
 
     :param bucketname: name of the bucket to get logs from. 
     :param pathprefix: the path identifying job logs: exclude logs. 
     :param outputpath: the path to an existing directory on the local machine. Will create a logs subdirectory if does not exist, and write logs there. 
+    :param manifest: (optional) dictionary from log keys to the ETag of the version last downloaded. Updated in place. 
+    :return: the number of logs downloaded. 
     """
     if not os.path.exists(outputpath):
         print("Output path {} does not exist".format(outputpath))
-    filenames = ls_name(bucketname,os.path.join(pathprefix,"logs/"))
     local_logs = os.path.join(outputpath,"logs/")
     if not os.path.exists(local_logs):
         os.mkdir(local_logs)
-    for filepath in filenames:    
-        try:
+    count = 0    
+    paginator = s3_client.get_paginator("list_objects_v2")
+    ## list only the top level of logs/: files in subfolders share basenames, and would overwrite each other locally. 
+    for page in paginator.paginate(Bucket = bucketname,Prefix = os.path.join(pathprefix,"logs/"),Delimiter = "/"):
+        for obj in page.get("Contents",[]):
+            filepath = obj["Key"]
             filename = os.path.basename(filepath)
-            s3_client.download_file(bucketname,filepath,os.path.join(local_logs,filename))
-        except IsADirectoryError:    
-            pass
+            if filename == "":
+                continue
+            localfile = os.path.join(local_logs,filename)
+            if manifest is not None and manifest.get(filepath) == obj["ETag"] and os.path.exists(localfile):
+                continue
+            s3_client.download_file(bucketname,filepath,localfile)
+            count += 1
+            if manifest is not None:
+                manifest[filepath] = obj["ETag"]
+    return count        
 
 def get_end(bucketname,pathprefix):
     """Given a path to a directory, look for an "endfile" contained in "s3://bucketname/pathprefix/process_results/end.txt"
@@ -608,51 +1428,116 @@ def get_end(bucketname,pathprefix):
     else:
         return False
 
-def get_results(bucketname,pathprefix,outputpath):        
-    """Given a path to a directory, get the result files contained in "s3://bucketname/pathprefix/process_results/", and write them to "outputpath/process_results". 
+## Name of the manifest recording downloaded results, written into the local results directory. 
+results_manifest = ".results_manifest.json"
+
+def get_results(bucketname,pathprefix,outputpath,workers = 8,transfer_config = None):        
+    """Given a path to a directory, get the result files contained in "s3://bucketname/pathprefix/process_results/", and write them to "outputpath/process_results". Files are downloaded concurrently through one TransferManager over the shared s3 client, so that the number of requests in flight (across files and the parts of multipart downloads) is bounded by the concurrency of its config, and fits in the client's connection pool. A manifest of the size, ETag and local modification time of each downloaded file is kept in the results directory so that files that are already in sync are skipped on later calls. 
 
     :param bucketname: name of the bucket to get results from. 
     :param pathprefix: the path identifying job process_results: exclude process_results. 
     :param outputpath: the path to an existing directory on the local machine. Will create a process_results subdirectory if does not exist, and write results there. 
+    :param workers: the number of requests to run concurrently. Should be no more than max_workers, the size of the s3 client's connection pool. 
+    :param transfer_config: (optional) a boto3.s3.transfer.TransferConfig controlling multipart downloads of individual files (threshold, chunk size and concurrency). If given, its max_concurrency is used instead of workers. 
+    :return: the number of files downloaded (not counting files that were already in sync or could not be written). 
     """
-    filenames = ls_name(bucketname,os.path.join(pathprefix,"process_results/"))
     local_results = os.path.join(outputpath,"process_results/")
     if not os.path.exists(local_results):
         os.mkdir(local_results)
-    for filepath in filenames:    
-        try:
-            filename = os.path.basename(filepath)
-            s3_client.download_file(bucketname,filepath,os.path.join(local_results,filename))
-        except IsADirectoryError:    
-            pass
+    manifest_path = os.path.join(local_results,results_manifest)
+    try:
+        with open(manifest_path,"r") as f:
+            manifest = json.load(f)
+    except (FileNotFoundError,ValueError):
+        manifest = {}
+    if transfer_config is None:
+        transfer_config = TransferConfig(max_concurrency = min(workers,max_workers))
+
+    to_download = []
+    skipped = 0
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket = bucketname,Prefix = os.path.join(pathprefix,"process_results/")):
+        for obj in page.get("Contents",[]):
+            filename = os.path.basename(obj["Key"])
+            if filename == "":
+                continue
+            localfile = os.path.join(local_results,filename)
+            entry = manifest.get(obj["Key"])
+            if entry is not None and entry["etag"] == obj["ETag"] and entry["size"] == obj["Size"] and os.path.exists(localfile):
+                if os.path.getmtime(localfile) == entry["mtime"] and os.path.getsize(localfile) == obj["Size"]:
+                    skipped += 1
+                    continue
+            to_download.append((obj,localfile))
+
+    start = time.time()
+    nbytes = 0
+    downloaded = 0
+    errors = []
+    with TransferManager(s3_client,transfer_config) as manager:
+        futures = [(manager.download(bucketname,obj["Key"],localfile),obj,localfile) for obj,localfile in to_download]
+        for future,obj,localfile in futures:
+            try:
+                future.result()
+                manifest[obj["Key"]] = {"size":obj["Size"],"etag":obj["ETag"],"mtime":os.path.getmtime(localfile)}
+                nbytes += obj["Size"]
+                downloaded += 1
+            except IsADirectoryError:
+                pass
+            except Exception as e:
+                errors.append(e)
+    with open(manifest_path,"w") as f:
+        json.dump(manifest,f,indent = 4)
+    elapsed = time.time()-start
+    print("Downloaded {} results ({:.2f} MB) in {:.2f}s ({:.2f} MB/s), {} already in sync".format(downloaded,nbytes/1e6,elapsed,nbytes/1e6/max(elapsed,1e-9),skipped),file = sys.stderr)
+    if len(errors) > 0:
+        raise errors[0]
+    return downloaded
 
     
-def poll(bucketname,pathprefix,output):
+def poll(bucketname,pathprefix,output,manifest = None):
     """One round of polling a job for logging output. Returns true or false based on the output of get_end.  
     :param bucketname: name of the bucket to get logs from. 
     :param pathprefix: the path identifying job logs: exclude logs. 
     :param outputpath: the path to an existing directory on the local machine. Will create a logs subdirectory if does not exist, and write logs there. 
+    :param manifest: (optional) manifest of downloaded logs, passed to get_logfiles so that only changed logs are downloaded. 
     """
-    get_logfiles(bucketname,pathprefix,output)
+    get_logfiles(bucketname,pathprefix,output,manifest)
     return get_end(bucketname,pathprefix)
 
-def setup_polling(bucketname,pathprefix,output,step = 60,timeout = 60*15):
-    """Set up polling function 
+def setup_polling(bucketname,pathprefix,output,step = 60,timeout = 60*15,max_step = None,backoff = 2):
+    """Set up polling function. Only logs that have changed since the last round are downloaded. While logs are not changing, the interval between rounds grows by a factor of backoff (up to max_step), and it is reset to step as soon as a change is seen. 
 
     :param bucketname: name of the bucket to get logs from. 
     :param pathprefix: the path identifying job logs: exclude logs. 
     :param outputpath: the path to an existing directory on the local machine. Will create a logs subdirectory if does not exist, and write logs there. 
     :param step: number of seconds to wait before querying again. Default 60
     :param timeout: timeout for the poll in seconds. Default 15 mins
+    :param max_step: maximum number of seconds to wait between queries while the job is quiet. Default 4*step.
+    :param backoff: factor by which to increase the wait between queries while the job is quiet. Default 2. Waits are cut short so that polling does not run past the timeout. 
     :returns: returns an exit code: 0: success, 1: timeout, 2: uncaught exception. 
     """
+    if max_step is None:
+        max_step = 4*step
+    manifest = {}
+    state = {"delay":None}
+    deadline = time.time()+timeout
     def ended(response):
         return response == True
+    def adaptive_poll():
+        ## polling2 sleeps before calling the step function, so the adaptive wait is taken here instead, where it can depend on the latest round.
+        if state["delay"] is not None:
+            time.sleep(max(min(state["delay"],deadline-time.time()),0))
+        changed = get_logfiles(bucketname,pathprefix,output,manifest)
+        if changed > 0 or state["delay"] is None:
+            state["delay"] = step
+        else:    
+            state["delay"] = min(state["delay"]*backoff,max_step)
+        return get_end(bucketname,pathprefix)
     try:
         polling2.poll(
-            lambda : poll(bucketname,pathprefix,output),
+            adaptive_poll,
             check_success = ended,
-            step = step,
+            step = 0,
             timeout = timeout,
             log = logging.INFO)
         get_results(bucketname,pathprefix,output)
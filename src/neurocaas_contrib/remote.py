@@ -9,18 +9,14 @@ import datetime
 import subprocess
 import json
 import pathlib
+from . import clients
 
-try:
-    ec2_resource = boto3.resource('ec2')
-    ec2_client = boto3.client("ec2")
-    ssm_client = boto3.client('ssm')
-except NoRegionError: ## if building on readthedocs, read the region in from environment variables:    
-    ec2_resource = boto3.resource('ec2',region_name = os.environ["REGION"])
-    ec2_client = boto3.client("ec2",region_name = os.environ["REGION"])
-    ssm_client = boto3.client('ssm',region_name = os.environ["REGION"])
-s3 = boto3.resource("s3")
+ec2_resource = clients.lazy_resource("ec2")
+ec2_client = clients.lazy_client("ec2")
+ssm_client = clients.lazy_client("ssm")
+s3 = clients.lazy_resource("s3")
 #ssm_client = boto3.client('ssm',region_name = self.config['Lambda']['LambdaConfig']['REGION'])
-sts = boto3.client("sts")        
+sts = clients.lazy_client("sts")        
 
 home_repo = "neurocaas"
 
@@ -9,8 +9,14 @@ import sys
 import yaml
 import json
 import zipfile
-from .log import NeuroCAASCertificate,NeuroCAASDataStatus,NeuroCAASDataStatusLegacy
-from .Interface_S3 import download,upload
+import threading
+import codecs
+import selectors
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from .log import NeuroCAASCertificate,NeuroCAASDataStatus,NeuroCAASDataStatusLegacy,CoalescingWriter,CertificateWriter,PsutilSource,upload_queue
+from .Interface_S3 import download,upload,download_many,upload_many,get_etag,S3ObjectReader
+from .cache import InputCache
 
 dir_loc = os.path.abspath(os.path.dirname(__file__))
 
@@ -54,112 +60,365 @@ def get_yaml_field(yamlfile,fieldname):
     else:
         return str(output)
 
-def parse_zipfile(zipname,path = None): 
+def parse_zipfile(zipname,path = None,workers = 1): 
     """Given a zipfile, confirms that it is a zipfile, and that it contains one top level directory. Unzips the zip file, and returns the name of the top level directory. Will throw an error if 1) the file path is not a zip file, or 2) if it contains more than one top level directory. 
+    :param zipname: path to the zip file. Can also be an s3 path (s3://bucketname/key), in which case members are read from s3 with ranged requests and written straight to disk, without first downloading the archive. 
+    :param path: (optional) directory to extract into. Defaults to the directory of the zip file, or the current directory if the zip file is in s3. 
+    :param workers: (optional) number of threads to extract members with. Decompression releases the GIL, so members are extracted in parallel. 
 
     """
-    assert zipfile.is_zipfile(zipname), "File is not a recognized zip archive"
-    archive = zipfile.ZipFile(zipname)
-    full_namelist = archive.namelist()
-    folder = {item.split("/")[0] for item in full_namelist}.difference({'__MACOSX'})
-    filtered_namelist = [fn for fn in full_namelist if not fn.startswith('__MACOSX')]
-    assert len(folder) == 1; "Folder must contain only one top level directory." 
-    if path is None:
-        path = os.path.dirname(zipname)
-    archive.extractall(path = path,members = filtered_namelist) ## This should extract and replace. Maybe it does so at the file level
+    if zipname.startswith("s3://"):
+        opener = lambda: S3ObjectReader(zipname)
+        if path is None:
+            path = os.getcwd()
+    else:    
+        opener = lambda: open(zipname,"rb")
+        if path is None:
+            path = os.path.dirname(zipname)
+    with opener() as fileobj:
+        assert zipfile.is_zipfile(fileobj), "File is not a recognized zip archive"
+        with zipfile.ZipFile(fileobj) as archive:
+            full_namelist = archive.namelist()
+            folder = {item.split("/")[0] for item in full_namelist}.difference({'__MACOSX'})
+            filtered_namelist = [fn for fn in full_namelist if not fn.startswith('__MACOSX')]
+            assert len(folder) == 1; "Folder must contain only one top level directory." 
+            if workers > 1:
+                extract_parallel(opener,[archive.getinfo(fn) for fn in filtered_namelist],path,workers)
+            else:    
+                archive.extractall(path = path,members = filtered_namelist) ## This should extract and replace. Maybe it does so at the file level
     return folder.pop()
 
+def extract_parallel(opener,members,path,workers):
+    """Extract members of a zip archive with a pool of threads. Each thread opens its own handle on the archive, so that reads from different members do not wait on each other. 
+    :param opener: function with no arguments that opens a new file object for the archive. 
+    :param members: list of ZipInfo objects to extract. 
+    :param path: directory to extract into. 
+    :param workers: number of threads. 
+
+    """
+    local = threading.local()
+    handles = []
+    lock = threading.Lock()
+
+    def extract(member):
+        if not hasattr(local,"archive"):
+            fileobj = opener()
+            with lock:
+                handles.append(fileobj)
+            local.archive = zipfile.ZipFile(fileobj)
+        try:
+            local.archive.extract(member,path)
+        except FileExistsError: ## another thread created the same parent directory. 
+            local.archive.extract(member,path)
+
+    ## start with the largest members, so that the pool finishes together. 
+    members = sorted(members,key = lambda m: m.file_size,reverse = True)
+    try:
+        with ThreadPoolExecutor(max_workers = workers) as pool:
+            list(pool.map(extract,members))
+    finally:        
+        for fileobj in handles:
+            fileobj.close()
+
+class LoggedProcess(object):
+    """A single analysis subprocess supervised by a JobLogger, along with its datastatus object. 
+
+    """
+    def __init__(self,command,logpath,s3status,localstatus = None,min_interval = 60,tail_lines = 100):
+        """
+        :param command: command you want to run. 
+        :param logpath: path where you will log the stdout/err outputs locally. 
+        :param s3status: s3 path of the datastatus object for this dataset. 
+        :param localstatus: (optional) local path to write the datastatus object to if s3 is not available. Defaults to DATASTATUS.json, next to the log. 
+        :param min_interval: minimum number of seconds between writes of the datastatus object. 
+        :param tail_lines: the number of recent lines of output to keep in memory and in the datastatus object. 
+        """
+        self.command = command
+        self.logpath = logpath
+        ## recent complete lines of output, and the total number of complete lines. 
+        self.tail = deque(maxlen = tail_lines)
+        self.lines = 0
+        ## output that does not end in a newline yet. 
+        self.tail_partial = ""
+        ## bytes of output since the status was last published. 
+        self.unpublished = 0
+        self.last_publish = time.time()
+        if localstatus is None:
+            localstatus = os.path.join(os.path.dirname(logpath),"DATASTATUS.json")
+        ## Initialize datastatus object. 
+        self.ncds = NeuroCAASDataStatusLegacy(s3status,localstatus)
+        ## pick up statistics of results uploaded while the process runs (see NeuroCAASScriptManager.put_results_dir). 
+        self.ncds.uploads_path = os.path.join(os.path.dirname(localstatus),"result_uploads.json")
+        ## upload output as compressed chunks, keeping only recent lines in the status file. 
+        self.ncds.enable_chunking(logpath,tail_lines)
+        self.ncds.enable_async()
+        ## also record status, usage and output offsets as an append-only event stream. 
+        self.ncds.enable_events()
+        self.ncds_writer = CoalescingWriter(self.ncds,min_interval)
+        self.dataname = self.ncds.rawfile["input"]
+        self.updatedict = {
+            "t" : datetime.datetime.now().strftime("%Y_%m_%d_%H_%M_%S"),
+            "n" : self.dataname,
+            "s" : self.ncds.rawfile["status"],
+            "r" : "N/A",
+            "u" : "N/A",
+        }
+        self.process = None
+        ## output not yet echoed because it does not end in a newline. 
+        self.partial = ""
+
+    def start(self):
+        """Start the process, with stdout and stderr going to a pipe that is read by the JobLogger. 
+
+        """
+        self.writer = io.open(self.logpath,"wb")
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors = "replace")
+        self.starttime = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ")
+        self.process = subprocess.Popen(self.command,stdout = subprocess.PIPE,stderr = subprocess.STDOUT)
+        ## sample the resource usage of the job in the background. 
+        self.ncds.start_sampler(PsutilSource(self.process.pid))
+        self.stdstub = "initializing..."
+
+    def feed(self,data):
+        """Handle output read from the pipe: write it to the logfile, and add it to the in-memory tail. Keeps track of the last meaningful line. Only looks at the new output, so the cost does not depend on the size of the log. 
+
+        :param data: bytes of output. 
+        :return: the output, decoded. 
+        """
+        self.writer.write(data)
+        self.writer.flush()
+        self.unpublished += len(data)
+        return self.add_text(self.decoder.decode(data))
+
+    def add_text(self,text):
+        """Add decoded output to the in-memory tail. 
+
+        :param text: decoded output. 
+        :return: the output. 
+        """
+        lines = (self.tail_partial+text).split("\n")
+        self.tail_partial = lines.pop()
+        self.tail.extend([line+"\n" for line in lines])
+        self.lines += len(lines)
+        stdmeaning = [s for s in lines+[self.tail_partial] if s and not s.isspace()]
+        if len(stdmeaning) > 0:
+            self.stdstub = stdmeaning[-1]
+        return text
+
+    def get_tail(self):
+        """
+        :return: tuple (index of the first line returned, list of recent lines of output, including any incomplete last line). 
+        """
+        lines = list(self.tail)+([self.tail_partial] if self.tail_partial else [])
+        return self.lines-len(self.tail),lines
+
+    def due(self,publish_interval,publish_bytes):
+        """Check if the status should be published: after publish_interval seconds, or publish_bytes bytes of new output. 
+
+        """
+        return self.unpublished >= publish_bytes or time.time()-self.last_publish >= publish_interval
+
+    def update(self):
+        """Update the datastatus object. 
+
+        """
+        self.unpublished = 0
+        self.last_publish = time.time()
+        self.ncds.update_file(self.logpath,self.starttime,tail = self.get_tail())
+        self.ncds_writer.touch(self.ncds.rawfile["status"])
+        self.updatedict["t"] = datetime.datetime.now().strftime("%Y_%m_%d_%H_%M_%S")
+        self.updatedict["s"] = self.ncds.rawfile["status"]
+        self.updatedict["r"] = self.stdstub
+        self.updatedict["u"] = self.ncds.rawfile["cpu_usage"]
+
+    def logfail(self):
+        self.updatedict["t"] = datetime.datetime.now().strftime("%Y_%m_%d_%H_%M_%S")
+        self.updatedict["s"] = "LOGFAIL"
+        self.updatedict["r"] = "Logging failed. Job will continue, but something went wrong while writing logs."
+        self.updatedict["u"] = "LOGFAIL" 
+
+    def finish(self):
+        """Record the final state of the datastatus object, after the process has finished.
+
+        :return: any output that was held back by the decoder (i.e. an incomplete utf-8 sequence at the end of the output). 
+        """
+        self.writer.close()
+        text = self.add_text(self.decoder.decode(b"",final = True))
+        finishtime = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ")
+        self.ncds.update_file(self.logpath,self.starttime,finishtime,self.process.returncode,tail = self.get_tail())
+        self.ncds.close_chunks()
+        self.ncds.finish_usage()
+        self.ncds_writer.touch(self.ncds.rawfile["status"])
+        self.ncds_writer.flush()
+        self.updatedict["t"] = datetime.datetime.now().strftime("%Y_%m_%d_%H_%M_%S") + " (finished)"
+        self.updatedict["s"] = self.ncds.rawfile["status"]
+        self.updatedict["r"] = self.stdstub
+        self.updatedict["u"] = self.ncds.rawfile["cpu_usage"]
+        return text
+
+class JobLogger(object):
+    """Runs several analysis subprocesses concurrently on one instance, and logs them from a single loop. The output of each process is read from a pipe as soon as it is available (using selectors), and tee'd to its logfile, an in-memory tail, and stdout (prefixed with the dataset name if there is more than one process). Status is published separately, whenever a process has produced publish_bytes of new output or publish_interval seconds have passed, so the work per update does not grow with the size of the log. Each process has its own datastatus object, while certificate updates for all of them go through one shared CertificateWriter. All status and certificate writes are made through the same background upload queue (see log.UploadQueue), so the loop never waits on the network, and repeated writes of the same object are coalesced. 
+
+    """
+    def __init__(self,s3certificate,localdir,min_interval = 60,certificate_mode = "shared",publish_interval = 5,publish_bytes = 65536,exit_interval = 1):
+        """
+        :param s3certificate: s3 path of the certificate for this job. 
+        :param localdir: local directory to write the certificate to if s3 is not available. 
+        :param min_interval: minimum number of seconds between writes of the status and certificate files.
+        :param certificate_mode: how to write certificate updates: "shared" (default), "conditional" or "sharded" (see log.CertificateWriter). The last two rely on conditional writes to s3.
+        :param publish_interval: maximum number of seconds between status updates. 
+        :param publish_bytes: number of bytes of new output that triggers a status update. 
+        :param exit_interval: maximum number of seconds between checks for processes that have exited. Processes can exit before their output ends, if they leave background processes that hold on to it. 
+        """
+        self.exit_interval = exit_interval
+        self.min_interval = min_interval
+        self.publish_interval = publish_interval
+        self.publish_bytes = publish_bytes
+        ## Initialize certificate object. 
+        self.localcertificate = os.path.join(localdir,"certificate.txt")
+        self.ncc = NeuroCAASCertificate(s3certificate,self.localcertificate)
+        self.ncc.enable_async()
+        self.ncc_writer = CertificateWriter(self.ncc,min_interval,mode = certificate_mode)
+        self.jobs = []
+
+    def add(self,command,logpath,s3status,localstatus = None):
+        """Add a process to run. See LoggedProcess for parameters. 
+
+        :return: the LoggedProcess. 
+        """
+        job = LoggedProcess(command,logpath,s3status,localstatus,self.min_interval)
+        self.ncc_writer.update_instance_info(job.updatedict)
+        self.jobs.append(job)
+        return job
+
+    def echo(self,job,text,final = False):
+        """Write output of a process to stdout. With more than one process, only complete lines are written, prefixed with the dataset name. 
+
+        :param job: the LoggedProcess the output comes from. 
+        :param text: new output. 
+        :param final: if true, also write any incomplete last line. 
+        """
+        if len(self.jobs) == 1:
+            sys.stdout.write(text)
+            return
+        lines = (job.partial+text).split("\n")
+        job.partial = lines.pop()
+        if final and job.partial:
+            lines.append(job.partial)
+            job.partial = ""
+        sys.stdout.write("".join(["[{}] {}\n".format(os.path.basename(job.dataname),line) for line in lines]))
+
+    def publish(self,job):
+        """Publish the status of a running process. 
+
+        """
+        try:
+            job.update()
+        except: ## if logging fails midway through, we don't want to cancel the job.    
+            job.logfail()
+        self.ncc_writer.update_instance_info(job.updatedict)
+
+    def pump(self,selector,timeout):
+        """Wait for output from any process (up to timeout seconds), and handle it. 
+
+        :param selector: selector with the stdout pipes of running processes registered. 
+        :param timeout: maximum number of seconds to wait. 
+        :return: list of processes whose output has ended. 
+        """
+        ended = []
+        for key,mask in selector.select(timeout):
+            job = key.data
+            data = os.read(key.fd,65536)
+            if data:
+                self.echo(job,job.feed(data))
+            else:    
+                selector.unregister(key.fileobj)
+                ended.append(job)
+        return ended
+
+    def drain(self,selector,job):
+        """Read the output that is available from a process that has exited, without waiting for the end of the output. 
+
+        :param selector: selector with the stdout pipe of the process registered. 
+        :param job: the LoggedProcess. 
+        """
+        fd = job.process.stdout.fileno()
+        os.set_blocking(fd,False)
+        try:
+            data = os.read(fd,65536)
+            while data:
+                self.echo(job,job.feed(data))
+                data = os.read(fd,65536)
+        except BlockingIOError: ## output is still open, but there is nothing more to read. 
+            pass
+        selector.unregister(job.process.stdout)
+
+    def run(self):
+        """Start all processes, and log them until they have all finished. 
+
+        :return: list of return codes, in the order the processes were added. 
+        """
+        selector = selectors.DefaultSelector()
+        for job in self.jobs:
+            job.start()
+            selector.register(job.process.stdout,selectors.EVENT_READ,job)
+        sys.stdout.write("\n\n-------Start Process Log-------\n\n")
+        running = list(self.jobs)
+        while len(running) > 0:
+            next_publish = min([job.last_publish for job in running])+self.publish_interval
+            ended = self.pump(selector,min(max(next_publish-time.time(),0),self.exit_interval))
+            for job in running:
+                if job not in ended and job.process.poll() is not None:
+                    self.drain(selector,job)
+                    ended.append(job)
+            for job in running:
+                if job in ended:
+                    job.process.stdout.close()
+                    job.process.wait()
+                    self.echo(job,job.finish(),final = True)
+                    self.ncc_writer.update_instance_info(job.updatedict)
+                elif job.due(self.publish_interval,self.publish_bytes):
+                    self.publish(job)
+            running = [job for job in running if job not in ended]
+        selector.close()
+        sys.stdout.write("\n--------End Process Log--------\n\n")
+        self.ncc_writer.flush(finish = True)
+        if not upload_queue.flush():
+            ## the final status of the jobs may not have reached s3: record that logging failed, locally. 
+            sys.stderr.write("Uploading the final status of this job failed. Recording LOGFAIL in {}\n".format(self.localcertificate))
+            for job in self.jobs:
+                job.logfail()
+                self.ncc.update_instance_info(job.updatedict,reload = False)
+            self.ncc.write_local(self.localcertificate)
+        return [job.process.returncode for job in self.jobs]
+
 ## from https://stackoverflow.com/questions/18421757/live-output-from-subprocess-command
-def log_process(command,logpath,s3status):
-    """Given a path to an executable, runs it, logs output and prints to stdout. 
+def log_process(command,logpath,s3status,min_interval = 60,certificate_mode = "shared"):
+    """Given a path to an executable, runs it, logs output and prints to stdout. Status and certificate files are written behind: at most once every min_interval seconds, immediately when the job status changes, and when the process finishes, and are uploaded from a background thread. By default, the certificate is reloaded before each write and updated in place. Set certificate_mode to "sharded" to write updates to a per-dataset shard while the process runs and merge them into the certificate when it finishes, so that many instances running in parallel do not overwrite each other's lines. To run several processes at once, use JobLogger directly. 
 
     :param processpath: command you want to run. 
     :param logpath: path where you will log the stdout/err outputs locally. 
     :param s3status: s3 path where the dataset is stored  
+    :param min_interval: minimum number of seconds between writes of the status and certificate files.
+    :param certificate_mode: how to write certificate updates: "shared" (default), "conditional" or "sharded" (see log.CertificateWriter). The last two rely on conditional writes to s3.
     :return: return code of the command. 
     """
-    ## Initialize datastatus object. 
-    localstatus = os.path.join(os.path.dirname(logpath),"DATASTATUS.json")
-    ncds = NeuroCAASDataStatusLegacy(s3status,localstatus)
-    ## Initialize certificate object. 
     s3certificate = os.path.join(os.path.dirname(s3status),"certificate.txt")
-    localcertificate = os.path.join(os.path.dirname(logpath),"certificate.txt")
-    ncc = NeuroCAASCertificate(s3certificate,localcertificate)
-    dataname = ncds.rawfile["input"]
-    updatedict = {
-        "t" : datetime.datetime.now().strftime("%Y_%m_%d_%H_%M_%S"),
-        "n" : dataname,
-        "s" : ncds.rawfile["status"],
-        "r" : "N/A",
-        "u" : "N/A",
-    }
-    ncc.update_instance_info(updatedict)
-    with io.open(logpath,"wb") as writer, io.open(logpath,"rb",1) as reader:
-        starttime = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ")
-        process = subprocess.Popen(command,stdout = writer,stderr = writer)
-        ## initialize a legacy logging object. starttime
-        sys.stdout.write("\n\n-------Start Process Log-------\n\n")
-        stdlatest = "initializing...\n"
-        while process.poll() is None:
-            try:
-                stdtemp = reader.read().decode("utf-8")
-                if stdtemp and not stdtemp.isspace(): ## do not write if it's just nothing. 
-                    stdlatest = stdtemp
-                    try:
-                        ## Try to get the last log that has meaning. 
-                        stdlatest_split = stdlatest.split("\n")
-                        stdmeaning = [s for s in stdlatest_split if s and not s.isspace()]
-                        stdstub = stdmeaning[-1]#stdlatest.replace("\n"," ")
-                    except IndexError:    
-                        stdstub = stdlatest.replace("\n"," ")
-
-
-                sys.stdout.write(stdlatest)
-                ncds.update_file(logpath,starttime)
-                ncds.write()
-                updatedict["t"] = datetime.datetime.now().strftime("%Y_%m_%d_%H_%M_%S")
-                updatedict["s"] = ncds.rawfile["status"]
-                updatedict["r"] = stdstub
-                updatedict["u"] = ncds.rawfile["cpu_usage"]
-                ncc.update_instance_info(updatedict)
-                ncc.write()
-                time.sleep(0.5)
-                ## update logging. 
-            except: ## if logging fails midway through, we don't want to cancel the job.    
-                updatedict["t"] = datetime.datetime.now().strftime("%Y_%m_%d_%H_%M_%S")
-                updatedict["s"] = "LOGFAIL"
-                updatedict["r"] = "Logging failed. Job will continue, but something went wrong while writing logs."
-                updatedict["u"] = "LOGFAIL" 
-                ncc.update_instance_info(updatedict)
-                ncc.write()
-                time.sleep(0.5)
-            
-        stdlast = reader.read().decode("utf-8")
-        sys.stdout.write(stdlast)
-        sys.stdout.write("\n--------End Process Log--------\n\n")
-        finishtime = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%SZ")
-        ncds.update_file(logpath,starttime,finishtime,process.returncode)
-        ncds.write()
-        updatedict["t"] = datetime.datetime.now().strftime("%Y_%m_%d_%H_%M_%S") + " (finished)"
-        updatedict["s"] = ncds.rawfile["status"]
-        updatedict["r"] = stdlast.replace("\n"," ")
-        updatedict["u"] = ncds.rawfile["cpu_usage"]
-        ncc.update_instance_info(updatedict)
-        ncc.write()
-        ## finish logging, get end log time + exit code. 
-
-    return process.returncode    
+    joblogger = JobLogger(s3certificate,os.path.dirname(logpath),min_interval,certificate_mode)
+    joblogger.add(command,logpath,s3status)
+    return joblogger.run()[0]
 
 class NeuroCAASScriptManager(object):
     """An object to take care of the management logic of handling input/output and logging on a NeuroCAAS job. Has all of its state stored in a json file called "registration.json" in the io-dir folder where job inputs and outputs are kept. 
 
     """
-    def __init__(self,path,write = True):
+    def __init__(self,path,write = True,cachedir = None):
         """Initialize the script manager with a location where we will keep all of its data.
         Creates a file "registration.json" at that location. 
         This file contains a field to register 
         :param path: path to the directory where we will write the file registration.json
         :param write: boolean, if we should write the file or not. Useful if initializing from existing class. 
+        :param cachedir: (optional) directory to cache inputs downloaded from s3 in, so they can be reused by later jobs (see cache.InputCache). Defaults to the environment variable NEUROCAAS_CACHE_DIR. If neither is given, inputs are not cached. 
 
         """
         assert os.path.isdir(path); "Must give path to existing input/output directory"
@@ -173,6 +432,11 @@ class NeuroCAASScriptManager(object):
                 "additional_files":{},
                 "resultpath":{}
                 }
+        self.cache = None
+        if cachedir is not None:
+            self.enable_cache(cachedir)
+        else:    
+            self.cache = InputCache.from_env()
 
         if write is True:
             self.write()
@@ -195,8 +459,34 @@ class NeuroCAASScriptManager(object):
 
         inst = cls(path,write = False)
         inst.registration = registration
+        if "cachedir" in registration.get("cache",{}):
+            inst.cache = InputCache(registration["cache"]["cachedir"])
         return inst
 
+    def enable_cache(self,cachedir,maxsize = None):
+        """Cache inputs downloaded from s3, so that they can be reused by later jobs. The cache location is saved in the registration, so that it is used whenever this registration is loaded. 
+        :param cachedir: directory to keep cached inputs in. 
+        :param maxsize: (optional) maximum size of the cache in bytes. See cache.InputCache. 
+
+        """
+        self.cache = InputCache(cachedir,maxsize)
+        self.registration.setdefault("cache",{"hits":0,"misses":0,"bytes_saved":0})
+        self.registration["cache"]["cachedir"] = self.cache.cachedir
+
+    def record_cache(self):
+        """Add the cache hits, misses and bytes saved since the last call to the totals in the registration, and print them to the job log. 
+
+        """
+        if self.cache is None:
+            return
+        stats = self.cache.collect()
+        totals = self.registration.setdefault("cache",{"hits":0,"misses":0,"bytes_saved":0})
+        for key,value in stats.items():
+            totals[key] = totals.get(key,0)+value
+        if stats["hits"]+stats["misses"] == 0:
+            return
+        print("Input cache: {} hits, {} misses, {} bytes saved ({} hits, {} misses, {} bytes saved in total for this job)".format(stats["hits"],stats["misses"],stats["bytes_saved"],totals["hits"],totals["misses"],totals["bytes_saved"]))
+
     def register_data(self,s3path):
         """Given an s3 path, registers that as the location of the data we care about. 
         :param s3path: path to a file in aws s3, given in "s3://bucket/path" format
@@ -283,6 +573,15 @@ class NeuroCAASScriptManager(object):
         self.registration["resultpath"].pop("localsource","False")
         self.write()
 
+    def register_datastatus(self,s3path,localpath):    
+        """Registers the location of the datastatus object that a logged command writes to, so that other steps of the workflow can add to it. Called by log_command.  
+        :param s3path: path to the datastatus object in aws s3, given in "s3://bucket/path" format
+        :param localpath: local path the datastatus object is written to if s3 is not available. 
+
+        """
+        self.registration["datastatus"] = {"s3":str(s3path),"local":str(localpath)}
+        self.write()
+
     def register_resultpath_local(self,localpath):    
         """Given an local path, registers that as the location where we will upload job data. Give a folder, where you want to generate two subdirectories, "logs", and "process_results". Logs and analysis results will be sent to these respective locations.  
 
@@ -291,45 +590,68 @@ class NeuroCAASScriptManager(object):
         self.registration["resultpath"].pop("s3","False")
         self.write()
 
-    def get_data(self,path = None,force = False,display = False):    
-        """Get currently registered data. If desired, you can pass a path where you would like data to be moved. Otherwise, it will be moved to self.path/self.subdirs[data]
-        :param path: (optional) the location you want to write data to. 
-        :param force: (optional) by default, will not redownload if data of the same name already lives here. Can override with force = True
-        :param display: (optional) by default, will not display downlaod progress. 
-        :return: bool (True if downloaded, False if not)
+    def locate_input(self,entry,subdir,path = None):
+        """Find where a registered input comes from, and where it should be written to. 
+        :param entry: the registration entry of the input (e.g. self.registration["data"]). 
+        :param subdir: the key in self.subdirs of the directory to write to by default. 
+        :param path: (optional) the location you want to write the input to instead. 
+        :return: tuple (source, sourcepath, localpath), where source is "s3" or "local", or None if the input is not registered. 
 
         """
-        try:
-            data_s3path = self.registration["data"]["s3"]
-            data_name = os.path.basename(data_s3path)
-            source = "s3"
-        except KeyError:     
-            try:
-                data_localsource = self.registration["data"]["localsource"]
-                data_name = os.path.basename(data_localsource)
-                source = "local"
-            except:    
-                raise AssertionError("Data not registered. Run register_data first.") 
-
+        if "s3" in entry:
+            source,sourcepath = "s3",entry["s3"]
+        elif "localsource" in entry:    
+            source,sourcepath = "local",entry["localsource"]
+        else:    
+            return None
         if path is None: 
-            path = os.path.join(self.path,self.subdirs["data"])
+            path = os.path.join(self.path,self.subdirs[subdir])
             mkdir_notexists(path)
-        data_localpath = os.path.join(path,data_name)
+        localpath = os.path.join(path,os.path.basename(sourcepath))
+        return source,sourcepath,localpath
+
+    def fetch_input(self,entry,subdir,label,path = None,force = False,display = False):
+        """Get a registered input. Shared logic of get_data, get_config and get_file. 
+        :param entry: the registration entry of the input (e.g. self.registration["data"]). 
+        :param subdir: the key in self.subdirs of the directory to write to by default. 
+        :param label: name of the kind of input, for messages. 
+        :param path: (optional) the location you want to write the input to. 
+        :param force: (optional) by default, will not redownload if an input of the same name already lives here. Can override with force = True
+        :param display: (optional) by default, will not display download progress. 
+        :return: bool (True if downloaded, False if not)
+
+        """
+        located = self.locate_input(entry,subdir,path)
+        if located is None:
+            raise AssertionError("{} not registered. Run register_{} first.".format(label,label.lower())) 
+        source,sourcepath,localpath = located
 
         if not force: 
-            if os.path.exists(data_localpath):
-                print("Data already exists at this location. Set force = true to overwrite")
+            if os.path.exists(localpath):
+                print("{} already exists at this location. Set force = true to overwrite".format(label))
                 return 0
-            else:   
-                pass
-        if source == "s3":   
-            download(data_s3path,data_localpath,display)    
+        if source == "s3" and self.cache is not None:
+            ## not verified, as with uncached downloads. 
+            download_many([(sourcepath,localpath)],display,verify = False,cache = self.cache)
+            self.record_cache()
+        elif source == "s3":   
+            download(sourcepath,localpath,display)    
         elif source == "local":   
-            shutil.copy(data_localsource,data_localpath)
-        self.registration["data"]["local"] = data_localpath
+            shutil.copy(sourcepath,localpath)
+        entry["local"] = localpath
         self.write()
         return 1
 
+    def get_data(self,path = None,force = False,display = False):    
+        """Get currently registered data. If desired, you can pass a path where you would like data to be moved. Otherwise, it will be moved to self.path/self.subdirs[data]
+        :param path: (optional) the location you want to write data to. 
+        :param force: (optional) by default, will not redownload if data of the same name already lives here. Can override with force = True
+        :param display: (optional) by default, will not display downlaod progress. 
+        :return: bool (True if downloaded, False if not)
+
+        """
+        return self.fetch_input(self.registration["data"],"data","Data",path,force,display)
+
     def get_config(self,path = None,force = False,display = False):    
         """Get currently registered config. If desired, you can pass a path where you would like config to be moved. Otherwise, it will be moved to self.path/self.subdirs[config]
         :param path: (optional) the location you want to write data to. 
@@ -338,37 +660,7 @@ class NeuroCAASScriptManager(object):
         :return: bool (True if downloaded, False if not)
 
         """
-        try:
-            config_s3path = self.registration["config"]["s3"]
-            config_name = os.path.basename(config_s3path)
-            source = "s3"
-        except KeyError:     
-            try:
-                config_localsource = self.registration["config"]["localsource"]
-                config_name = os.path.basename(config_localsource)
-                source = "local"
-            except:    
-                raise AssertionError("Config not registered. Run register_config first.") 
-
-        if path is None: 
-            path = os.path.join(self.path,self.subdirs["config"])
-            mkdir_notexists(path)
-        config_localpath = os.path.join(path,config_name)
-
-        if not force: 
-            if os.path.exists(config_localpath):
-                print("Config already exists at this location. Set force = true to overwrite")
-                return 0 
-            else:   
-                pass
-        if source == "s3":    
-            download(config_s3path,config_localpath,display)    
-        elif source == "local":    
-            shutil.copy(config_localsource,config_localpath)
-        self.registration["config"]["local"] = config_localpath
-        self.write()
-        return 1
-
+        return self.fetch_input(self.registration["config"],"config","Config",path,force,display)
 
     def get_file(self,varname,path = None,force = False,display = False):    
         """Get currently registered file. If desired, you can pass a path where you would like file to be moved. Otherwise, it will be moved to self.path/self.subdirs[data]
@@ -379,36 +671,48 @@ class NeuroCAASScriptManager(object):
         :return: bool (True if downloaded, False if not)
 
         """
-        try:
-            file_s3path = self.registration["additional_files"][varname]["s3"]
-            file_name = os.path.basename(file_s3path)
-            source = "s3"
-        except KeyError:    
-            try:
-                file_localsource = self.registration["additional_files"][varname]["localsource"]
-                file_name = os.path.basename(file_localsource)
-                source = "local"
-            except:    
-                raise AssertionError("File not registered. Run register_file first.") 
+        entry = self.registration["additional_files"].get(varname,{})
+        return self.fetch_input(entry,"data","File",path,force,display)
 
-        if path is None: 
-            path = os.path.join(self.path,self.subdirs["data"])
-            mkdir_notexists(path)
-        file_localpath = os.path.join(path,file_name)
+    def stage_all(self,path = None,force = False,display = False,verify = True):
+        """Get all registered inputs (data, config and additional files) at once. Inputs in s3 are downloaded concurrently over a shared transfer manager, so this takes about as long as the slowest single download. Downloads are checked against the size and checksum of their s3 objects, and the registration is written once at the end, recording every input that was fetched even if another download failed. If a cache is enabled, inputs found in the cache are placed from it instead of downloaded. 
+        :param path: (optional) the location you want to write all inputs to. Otherwise, each is written to the same location as with get_data, get_config or get_file. 
+        :param force: (optional) by default, will not redownload inputs of the same name that already live here. Can override with force = True
+        :param display: (optional) by default, will not display download progress. 
+        :param verify: (optional) by default, checks the size and checksum of downloads. See Interface_S3.download_many. 
+        :return: dictionary with the same structure as the registration, giving True for each input that was fetched and False for each that was not. 
 
-        if not force: 
-            if os.path.exists(file_localpath):
-                print("Config already exists at this location. Set force = true to overwrite")
-                return 0
-            else:   
-                pass
-        if source == "s3":    
-            download(file_s3path,file_localpath,display)    
-        elif source == "local":    
-            shutil.copy(file_localsource,file_localpath)
-        self.registration["additional_files"][varname]["local"] = file_localpath
-        self.write()
-        return 1
+        """
+        staged = {"additional_files":{}}
+        inputs = [(staged,"data",self.registration["data"],"data"),(staged,"config",self.registration["config"],"config")]
+        inputs += [(staged["additional_files"],name,entry,"data") for name,entry in self.registration["additional_files"].items()]
+        transfers = []
+        for result,name,entry,subdir in inputs:
+            located = self.locate_input(entry,subdir,path)
+            if located is None:
+                continue
+            source,sourcepath,localpath = located
+            if not force and os.path.exists(localpath):
+                print("{} already exists at this location. Set force = true to overwrite".format(name))
+                result[name] = False
+            elif source == "s3":
+                transfers.append((result,name,entry,sourcepath,localpath))
+            elif source == "local":    
+                shutil.copy(sourcepath,localpath)
+                entry["local"] = localpath
+                result[name] = True
+        done = []
+        try:
+            download_many([(sourcepath,localpath) for result,name,entry,sourcepath,localpath in transfers],display,verify,self.cache,done)
+        finally:
+            self.record_cache()
+            completed = set([info["localpath"] for info in done])
+            for result,name,entry,sourcepath,localpath in transfers:
+                if localpath in completed:
+                    entry["local"] = localpath
+                    result[name] = True
+            self.write()
+        return staged
 
     def put_result(self,localfile,display = False):
         """
@@ -428,6 +732,91 @@ class NeuroCAASScriptManager(object):
             except:    
                 raise AssertionError("Result location not registered. Run register_resultpath first.")
 
+    def put_results_dir(self,localdir,force = False,display = False):
+        """Upload a directory of results to the registered result location (at the path given by get_resultpath). Files are uploaded concurrently over a shared transfer manager. A manifest of the size, modification time and md5 hash of each uploaded file is kept in the file "results_manifest.json" next to the registration, and files that have not changed since they were last uploaded are skipped. Total upload statistics (files, bytes and throughput) are kept in the registration, and recorded in the datastatus object of the job if one was registered by log_command. 
+        :param localdir: the directory you want to upload. 
+        :param force: (optional) by default, will not upload files that have not changed since the last upload. Can override with force = True
+        :param display: (optional) by default, will not display upload progress. 
+        :return: dictionary with the number of files uploaded ("files") and skipped ("skipped"), bytes uploaded ("bytes"), time taken in seconds ("seconds") and throughput in MB/s ("throughput_mbps") for this call.  
+
+        """
+        try:
+            destdir = self.get_resultpath(localdir)
+        except KeyError:    
+            raise AssertionError("Result location not registered. Run register_resultpath first.")
+        manifestpath = os.path.join(self.path,"results_manifest.json")
+        try:
+            with open(manifestpath,"r") as f:
+                manifest = json.load(f)
+        except FileNotFoundError:    
+            manifest = {}
+
+        files = []
+        for root,dirs,filenames in os.walk(localdir):
+            for filename in sorted(filenames):
+                localpath = os.path.join(root,filename)
+                files.append((localpath,os.path.join(destdir,os.path.relpath(localpath,localdir))))
+
+        def check(transfer):
+            """Get the manifest entry for a file, and whether it has changed since the last upload. Only hashes files whose size or modification time has changed. 
+
+            """
+            localpath,destpath = transfer
+            info = os.stat(localpath)
+            entry = {"size":info.st_size,"mtime_ns":info.st_mtime_ns}
+            previous = manifest.get(destpath,{})
+            if {k:previous.get(k) for k in entry} == entry:
+                return False,previous
+            entry["md5"] = get_etag(localpath)
+            return entry["md5"] != previous.get("md5"),entry
+
+        start = time.time()
+        with ThreadPoolExecutor() as pool:
+            checked = list(pool.map(check,files))
+        changed = [transfer for transfer,(update,entry) in zip(files,checked) if update or force]
+        if destdir.startswith("s3://"):
+            nbytes = upload_many(changed,display)
+        else:    
+            for localpath,destpath in changed:
+                os.makedirs(os.path.dirname(destpath),exist_ok = True)
+                shutil.copy2(localpath,destpath)
+            nbytes = sum([os.path.getsize(localpath) for localpath,destpath in changed])
+        seconds = time.time()-start
+        for (localpath,destpath),(update,entry) in zip(files,checked):
+            manifest[destpath] = entry
+        with open(manifestpath,"w") as f:
+            json.dump(manifest,f)
+
+        stats = {"files":len(changed),"skipped":len(files)-len(changed),"bytes":nbytes,"seconds":round(seconds,3),"throughput_mbps":round(nbytes/seconds/1e6,3) if seconds > 0 else 0}
+        print("Uploaded {} files ({} bytes) to {} in {:.1f} seconds ({} MB/s), skipped {} unchanged files".format(stats["files"],stats["bytes"],destdir,stats["seconds"],stats["throughput_mbps"],stats["skipped"]))
+        self.record_uploads(stats)
+        return stats
+
+    def record_uploads(self,stats):
+        """Add statistics of a call to put_results_dir to the totals in the registration, and record the totals in the datastatus object of the job, if one is registered. The totals are also written to the file result_uploads.json next to the local datastatus path, so that a logged command that is still running keeps them in the datastatus object. 
+        :param stats: statistics returned by put_results_dir. 
+
+        """
+        totals = self.registration.setdefault("result_uploads",{"files":0,"skipped":0,"bytes":0,"seconds":0})
+        for key in ["files","skipped","bytes","seconds"]:
+            totals[key] = totals[key]+stats[key]
+        totals["throughput_mbps"] = round(totals["bytes"]/totals["seconds"]/1e6,3) if totals["seconds"] > 0 else 0
+        self.write()
+        if "datastatus" not in self.registration:
+            return
+        datastatus = self.registration["datastatus"]
+        uploads_path = os.path.join(os.path.dirname(datastatus["local"]),"result_uploads.json")
+        os.makedirs(os.path.dirname(uploads_path),exist_ok = True)
+        with open(uploads_path+".tmp","w") as f:
+            json.dump(totals,f)
+        os.replace(uploads_path+".tmp",uploads_path)
+        ncds = NeuroCAASDataStatusLegacy(datastatus["s3"],datastatus["local"])
+        if ncds.writeobj.init_dict["loc"] == "local" and os.path.exists(datastatus["local"]):
+            ## keep the contents written by the logged command. 
+            with open(datastatus["local"],"r") as f:
+                ncds.rawfile = json.load(f)
+        ncds.record_uploads(totals)
+
     def get_name(self,contents):
         """Given a generic dictionary of structure self.pathtemplate, correctly returns the filename if available. 
         :param contents: a dictionary of structure {"s3":location,"local":location}
@@ -512,7 +901,7 @@ class NeuroCAASScriptManager(object):
         return resultpath
     
     def get_resultpath(self,filepath):
-        """Given the path to a file or directory locally, give the path we would upload it to in S3 (useful for using aws s3 sync)
+        """Given the path to a file or directory locally, give the path we would upload it to in S3. To upload a whole directory, use put_results_dir. 
 
         """
         assert self.registration["resultpath"] is not None, "result path must be registered"
@@ -534,8 +923,27 @@ class NeuroCAASScriptManager(object):
         if path is None: 
             path = os.path.join(self.path,self.subdirs["logs"])
             mkdir_notexists(path)
+        self.register_datastatus(s3log,os.path.join(path,"DATASTATUS.json"))
         log_process(command,os.path.join(path,"log.txt"),s3log)    
 
+    def log_commands(self,commands,s3logs,path=None):
+        """Run several commands concurrently, each logged to its own datastatus object (see JobLogger). All datastatus objects are assumed to share the same certificate. 
+
+        :param commands: list of commands to run. 
+        :param s3logs: list of s3 paths to datastatus objects, one per command. 
+        :param path: path to a directory where you want to write the log outputs to log_{i}.txt
+        :return: list of return codes. 
+        """
+        assert len(commands) == len(s3logs), "must give one datastatus path per command"
+        if path is None: 
+            path = os.path.join(self.path,self.subdirs["logs"])
+            mkdir_notexists(path)
+        s3certificate = os.path.join(os.path.dirname(s3logs[0]),"certificate.txt")
+        joblogger = JobLogger(s3certificate,path)
+        for i,(command,s3log) in enumerate(zip(commands,s3logs)):
+            joblogger.add(command,os.path.join(path,"log_{}.txt".format(i)),s3log,os.path.join(path,"DATASTATUS_{}.json".format(i)))
+        return joblogger.run()
+
     def cleanup(self):    
         """Indicates the end of registered workflow. Sends the relevant config file to the results directory, and sends a file called "update.txt" as well.
 
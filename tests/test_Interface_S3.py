@@ -51,8 +51,36 @@ def test_upload(setup_simple_bucket,tmp_path):
     Interface_S3.upload(upload_file,s3path)    
     Interface_S3.upload(upload_file,s3path,display = True)    
     Interface_S3.download(s3path,upload_file)
-        
-
-
 
+def test_S3ObjectReader(setup_simple_bucket):
+    bucket,username,contents,s3_client,s3_resource = setup_simple_bucket
+    content = bytes(range(256))*40
+    s3_client.put_object(Bucket = bucket,Key = f"{username}/bytes.bin",Body = content)
+    reader = Interface_S3.S3ObjectReader(f"s3://{bucket}/{username}/bytes.bin",blocksize = 1000)
+    assert reader.read(10) == content[:10]
+    assert reader.read(10) == content[10:20]
+    assert reader.requests == 1
+    reader.seek(-5,2)
+    assert reader.read() == content[-5:]
+    reader.seek(5000)
+    assert reader.tell() == 5000
+    assert reader.read(3000) == content[5000:8000]
+    assert reader.read() == content[8000:]
+    assert reader.read(10) == b""
 
+def test_download_many_kms(setup_simple_bucket,tmp_path,monkeypatch):
+    bucket,username,contents,s3_client,s3_resource = setup_simple_bucket
+    head_object = Interface_S3.s3_client.head_object
+    def kms_head_object(**kwargs):
+        ## objects encrypted with SSE-KMS have etags that are not md5 hashes of their contents. 
+        head = head_object(**kwargs)
+        head["ServerSideEncryption"] = "aws:kms"
+        head["ETag"] = '"{}"'.format("0"*32)
+        return head
+    monkeypatch.setattr(Interface_S3.s3_client,"head_object",kms_head_object)
+    s3path = f"s3://{bucket}/{username}/file.json"
+    info = Interface_S3.download_many([(s3path,str(tmp_path / "file.json"))])
+    assert info[0]["size"] == os.path.getsize(tmp_path / "file.json")
+    ## the size is still checked. 
+    with pytest.raises(AssertionError):
+        Interface_S3.verify_download(str(tmp_path / "file.json"),1,None)
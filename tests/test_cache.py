@@ -0,0 +1,107 @@
+import neurocaas_contrib.cache as cache
+import neurocaas_contrib.scripting as scripting
+import neurocaas_contrib.Interface_S3 as Interface_S3
+import localstack_client.session
+import json
+import os
+import stat
+import pytest
+
+@pytest.fixture
+def setup_cache_bucket(monkeypatch):
+    bucketname = "testcache"
+    session = localstack_client.session.Session()
+    s3_client = session.client("s3")
+    monkeypatch.setattr(Interface_S3, "s3_client", s3_client) 
+    s3_client.create_bucket(Bucket = bucketname)
+    s3_client.put_object(Bucket = bucketname,Key = "user/inputs/data.json",Body = json.dumps({"data":"element"}).encode("utf-8"))
+    s3_client.put_object(Bucket = bucketname,Key = "user/inputs/copy.json",Body = json.dumps({"data":"element"}).encode("utf-8"))
+    return bucketname
+
+def write(path,size):
+    with open(path,"wb") as f:
+        f.write(b"0"*size)
+
+def test_InputCache(tmp_path):
+    inputcache = cache.InputCache(str(tmp_path / "cache"),maxsize = 100,link = True)
+    write(tmp_path / "file",10)
+    key = inputcache.get_key('"abc"',10)
+    assert key == "abc-10"
+    assert not inputcache.get(key,str(tmp_path / "linked"))
+    inputcache.add(key,str(tmp_path / "file"))
+    ## the downloaded file is not changed by adding it to the cache. 
+    assert not os.path.samefile(tmp_path / "file",inputcache.get_path(key))
+    assert os.stat(tmp_path / "file").st_mode & stat.S_IWUSR
+    assert inputcache.get(key,str(tmp_path / "linked"))
+    assert os.path.samefile(tmp_path / "linked",inputcache.get_path(key))
+    ## cached objects cannot be modified through their links. 
+    assert not os.stat(tmp_path / "linked").st_mode & 0o222
+    ## linking replaces existing files. 
+    assert inputcache.get(key,str(tmp_path / "linked"))
+    assert inputcache.collect() == {"hits":2,"misses":1,"bytes_saved":20}
+    assert inputcache.collect() == {"hits":0,"misses":0,"bytes_saved":0}
+
+def test_InputCache_copy(tmp_path):
+    inputcache = cache.InputCache(str(tmp_path / "cache"),link = False)
+    write(tmp_path / "file",10)
+    inputcache.add("abc-10",str(tmp_path / "file"))
+    assert inputcache.get("abc-10",str(tmp_path / "copied"))
+    assert not os.path.samefile(tmp_path / "copied",inputcache.get_path("abc-10"))
+    with open(tmp_path / "copied","ab") as f:
+        f.write(b"1")
+    assert os.path.getsize(inputcache.get_path("abc-10")) == 10
+
+def test_InputCache_check(tmp_path):
+    inputcache = cache.InputCache(str(tmp_path / "cache"))
+    write(tmp_path / "file",10)
+    etag = Interface_S3.get_etag(str(tmp_path / "file"))
+    key = inputcache.get_key(etag,10)
+    inputcache.add(key,str(tmp_path / "file"))
+    assert inputcache.get(key,str(tmp_path / "placed"),etag)
+    ## a cached object with the right size but wrong contents is caught by its etag.  
+    os.chmod(inputcache.get_path(key),0o644)
+    with open(inputcache.get_path(key),"wb") as f:
+        f.write(b"1"*10)
+    assert inputcache.check(key,inputcache.get_path(key))
+    assert not inputcache.get(key,str(tmp_path / "placed"),etag)
+    assert not os.path.exists(inputcache.get_path(key))
+    ## one with the wrong size is caught without it. 
+    inputcache.add(key,str(tmp_path / "file"))
+    os.chmod(inputcache.get_path(key),0o644)
+    with open(inputcache.get_path(key),"ab") as f:
+        f.write(b"1")
+    assert not inputcache.get(key,str(tmp_path / "placed"))
+    assert inputcache.collect() == {"hits":1,"misses":2,"bytes_saved":10}
+
+def test_InputCache_evict(tmp_path):
+    inputcache = cache.InputCache(str(tmp_path / "cache"),maxsize = 100)
+    for i in range(3):
+        write(tmp_path / "file{}".format(i),40)
+        inputcache.add("key{}-40".format(i),str(tmp_path / "file{}".format(i)))
+        os.utime(inputcache.get_path("key{}-40".format(i)),(i,i))
+    ## key0 was evicted when key2 was added. Using key1 makes key2 least recently used. 
+    assert sorted(os.listdir(inputcache.cachedir)) == ["key1-40","key2-40"]
+    os.utime(inputcache.get_path("key2-40"),(10,10))
+    assert inputcache.get("key1-40",str(tmp_path / "linked"))
+    write(tmp_path / "file3",40)
+    inputcache.add("key3-40",str(tmp_path / "file3"))
+    assert sorted(os.listdir(inputcache.cachedir)) == ["key1-40","key3-40"]
+
+def test_stage_all_cached(tmp_path,setup_cache_bucket,monkeypatch):
+    bucketname = setup_cache_bucket
+    monkeypatch.setenv("NEUROCAAS_CACHE_DIR",str(tmp_path / "cache"))
+    totals = []
+    for i,key in enumerate(["data.json","copy.json"]):
+        subdir = tmp_path / "job{}".format(i)
+        subdir.mkdir()
+        ncsm = scripting.NeuroCAASScriptManager(str(subdir))
+        ncsm.register_data("s3://{}/user/inputs/{}".format(bucketname,key))
+        ncsm.stage_all()
+        with open(ncsm.registration["data"]["local"],"r") as f:
+            assert json.load(f) == {"data":"element"}
+        totals.append(ncsm.registration["cache"])
+    ## the second object has the same contents, so it is linked from the cache. 
+    assert totals[0]["misses"] == 1 and totals[0]["hits"] == 0
+    assert totals[1]["hits"] == 1 and totals[1]["bytes_saved"] == len(json.dumps({"data":"element"}))
+    ## the first job's own download is left writable. 
+    assert os.stat(tmp_path / "job0" / "inputs" / "data.json").st_mode & stat.S_IWUSR
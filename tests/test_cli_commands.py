@@ -499,8 +499,11 @@ def test_visualize_parallelism(setup_log_bucket):
         os.mkdir("./logs")
         result = eprint(runner.invoke(cli,["init","--location","./"],input = "{}\n{}".format(bucket_name,"Y")))
         result = eprint(runner.invoke(cli,["monitor","visualize-parallelism","-p","./logs"]))
-        logfiles = os.listdir("./logs")
-        assert len(logfiles) == 2
+        ## the usage table is overwritten by later runs, instead of accumulating copies. 
+        result = eprint(runner.invoke(cli,["monitor","visualize-parallelism","-p","./logs"]))
+        assert len([l for l in os.listdir("./logs") if l.endswith("usage_table.npy")]) == 1
+        logfiles = [l for l in os.listdir("./logs") if l.endswith("_parallel_logs.json")]
+        assert len(logfiles) == 4
         labnames = ["bendeskylab","sawtelllab"]
         for l in logfiles:
             assert any([l.startswith(bucket_name+"_{}".format(f)) for f in labnames])
@@ -763,6 +766,20 @@ class Test_workflow():
                 d = json.load(f)
                 assert d["data"] == "element"
 
+    def test_get_all(self,setup_simple_bucket):
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            result = eprint(runner.invoke(cli,["workflow","initialize-job","-p", "./"]))
+            result = eprint(runner.invoke(cli,["workflow","register-dataset","-b","testinterface","-k","user/file.json"]))
+            result = eprint(runner.invoke(cli,["workflow","register-config","-b","testinterface","-k","user/config.json"]))
+            result = eprint(runner.invoke(cli,["workflow","get-all"]))
+            assert os.path.exists("./inputs/file.json") 
+            assert os.path.exists("./configs/config.json") 
+            with open("registration.json","r") as f:
+                registration = json.load(f)
+            assert registration["data"]["local"] == os.path.abspath("./inputs/file.json")    
+            assert registration["config"]["local"] == os.path.abspath("./configs/config.json")    
+
     def test_put_result(self,setup_simple_bucket):
         bucketname,username,contents,s3_client,s3_resource = setup_simple_bucket
         runner = CliRunner()
@@ -780,6 +797,22 @@ class Test_workflow():
             result = eprint(runner.invoke(cli,["workflow","put-result","-r","file.txt","-d"]))
             config =  s3_client.download_file(bucketname,"groupname/keypath/process_results/file.txt","./file.txt")
 
+    def test_put_results(self,setup_simple_bucket):
+        bucketname,username,contents,s3_client,s3_resource = setup_simple_bucket
+        runner = CliRunner()
+        with runner.isolated_filesystem():
+            os.makedirs("outputs/sub")
+            for name in ["outputs/file.txt","outputs/sub/file2.txt"]:
+                with open(name,"w") as f:
+                    f.write(name)
+            result = eprint(runner.invoke(cli,["workflow","initialize-job","-p", "./"]))
+            result = eprint(runner.invoke(cli,["workflow","register-dataset","-b",bucketname,"-k","groupname/inputs/loc"]))
+            result = eprint(runner.invoke(cli,["workflow","register-resultpath","-b",bucketname,"-k","keypath/"]))
+            result = eprint(runner.invoke(cli,["workflow","put-results","-r","outputs"]))
+            assert result.exit_code == 0
+            s3_client.head_object(Bucket = bucketname,Key = "groupname/keypath/process_results/outputs/file.txt")
+            s3_client.head_object(Bucket = bucketname,Key = "groupname/keypath/process_results/outputs/sub/file2.txt")
+
     def test_get_dataname(self,setup_simple_bucket):            
         runner = CliRunner()
         with runner.isolated_filesystem():
@@ -0,0 +1,119 @@
+import neurocaas_contrib.clients as clients
+import neurocaas_contrib.log as log
+import neurocaas_contrib.monitor as monitor
+import neurocaas_contrib.Interface_S3 as Interface_S3
+import subprocess
+import json
+import time
+import sys
+import os
+import pytest
+
+loc = os.path.abspath(os.path.dirname(__file__))
+srcdir = os.path.join(os.path.dirname(loc),"src")
+
+## representative subcommands to time startup for.
+subcommands = [
+        ["--help"],
+        ["init","--help"],
+        ["workflow","--help"],
+        ["scripting","read-yaml","--help"],
+        ]
+
+## patches the constructors of boto3 clients and resources (through any session) and of docker clients to count calls, and builds nothing. 
+count_constructors = """
+import boto3.session, docker.client
+calls = []
+def counting(kind):
+    def construct(*args,**kwargs):
+        calls.append(kind)
+        raise RuntimeError("client built: "+kind)
+    return construct
+boto3.session.Session.client = counting("boto3.client")
+boto3.session.Session.resource = counting("boto3.resource")
+docker.client.DockerClient.__init__ = counting("docker")
+"""
+
+class Counter():
+    def __init__(self):
+        self.calls = 0
+    def __call__(self):
+        self.calls += 1
+        return {"calls":self.calls}
+
+@pytest.fixture
+def registry():
+    saved = dict(clients.registry)
+    clients.reset()
+    yield clients.registry
+    clients.reset()
+    clients.registry.update(saved)
+
+def test_get(registry):
+    factory = Counter()
+    assert clients.get("counter",factory) is clients.get("counter",factory)
+    assert factory.calls == 1
+    assert clients.built() == ["counter"]
+
+def test_LazyClient(registry):
+    factory = Counter()
+    proxy = clients.LazyClient("counter",factory)
+    assert factory.calls == 0
+    assert proxy.get("calls") == 1
+    assert proxy.get("calls") == 1
+    assert factory.calls == 1
+
+def test_lazy_resource_shared(registry):
+    assert clients.built() == []
+    bucket = log.s3_resource.Bucket("test-bucket")
+    assert bucket.name == "test-bucket"
+    assert clients.built() == ["resource:s3"]
+    ## other modules share the resource.
+    assert monitor.s3_resource._get() is log.s3_resource._get()
+    assert Interface_S3.s3._get() is log.s3_resource._get()
+    assert clients.built() == ["resource:s3"]
+
+def test_import_builds_no_clients():
+    code = "import neurocaas_contrib.cli_commands; from neurocaas_contrib import clients; print(clients.built())"
+    output = subprocess.run([sys.executable,"-c",code],cwd = srcdir,capture_output = True,check = True)
+    assert output.stdout.decode("utf-8").strip() == "[]"
+
+def test_import_constructs_no_clients():
+    ## modules that bypass the registry would construct clients directly. 
+    modules = ["neurocaas_contrib.{}".format(os.path.splitext(f)[0]) for f in sorted(os.listdir(os.path.join(srcdir,"neurocaas_contrib"))) if f.endswith(".py")]
+    code = count_constructors+"""
+import importlib,json
+for module in {}:
+    importlib.import_module(module)
+before = list(calls)
+import neurocaas_contrib.log as log
+try:
+    log.s3_resource.meta
+except RuntimeError:
+    pass
+print(json.dumps([before,calls]))
+""".format(modules)
+    output = subprocess.run([sys.executable,"-c",code],cwd = srcdir,capture_output = True,check = True)
+    before,after = json.loads(output.stdout.decode("utf-8").strip().splitlines()[-1])
+    assert before == []
+    ## the first attribute access builds the client. 
+    assert after == ["boto3.resource"]
+
+@pytest.mark.parametrize("args",subcommands)
+def test_startup_benchmark(args):
+    code = count_constructors+"""
+import sys,atexit
+from neurocaas_contrib.main import main
+atexit.register(lambda: print("clients constructed: {}".format(len(calls))))
+sys.argv = ['neurocaas-contrib']+sys.argv[1:]
+main()
+"""
+    times = []
+    for i in range(3):
+        start = time.time()
+        output = subprocess.run([sys.executable,"-c",code]+args,cwd = srcdir,capture_output = True,check = True)
+        times.append(time.time()-start)
+        ## help output never needs a client. 
+        assert output.stdout.decode("utf-8").strip().endswith("clients constructed: 0")
+    print("neurocaas-contrib {}: best of 3 {:.3f}s".format(" ".join(args),min(times)))
+    assert min(times) < 10
@@ -1,5 +1,7 @@
 import localstack_client.session
 import datetime
+import time
+import threading
 import json
 import pdb
 import docker
@@ -159,6 +161,22 @@ class Test_NeuroCAASCertificate(object):
         with pytest.raises(IndexError):
             ncc.update_instance_info(updatedict,loc = 10)
 
+    def test_NeuroCAASCertificate_update_benchmark(self,tmp_path):
+        """Micro-benchmark: the cost of updating a row should not grow with the number of datasets in the certificate. Bound is loose to avoid flaky timing. 
+
+        """
+        import timeit
+        ncc = log.NeuroCAASCertificate("s3://fake/path.txt",tmp_path / "certificate.txt")
+        timings = {}
+        for nb_datasets in [10,100,1000,10000]:
+            rows = ["DATANAME: groupname/inputs/data{}.ext | STATUS: INITIALIZING | TIME: N/A".format(i) for i in range(nb_datasets)]
+            ncc.parse("\n".join(["header",log.divider]+rows+[log.divider,"footer"]))
+            updatedict = {"n":"groupname/inputs/data{}.ext".format(nb_datasets//2),"s":"IN PROGRESS"}
+            timings[nb_datasets] = min(timeit.repeat(lambda: ncc.update_instance_info(dict(updatedict),reload = False),number = 200,repeat = 5))
+        print(timings)    
+        assert timings[10000] < 10*timings[10]
+        assert "DATANAME: groupname/inputs/data5000.ext | STATUS: IN PROGRESS" in ncc.render()
+
     def test_NeuroCAASCertificate_write(self):
         ncc = log.NeuroCAASCertificate(certpath)
         ncc.write()
@@ -189,6 +207,310 @@ class Test_NeuroCAASCertificate(object):
         assert datalines[0] == base
         assert datalines[1] == base2
 
+class Test_CoalescingWriter():
+    class Counter():
+        def __init__(self):
+            self.writes = 0
+        def write(self):
+            self.writes += 1
+
+    def test_touch(self):
+        now = [0]
+        logobj = self.Counter()
+        writer = log.CoalescingWriter(logobj,min_interval = 10,clock = lambda: now[0])
+        assert writer.touch("IN PROGRESS") ## first update is always written.
+        for t in range(1,10):
+            now[0] = t
+            assert not writer.touch("IN PROGRESS")
+        now[0] = 10    
+        assert writer.touch("IN PROGRESS")
+        now[0] = 11    
+        assert writer.touch("SUCCESS") ## status transitions are written immediately.
+        assert not writer.flush() ## nothing left to write. 
+        assert logobj.writes == 3
+
+    def test_CertificateWriter(self,tmp_path):
+        temp_cert = tmp_path / "certificate.txt"
+        now = [0]
+        ncc = log.NeuroCAASCertificate("s3://fake/path.txt",temp_cert)
+        writer = log.CertificateWriter(ncc,min_interval = 10,clock = lambda: now[0])
+        updatedict = {"n":"groupname/inputs/dataname.ext","s":"IN PROGRESS"}
+        for t in range(100):
+            now[0] = t/10.
+            updatedict["r"] = "command {}".format(t)
+            writer.update_instance_info(updatedict)
+        assert writer.writes == 1
+        writer.flush()
+        assert writer.writes == 2
+        with open(temp_cert,"r") as f:
+            out = f.readlines()
+        assert out[2] == "DATANAME: groupname/inputs/dataname.ext | STATUS: IN PROGRESS | TIME: N/A | LAST COMMAND: command 99 | CPU_USAGE: N/A\n"
+
+    def test_CertificateWriter_sharded(self,tmp_path):
+        temp_cert = tmp_path / "certificate.txt"
+        base  = "DATANAME: groupname/inputs/dataname.ext | STATUS: IN PROGRESS | TIME: N/A | LAST COMMAND: N/A | CPU_USAGE: N/A"
+        base2  = "DATANAME: groupname/inputs/dataname2.ext | STATUS: IN PROGRESS | TIME: N/A | LAST COMMAND: N/A | CPU_USAGE: N/A"
+        writers = [log.CertificateWriter(log.NeuroCAASCertificate("s3://fake/path.txt",temp_cert),mode = "sharded") for i in range(2)]
+        writers[0].update_instance_info({"n":"groupname/inputs/dataname.ext","s":"IN PROGRESS"})
+        writers[1].update_instance_info({"n":"groupname/inputs/dataname2.ext","s":"IN PROGRESS"})
+        ## only shards have been written so far. 
+        assert not os.path.exists(temp_cert)
+        ncc = log.NeuroCAASCertificate("s3://fake/path.txt",temp_cert)
+        assert ncc.merge_shards() == 2
+        assert base in ncc.rawfile and base2 in ncc.rawfile
+        ## on finish, each writer updates the certificate itself. 
+        [w.flush(finish = True) for w in writers]
+        with open(temp_cert,"r") as f:
+            out = f.read()
+        assert base in out and base2 in out
+
+    def test_CertificateWriter_sharded_basenames(self,tmp_path):
+        ## datasets with the same basename in different folders get their own shards. 
+        assert log.get_dataset_key("a/data.h5") != log.get_dataset_key("b/data.h5")
+        assert log.get_dataset_key("a/data:1 2.h5").startswith("data_1_2.h5-")
+        temp_cert = tmp_path / "certificate.txt"
+        writer = log.CertificateWriter(log.NeuroCAASCertificate("s3://fake/path.txt",temp_cert),mode = "sharded")
+        for dataname in ["groupname/a/data.h5","groupname/b/data.h5"]:
+            writer.update_instance_info({"n":dataname,"s":"IN PROGRESS"})
+        ncc = log.NeuroCAASCertificate("s3://fake/path.txt",temp_cert)
+        assert sorted([shard["n"] for shard in ncc.load_shards()]) == ["groupname/a/data.h5","groupname/b/data.h5"]
+
+    def test_NeuroCAASCertificate_load_shards_missing(self,monkeypatch):
+        ## shards that cannot be read (i.e. deleted after listing) are skipped. 
+        class FakeObject():
+            def __init__(self,key):
+                self.key = key
+        class FakeBucket():
+            class objects():
+                @staticmethod
+                def filter(Prefix):
+                    return [FakeObject(Prefix+name) for name in ["DATASET_NAME:a.json","DATASET_NAME:b.json"]]
+        class FakeResource():
+            def Bucket(self,name):
+                return FakeBucket()
+        def load_file_s3(bucket_name,key):
+            if key.endswith("a.json"):
+                raise ValueError
+            return json.dumps({"n":"groupname/inputs/b","s":"IN PROGRESS"})
+        ncc = log.NeuroCAASCertificate(certpath,parse = False)
+        monkeypatch.setattr(ncc,"writeobj",log.WriteObj({"loc":"s3","bucket":certbucket,"key":certkey}))
+        monkeypatch.setattr(log,"s3_resource",FakeResource())
+        monkeypatch.setattr(log,"load_file_s3",load_file_s3)
+        assert ncc.load_shards() == [{"n":"groupname/inputs/b","s":"IN PROGRESS"}]
+
+    def test_CertificateWriter_conditional(self,monkeypatch):
+        create_mock_data(certbucket,certkey,localcertpath)
+        base  = "DATANAME: groupname/inputs/dataname.ext | STATUS: IN PROGRESS | TIME: N/A | LAST COMMAND: N/A | CPU_USAGE: N/A"
+        base2  = "DATANAME: groupname/inputs/dataname2.ext | STATUS: IN PROGRESS | TIME: N/A | LAST COMMAND: N/A | CPU_USAGE: N/A"
+        ncc = log.NeuroCAASCertificate(certpath)
+        writer = log.CertificateWriter(ncc,mode = "conditional")
+        other = log.CertificateWriter(log.NeuroCAASCertificate(certpath),mode = "conditional")
+        ## another instance writes the certificate between our reload and write, so our first write should fail and be retried. 
+        reload = ncc.reload
+        reloads = []
+        def interrupted_reload():
+            out = reload()
+            reloads.append(1)
+            if len(reloads) == 1:
+                other.update_instance_info({"n":"groupname/inputs/dataname.ext","s":"IN PROGRESS"})
+            return out    
+        monkeypatch.setattr(ncc,"reload",interrupted_reload)
+        writer.update_instance_info({"n":"groupname/inputs/dataname2.ext","s":"IN PROGRESS"})
+        assert len(reloads) == 2
+        ncc = log.NeuroCAASCertificate(certpath)
+        assert base in ncc.rawfile and base2 in ncc.rawfile
+
+    def test_CertificateWriter_conditional_unsupported(self,monkeypatch):
+        create_mock_data(certbucket,certkey,localcertpath)
+        base2  = "DATANAME: groupname/inputs/dataname2.ext | STATUS: IN PROGRESS | TIME: N/A | LAST COMMAND: N/A | CPU_USAGE: N/A"
+        ncc = log.NeuroCAASCertificate(certpath)
+        ## older versions of botocore reject IfMatch before sending the request. 
+        put = ncc.writeobj.put
+        def put_no_ifmatch(stringbody,if_match = None):
+            if if_match is not None:
+                raise log.ParamValidationError(report = "Unknown parameter in input: \"IfMatch\"")
+            return put(stringbody)
+        monkeypatch.setattr(ncc.writeobj,"put",put_no_ifmatch)
+        writer = log.CertificateWriter(ncc,mode = "conditional")
+        writer.update_instance_info({"n":"groupname/inputs/dataname2.ext","s":"IN PROGRESS"})
+        ncc = log.NeuroCAASCertificate(certpath)
+        assert base2 in ncc.rawfile
+
+class Test_LogFollower():
+    class FakeContainer():
+        name = "fakecontainer"
+        status = "exited"
+        def logs(self,stream = True,follow = True):
+            yield b"line 0\nline"
+            yield b" 1\n\tline 2\r\n"
+            yield b"line 3\nline 4\n"
+        def reload(self):
+            pass
+
+    def test_LogFollower(self,tmp_path):
+        spoolpath = str(tmp_path / "spool.log")
+        follower = log.LogFollower(self.FakeContainer(),spoolpath,maxlines = 3)
+        follower.thread.join(5)
+        first,lines = follower.tail()
+        assert first == 2
+        assert lines == ["    line 2","line 3","line 4",""]
+        with open(spoolpath,"r") as f:
+            assert f.read() == "line 0\nline 1\n    line 2\nline 3\nline 4\n"
+
+    def test_LogFollower_spool(self,tmp_path):
+        ## a spool left by a previous container is truncated. 
+        spoolpath = str(tmp_path / "spool.log")
+        with open(spoolpath,"w") as f:
+            f.write("old line\n")
+        log.LogFollower(self.FakeContainer(),spoolpath).thread.join(5)
+        with open(spoolpath,"r") as f:
+            assert f.read().startswith("line 0\n")
+
+    def test_LogFollower_multibyte(self):
+        ## characters split across chunks are decoded whole, and an incomplete one at the end is replaced. 
+        class SplitContainer(self.FakeContainer):
+            def logs(self,stream = True,follow = True):
+                yield "caf\u00e9 \u20ac".encode("utf-8")[:-2]
+                yield "caf\u00e9 \u20ac".encode("utf-8")[-2:]+b"\n\xe2\x82"
+        follower = log.LogFollower(SplitContainer())
+        follower.thread.join(5)
+        assert follower.tail()[1] == ["caf\u00e9 \u20ac","\ufffd"]
+
+    def test_LogFollower_error(self):
+        class BrokenContainer(self.FakeContainer):
+            def logs(self,stream = True,follow = True):
+                yield b"line 0\n"
+                raise ConnectionError("docker went away")
+        follower = log.LogFollower(BrokenContainer())
+        follower.thread.join(5)
+        assert follower.stopped.is_set()
+        assert isinstance(follower.error,ConnectionError)
+        assert follower.tail()[1] == ["line 0",""]
+
+    def test_LogFollower_remove_spool(self,tmp_path):
+        spoolpath = str(tmp_path / "spool.log")
+        follower = log.LogFollower(self.FakeContainer(),spoolpath,remove_spool = True)
+        follower.thread.join(5)
+        assert os.path.exists(spoolpath)
+        follower.close()
+        assert not os.path.exists(spoolpath)
+        ## spools that were not created by the follower are kept. 
+        log.LogFollower(self.FakeContainer(),spoolpath).close()
+        assert os.path.exists(spoolpath)
+
+class Test_ResourceSampler():
+    class FakeSource():
+        def __init__(self):
+            self.calls = 0
+        def __call__(self):
+            self.calls += 1
+            return {"cpu_percent":float(self.calls),"memory_mb":100.0,"disk_read_bytes":self.calls*2e6,"disk_write_bytes":None,"net_recv_bytes":0,"net_sent_bytes":0}
+
+    def test_ResourceSampler(self):
+        clock = iter(range(1000))
+        sampler = log.ResourceSampler(self.FakeSource(),maxsamples = 8,clock = lambda: next(clock))
+        for i in range(20):
+            sampler.sample()
+        assert sampler.latest["disk_read_mbps"] == 2
+        assert sampler.latest["disk_write_mbps"] is None
+        history = sampler.get_history()
+        assert len(history) <= 8 
+        assert sum([p["n"] for p in history]) == 20
+        assert sampler.stride == 4
+        assert history[0]["cpu_percent"] == 2.5 ## average of samples 1-4.
+        summary = sampler.summary()
+        assert summary["cpu_percent"]["min"] == 1 
+        assert summary["cpu_percent"]["max"] == 20 
+        assert summary["cpu_percent"]["mean"] == 10.5 
+        assert summary["memory_mb"]["p95"] == 100
+        assert "disk_write_mbps" not in summary
+
+    def test_ResourceSampler_add_point(self):
+        ## metrics missing from some samples are averaged over the samples that measured them. 
+        point = {"t":0,"n":0,"values":{},"counts":{}}
+        log.ResourceSampler.add_point(point,{"t":0,"n":1,"values":{"cpu_percent":1.0,"disk_read_mbps":None},"counts":{"cpu_percent":1}})
+        log.ResourceSampler.add_point(point,{"t":1,"n":1,"values":{"cpu_percent":3.0,"disk_read_mbps":4.0},"counts":{"cpu_percent":1,"disk_read_mbps":1}})
+        other = {"t":2,"n":2,"values":{"cpu_percent":5.0,"disk_read_mbps":1.0},"counts":{"cpu_percent":2,"disk_read_mbps":2}}
+        log.ResourceSampler.add_point(point,other)
+        assert point["n"] == 4
+        assert point["values"]["cpu_percent"] == 3.5
+        assert point["values"]["disk_read_mbps"] == 2.0
+        assert point["counts"] == {"cpu_percent":4,"disk_read_mbps":3}
+
+    def test_ResourceSampler_thread(self):
+        source = self.FakeSource()
+        sampler = log.ResourceSampler(source,interval = 0.01).start()
+        time.sleep(0.2)
+        sampler.stop()
+        assert not sampler.thread.is_alive()
+        assert sampler.report()["samples"] == source.calls > 1
+
+    def test_NeuroCAASDataStatusLegacy_usage(self,tmp_path):
+        create_mock_data(statusbucket,statuskey,localstatuspath)
+        ncds = log.NeuroCAASDataStatusLegacy(statuspath)
+        sampler = ncds.start_sampler(log.PsutilSource(os.getpid()),interval = 0.01)
+        start = time.time()
+        usage = ncds.get_usage()
+        assert time.time()-start < 0.1 
+        assert float(usage["memory_total_mb"]) > 0 
+        report = ncds.finish_usage(str(tmp_path / "usage.json"))
+        assert not sampler.thread.is_alive()
+        assert set(report["summary"]["cpu_percent"].keys()) == {"min","mean","p95","max"}
+        assert ncds.rawfile["usage_summary"] == report["summary"]
+
+class Test_UploadQueue():
+    def test_UploadQueue(self):
+        queue = log.UploadQueue()
+        uploads = []
+        started = threading.Event()
+        release = threading.Event()
+        def blocking_upload():
+            started.set()
+            release.wait(10)
+            uploads.append(("block",0))
+        queue.submit("block",blocking_upload)
+        assert started.wait(10)
+        ## while the first upload is in progress, newer versions replace older ones.
+        for i in range(3):
+            queue.submit("a",lambda i=i: uploads.append(("a",i)))
+        queue.submit("b",lambda: uploads.append(("b",0)))
+        queue.submit("a",lambda: uploads.append(("a",3)))
+        assert not queue.flush(0.01)
+        release.set()
+        assert queue.flush(10)
+        assert uploads == [("block",0),("b",0),("a",3)]
+        assert queue.coalesced == 3
+        assert queue.close()
+        queue.thread.join(10)
+        assert not queue.thread.is_alive()
+
+    def test_UploadQueue_errors(self):
+        queue = log.UploadQueue(retries = 2,backoff = 0.01)
+        attempts = []
+        def failing_upload():
+            attempts.append("a")
+            raise ValueError("network down")
+        queue.submit("a",failing_upload)
+        queue.submit("b",lambda: None)
+        assert not queue.flush(10)
+        assert queue.uploads == 1
+        assert attempts == ["a"]*3
+        ## errors are reported once. 
+        assert queue.errors == []
+        assert queue.flush(10)
+
+    def test_UploadQueue_retry(self):
+        queue = log.UploadQueue(retries = 2,backoff = 0.01)
+        attempts = []
+        def flaky_upload():
+            attempts.append("a")
+            if len(attempts) < 3:
+                raise ValueError("network down")
+        queue.submit("a",flaky_upload)
+        assert queue.flush(10)
+        assert attempts == ["a"]*3
+        assert queue.uploads == 1
+
 class Test_NeuroCAASDataStatus():
     client = docker.from_env()
     @classmethod
@@ -219,6 +541,21 @@ class Test_NeuroCAASDataStatus():
         assert type(output) == list
         assert type(output[0]) == str 
     
+    def test_NeuroCAASDataStatus_close(self):
+        create_mock_data(statusbucket,statuskey,localstatuspath)
+        class BrokenContainer():
+            name = "brokencontainer"
+            def logs(self,stream = True,follow = True):
+                raise ConnectionError("docker went away")
+        ncds = log.NeuroCAASDataStatus(statuspath,BrokenContainer())
+        ncds.follower.thread.join(5)
+        ## errors following the logs are reported with the output. 
+        assert ncds.get_stdout()[-1] == "Error following container logs: ConnectionError('docker went away')"
+        spoolpath = ncds.follower.spoolpath
+        assert os.path.exists(spoolpath)
+        ncds.close()
+        assert not os.path.exists(spoolpath)
+
     def test_NeuroCAASDataStatus_get_status(self,test_containers):
         create_mock_data(statusbucket,statuskey,localstatuspath)
         ncds = log.NeuroCAASDataStatus(statuspath,test_containers)
@@ -413,6 +750,85 @@ class Test_NeuroCAASDataStatusLegacy():
         for key in datadict:
             assert datadict[key] == ncds.rawfile[key]
 
+    def test_NeuroCAASDataStatusLegacy_chunking(self,tmp_path):
+        logfile = os.path.join(tmp_path,"loglegacy.txt")
+        with open(logfile,"w") as f:
+            f.write("".join(["line {}\n".format(i) for i in range(10)]))
+        create_mock_data(statusbucket,statuskey,localstatuspath)
+        starttime = "0001-01-01T00:00:00Z"
+        ncds = log.NeuroCAASDataStatusLegacy(statuspath)
+        ncds.enable_chunking(logfile,tail_lines = 3)
+        ncds.update_file(logfile,starttime)
+        ncds.write()
+        assert ncds.rawfile["std_chunks"]["lines"] == 10
+        assert list(ncds.rawfile["std"].keys()) == ["7","8","9"]
+        ## nothing new: no new chunk. 
+        ncds.write()
+        assert len(ncds.rawfile["std_chunks"]["chunks"]) == 1
+        ## only new output is uploaded, and a trailing partial line waits until closed. 
+        with open(logfile,"a") as f:
+            f.write("line 10\nline 11\npartial")
+        ncds.update_file(logfile,starttime)
+        ncds.write()
+        chunks = ncds.rawfile["std_chunks"]["chunks"]
+        assert [(c["first"],c["count"]) for c in chunks] == [(0,10),(10,2)]
+        ncds.close_chunks()
+        ncds.write()
+        assert ncds.rawfile["std_chunks"]["lines"] == 13
+        ## read back a range from a fresh object. 
+        remote = log.NeuroCAASDataStatusLegacy(statuspath)
+        lines = remote.get_lines(8,12)
+        assert lines == {str(i):"line {}\n".format(i) for i in range(8,12)}
+        assert remote.get_lines(12) == {"12":"partial\n"}
+        assert len(remote.rawfile["std"]) == 3
+
+
+    def test_NeuroCAASDataStatusLegacy_events(self,tmp_path):
+        logfile = os.path.join(tmp_path,"loglegacy.txt")
+        with open(logfile,"w") as f:
+            f.write("line 0\nline 1\n")
+        starttime = "0001-01-01T00:00:00Z"
+        ncds = log.NeuroCAASDataStatusLegacy("s3://fake.ext",str(tmp_path / "DATASTATUS.json"))
+        ncds.enable_chunking(logfile)
+        events = ncds.enable_events("dataset.ext")
+        ncds.update_file(logfile,starttime)
+        ncds.write()
+        ## nothing changed: no new status event. 
+        ncds.write()
+        with open(logfile,"a") as f:
+            f.write("line 2\n")
+        ncds.update_file(logfile,starttime,"0001-01-01T00:01:00Z",0)
+        ncds.write()
+        eventdir = tmp_path / "events" / "dataset.ext"
+        written = []
+        for name in sorted(os.listdir(eventdir)):
+            with open(eventdir / name) as f:
+                written.extend([json.loads(line) for line in f])
+        assert [e["i"] for e in written] == list(range(events.count))
+        assert [e["type"] for e in written if e["type"] != "usage"] == ["log","status","log","status"]
+        states = log.apply_events(written)
+        assert states["dataset.ext"]["status"] == "SUCCESS"
+        assert states["dataset.ext"]["last_line"] == "line 2"
+        assert states["dataset.ext"]["std_chunks"]["lines"] == 3
+        ## compact into fresh views. 
+        view = log.NeuroCAASDataStatusLegacy("s3://fake.ext",str(tmp_path / "DATASTATUS.json"))
+        log.render_datastatus(states["dataset.ext"],view)
+        assert view.rawfile["status"] == "SUCCESS"
+        assert view.rawfile["std"] == {"0":"line 0\n","1":"line 1\n","2":"line 2\n"}
+        cert = log.NeuroCAASCertificate("s3://fake.ext",str(tmp_path / "certificate.txt"))
+        text = log.render_certificate(states,cert)
+        assert "DATANAME: groupname/inputs/dataset.ext | STATUS: SUCCESS" in text
+
+    def test_NeuroCAASDataStatusLegacy_events_writer(self,tmp_path):
+        ## by default, datasets with the same basename in different folders get their own writers. 
+        writers = []
+        for folder in ["a","b"]:
+            ncds = log.NeuroCAASDataStatusLegacy("s3://fake.ext",str(tmp_path / folder / "DATASTATUS.json"))
+            ncds.rawfile["input"] = "groupname/inputs/{}/data.ext".format(folder)
+            writers.append(ncds.enable_events().writer)
+        assert writers == [log.get_dataset_key("groupname/inputs/a/data.ext"),log.get_dataset_key("groupname/inputs/b/data.ext")]
+        assert writers[0] != writers[1]
+
 
 class Test_WriteObj():
     def setup_method(self):
@@ -464,6 +880,18 @@ class Test_WriteObj():
             
         for k in data_dict:    
             assert data_dict[k] == data[k]
+
+    def test_WriteObj_put_async(self):    
+        key = "object.json"
+        queue = log.UploadQueue()
+        wo = log.WriteObj({"loc":"s3","bucket":self.bucket_name,"key":key},queue)
+        data_dict = {"a":"aa"}
+        wo.put_json(data_dict)
+        data_dict["a"] = "bb" ## the body is captured when submitted. 
+        assert wo.flush(10)
+        remote = self.session_ls.resource("s3").Object(self.bucket_name,key).get()["Body"].read().decode("utf-8")
+        assert json.loads(remote) == {"a":"aa"}
+        assert queue.close()
         
     def teardown_method(self):
         s3_localclient = self.session_ls.client("s3")
@@ -2,10 +2,13 @@
 from botocore.exceptions import ClientError
 import pytest
 import json
+import time
 import logging
+import numpy as np
 import os
 import localstack_client.session
 import neurocaas_contrib.monitor as monitor
+import neurocaas_contrib.log as log
 from testpaths import get_dict_file 
 
 if get_dict_file() == "ci":
@@ -144,6 +147,55 @@ def test_get_analysis_cost(setup_log_bucket):
     assert cost == 54.82423500000001 
     
 
+def test_CostSummary(setup_log_bucket):
+    bucket_name = setup_log_bucket
+    group = "costsummarygroup"
+    s3_client = monitor.s3_client
+    keys = [monitor.CostSummary.get_key(group),"logs/{}/i-1.json".format(group),"logs/{}/i-2.json".format(group)]
+    ## start from scratch, in case the bucket persists from a previous run. 
+    for key in keys:
+        s3_client.delete_object(Bucket = bucket_name,Key = key)
+    report = {"instance-id":"i-1","price":1.0,"databucket":bucket_name,"jobpath":group+"/results/job1","start":"2020-06-03T20:00:00Z","end":None}
+    s3_client.put_object(Bucket = bucket_name,Key = "logs/{}/i-1.json".format(group),Body = json.dumps(report))
+    assert monitor.get_analysis_cost(group,bucket_name) == 1.0
+    summary = monitor.CostSummary.load(bucket_name,group)
+    assert summary.count == 1
+    assert list(summary.open_reports.keys()) == ["logs/{}/i-1.json".format(group)]
+    ## nothing new to read. 
+    assert summary.update(bucket_name) == 0
+    ## finish the open report, and add a new one. 
+    report["end"] = "2020-06-03T20:30:00Z"
+    s3_client.put_object(Bucket = bucket_name,Key = "logs/{}/i-1.json".format(group),Body = json.dumps(report))
+    report["instance-id"] = "i-2"
+    s3_client.put_object(Bucket = bucket_name,Key = "logs/{}/i-2.json".format(group),Body = json.dumps(report))
+    assert monitor.get_analysis_cost(group,bucket_name) == 1.0
+    summary = monitor.CostSummary.load(bucket_name,group)
+    assert summary.count == 2
+    assert summary.open_reports == {}
+    ## other tests expect only the original users in the bucket. 
+    for key in keys:
+        s3_client.delete_object(Bucket = bucket_name,Key = key)
+
+def test_CostSummary_unsorted(setup_log_bucket):
+    bucket_name = setup_log_bucket
+    group = "costsummaryunsorted"
+    s3_client = monitor.s3_client
+    keys = [monitor.CostSummary.get_key(group)]+["logs/{}/i-{}.json".format(group,i) for i in [1,2,3]]
+    for key in keys:
+        s3_client.delete_object(Bucket = bucket_name,Key = key)
+    report = {"instance-id":"i-2","price":1.0,"databucket":bucket_name,"jobpath":group+"/results/job1","start":"2020-06-03T20:00:00Z","end":"2020-06-03T21:00:00Z"}
+    s3_client.put_object(Bucket = bucket_name,Key = keys[2],Body = json.dumps(report))
+    assert monitor.get_analysis_cost(group,bucket_name) == 1.0
+    ## instance ids are not issued in sorted order: new reports before and after the ones already folded in are both picked up on the next call. 
+    for key in [keys[1],keys[3]]:
+        s3_client.put_object(Bucket = bucket_name,Key = key,Body = json.dumps(report))
+    assert monitor.get_analysis_cost(group,bucket_name) == 3.0
+    summary = monitor.CostSummary.load(bucket_name,group)
+    assert summary.count == 3
+    assert summary.update(bucket_name) == 0
+    for key in keys:
+        s3_client.delete_object(Bucket = bucket_name,Key = key)
+
 def test_check_bucket_exists(setup_log_bucket):    
     path = "bendeskylab"
     bucket_name = setup_log_bucket
@@ -171,6 +223,28 @@ def test_get_jobs(setup_log_bucket):
     jobs = monitor.get_jobs(l)
     assert len(jobs) == 290 
 
+def test_load_json_concurrent(setup_log_bucket):
+    bucket_name = setup_log_bucket
+    user_dict = monitor.get_user_logs(bucket_name) 
+    keys = user_dict["bendeskylab"]
+    loaded = dict(monitor.load_json_concurrent(bucket_name,keys,workers = 4))
+    assert set(loaded.keys()) == set(keys)
+    for key in keys:
+        assert loaded[key] == monitor.load_json(bucket_name,key)
+
+def test_get_json_retry_invalid(setup_log_bucket):
+    ## parse errors name the log that could not be parsed. 
+    bucket_name = setup_log_bucket
+    key = "logs/invalidgroup/i-invalid.json"
+    monitor.s3_client.put_object(Bucket = bucket_name,Key = key,Body = b"{not json")
+    try:
+        with pytest.raises(ValueError,match = "s3://{}/{}".format(bucket_name,key)):
+            monitor.get_json_retry(bucket_name,key)
+        with pytest.raises(ValueError,match = "s3://{}/{}".format(bucket_name,key)):
+            monitor.load_json(bucket_name,key)
+    finally:
+        monitor.s3_client.delete_object(Bucket = bucket_name,Key = key)
+
 def test_calculate_usage(setup_log_bucket):
     path = "bendeskylab"
     bucket_name = setup_log_bucket
@@ -202,6 +276,128 @@ def test_postprocess_jobdict(setup_log_bucket,path,nb):
 
     assert sum([len(l["instances"]) for l in usage_filtered.values()]) == nb 
 
+def test_iter_log_objects(setup_log_bucket):
+    bucket_name = setup_log_bucket
+    prefixes,contents = monitor.list_log_prefixes(bucket_name)
+    assert all([p.startswith("logs/") and p.endswith("/") for p in prefixes])
+    keys = [c["Key"] for c in contents]+[o["Key"] for o in monitor.iter_log_objects(bucket_name,prefixes,workers = 2)]
+    assert sorted(keys) == sorted(monitor.ls_name(bucket_name,"logs/"))
+
+def test_get_events(setup_log_bucket,monkeypatch):
+    bucket_name = setup_log_bucket
+    monkeypatch.setattr(log,"s3_resource",localstack_client.session.Session().resource("s3"))
+    logprefix = "eventsgroup/results/job__test/logs"
+    streams = {writer:log.EventStream(log.WriteObj({"loc":"s3","bucket":bucket_name,"key":logprefix+"/certificate.txt"}),writer) for writer in ["a.ext","b.ext"]}
+    try:
+        for writer,stream in streams.items():
+            stream.emit("status",input = writer,status = "IN PROGRESS")
+            stream.emit("usage",cpu_percent = 1.0,memory_mb = 10.0)
+            stream.flush()
+        events,offsets = monitor.get_events(bucket_name,logprefix)
+        assert len(events) == 4
+        assert offsets == {"a.ext":2,"b.ext":2}
+        ## only new events are returned. 
+        streams["a.ext"].emit("status",input = "a.ext",status = "SUCCESS")
+        streams["a.ext"].flush()
+        events,offsets = monitor.get_events(bucket_name,logprefix,offsets)
+        assert [(e["writer"],e["i"]) for e in events] == [("a.ext",2)]
+        assert offsets == {"a.ext":3,"b.ext":2}
+        assert monitor.get_events(bucket_name,logprefix,offsets)[0] == []
+        states = log.apply_events(monitor.get_events(bucket_name,logprefix)[0])
+        assert states["a.ext"]["status"] == "SUCCESS"
+        assert states["b.ext"]["usage"]["cpu_percent"] == 1.0
+    finally:
+        for key in monitor.ls_name(bucket_name,logprefix):
+            monitor.s3_client.delete_object(Bucket = bucket_name,Key = key)
+
+def test_JobLedger(setup_log_bucket):
+    bucket_name = setup_log_bucket
+    user_dict = monitor.get_user_logs(bucket_name)
+    ledger = monitor.JobLedger.from_user_logs(bucket_name,user_dict)
+    assert len(ledger.instances) == sum([len(v) for v in user_dict.values()])
+    assert ledger.get_cost("bendeskylab") == monitor.get_analysis_cost("bendeskylab",bucket_name)
+    for user in user_dict.keys():
+        assert ledger.get_parallelism(user) == monitor.calculate_parallelism(bucket_name,user_dict[user],user)
+        assert ledger.get_usage(user) == monitor.calculate_usage(bucket_name,user_dict[user],user)
+
+def test_UsageIndex(setup_log_bucket,tmp_path):
+    bucket_name = setup_log_bucket
+    usage_index = monitor.UsageIndex(str(tmp_path / "usage.db"))
+    assert usage_index.get_watermark(bucket_name) is None
+    count = usage_index.ingest(bucket_name)
+    assert count > 0
+    assert usage_index.get_watermark(bucket_name) is not None
+    ## nothing has changed, so nothing should be read. 
+    assert usage_index.ingest(bucket_name) == 0
+    user_dict = monitor.get_user_logs(bucket_name)
+    assert usage_index.get_user_logs(bucket_name) == {user:sorted(keys) for user,keys in user_dict.items()}
+    ledger = usage_index.get_ledger(bucket_name)
+    for user in user_dict.keys():
+        assert ledger.get_parallelism(user) == monitor.calculate_parallelism(bucket_name,user_dict[user],user)
+
+def test_UsageIndex_deleted(setup_log_bucket,tmp_path):
+    bucket_name = setup_log_bucket
+    key = "logs/bendeskylab/i-deleted.json"
+    report = {"instance-id":"i-deleted","instance-type":"p2.xlarge","price":1.0,"databucket":bucket_name,"jobpath":"bendeskylab/results/job1","start":"2020-06-03T20:00:00Z","end":"2020-06-03T21:00:00Z"}
+    usage_index = monitor.UsageIndex(str(tmp_path / "usage.db"))
+    try:
+        monitor.s3_client.put_object(Bucket = bucket_name,Key = key,Body = json.dumps(report))
+        usage_index.ingest(bucket_name)
+        assert key in usage_index.get_user_logs(bucket_name)["bendeskylab"]
+        assert usage_index.removed == 0
+    finally:
+        monitor.s3_client.delete_object(Bucket = bucket_name,Key = key)
+    ## deleted logs are removed, without rereading the others. 
+    assert usage_index.ingest(bucket_name) == 0
+    assert usage_index.removed == 1
+    assert key not in usage_index.get_user_logs(bucket_name)["bendeskylab"]
+
+def test_UsageTable(tmp_path):
+    keys = ["logs/user1/i-2.json","logs/user1/i-1.json","logs/user2/i-3.json"]
+    usage_dicts = [
+            {"instance-id":"i-2","price":2.0,"databucket":"stack","jobpath":"user1/results/job1","datapath":["group1/inputs/a.ext","group1/inputs/b.ext"],"start":"2020-06-03T20:00:00Z","end":"2020-06-03T21:00:00Z"},
+            {"instance-id":"i-1","price":1.0,"databucket":"stack","jobpath":"user1/results/job1","datapath":"group1/inputs/c.ext","start":"2020-07-03T20:00:00Z","end":"2020-07-03T20:30:00Z"},
+            {"instance-id":"i-3","price":1.0,"databucket":"stack","jobpath":"user2/results/job2","start":None,"end":"2020-07-03T20:30:00Z"},
+            ]
+    table = monitor.UsageTable.from_logs(keys,usage_dicts,["user1","user1","user2"])
+    assert list(table.data["key"]) == sorted(keys)
+    assert list(table.data["datapath"]) == ["group1/inputs/c.ext","group1/inputs/a.ext",""]
+    usage = table.get_usage("user1")
+    assert usage["cost"]["June"] == 2.0
+    assert usage["duration"]["July"] == 1800
+    totals = table.user_totals()
+    assert totals["user1"]["cost"] == 2.5
+    assert totals["user2"]["cost"] == 1.0 ## charged for the hour.
+    assert table.job_parallelism() == {"user1/results/job1":2,"user2/results/job2":1}
+    table.save(str(tmp_path / "table.npy"))
+    loaded = monitor.UsageTable.load(str(tmp_path / "table.npy"))
+    assert loaded.data.dtype == table.data.dtype
+    assert list(loaded.data["key"]) == list(table.data["key"])
+    assert np.isnat(loaded.data["start"][-1])
+
+def test_sweep_concurrency():
+    ## intervals that only touch are not concurrent, and zero length intervals are ignored.
+    stats = monitor.concurrency_stats(*monitor.sweep_concurrency([0,5,10,10,30],[10,15,20,12,30]))[0]
+    assert stats["peak"] == 3
+    assert stats["busy"] == 20
+    assert stats["histogram"] == {1:10,2:8,3:2}
+    assert stats["average"] == 32/20
+    stats = monitor.concurrency_stats(*monitor.sweep_concurrency([0,5,100],[10,15,110],[0,0,1]),ngroups = 2)
+    assert [s["peak"] for s in stats] == [2,1]
+
+def test_UsageTable_concurrency():
+    keys = ["logs/user1/i-1.json","logs/user1/i-2.json","logs/user2/i-3.json"]
+    usage_dicts = [
+            {"instance-id":"i-1","price":1.0,"databucket":"stack","jobpath":"user1/results/job1","start":"2020-06-03T20:00:00Z","end":"2020-06-03T21:00:00Z"},
+            {"instance-id":"i-2","price":1.0,"databucket":"stack","jobpath":"user1/results/job1","start":"2020-06-03T20:30:00Z","end":"2020-06-03T21:30:00Z"},
+            {"instance-id":"i-3","price":1.0,"databucket":"stack","jobpath":"user2/results/job2","start":"2020-06-03T21:00:00Z","end":"2020-06-03T22:00:00Z"},
+            ]
+    table = monitor.UsageTable.from_logs(keys,usage_dicts,["user1","user1","user2"])
+    assert table.concurrency()["histogram"] == {1:3600,2:3600}
+    jobs = table.concurrency("jobpath")
+    assert jobs["user1/results/job1"]["peak"] == 2
+    assert jobs["user2/results/job2"]["average"] == 1
+
 def test_RangeFinder():
     "WrITE ASSERTS "
     rf = monitor.RangeFinder()
@@ -209,6 +405,32 @@ def test_RangeFinder():
     rf.update("2010-12-04T12:55:12Z")
     rf.return_range()
     
+def test_LambdaMonitor_cache(monkeypatch,tmp_path):
+    monkeypatch.setattr(monitor.JobMonitor,"get_lambda_id",lambda self: "lambdaid")
+    jm = monitor.JobMonitor("stackname",cache_dir = str(tmp_path))
+    calls = []
+    def fetch_events(start,end):
+        calls.append(start)
+        return [{"logStreamName":"s{}".format(start%2),"timestamp":start,"message":"m{}".format(start),"eventId":str(start)}]
+    monkeypatch.setattr(jm,"fetch_events",fetch_events)
+    first = jm.get_logs(hours = 3)
+    nb_calls = len(calls)
+    ## closed windows are served from the cache, only the most recent ones are fetched again. 
+    assert jm.get_logs(hours = 3) == first
+    assert len(calls) - nb_calls <= 2
+    ## follow only passes on events it has not seen. 
+    seen = []
+    jm.follow(max_polls = 2,interval = 0,callback = seen.append)
+    assert len(seen) == 1
+
+def test_parse_events():
+    events = [
+            {"logStreamName":"a","timestamp":1,"message":"first","eventId":"1"},
+            {"logStreamName":"b","timestamp":2,"message":"other","eventId":"2"},
+            {"logStreamName":"a","timestamp":3,"message":"second","eventId":"3"},
+            ]
+    assert monitor.LambdaMonitor.parse_events(None,events) == [{"a":"first second"},{"b":"other"}]
+
 class Test_JobMonitor():
     def test_get_lambda_id(self,tmp_path):
         submitdict = {"dataname":"fakedata","configname":"fakeconfig","timestamp":"faketime"}
@@ -336,6 +558,62 @@ def test_get_logfiles(setup_analysis_bucket,tmp_path):
     for c in ["certificate.txt","DATASTATUS.json","logfile.txt"]:
         assert c in [os.path.basename(ci) for ci in contents] 
    
+def test_get_logfiles_manifest(setup_analysis_bucket,tmp_path):
+    bucket_name = setup_analysis_bucket
+    manifest = {}
+    assert monitor.get_logfiles(bucket_name,"user1/results/completed_job",str(tmp_path),manifest) == 3
+    ## nothing has changed, so nothing should be downloaded. 
+    assert monitor.get_logfiles(bucket_name,"user1/results/completed_job",str(tmp_path),manifest) == 0
+    ## missing local files are downloaded again.
+    os.remove(os.path.join(tmp_path,"logs","certificate.txt"))
+    assert monitor.get_logfiles(bucket_name,"user1/results/completed_job",str(tmp_path),manifest) == 1
+
+def test_get_logfiles_subfolders(setup_analysis_bucket,tmp_path):
+    bucket_name = setup_analysis_bucket
+    s3_client = monitor.s3_client
+    logs = "user1/results/completed_job/logs/"
+    for key in ["certificate.txt","DATASTATUS.json","logfile.txt","events/writer1/000000000.jsonl","events/writer2/000000000.jsonl","DATASTATUS.json.chunks/000000000.json","certificate_shards/dataset.json"]:
+        s3_client.put_object(Bucket = bucket_name,Key = logs+key,Body = b"{}")
+    manifest = {}
+    assert monitor.get_logfiles(bucket_name,"user1/results/completed_job",str(tmp_path),manifest) == 3
+    assert sorted(os.listdir(os.path.join(tmp_path,"logs"))) == ["DATASTATUS.json","certificate.txt","logfile.txt"]
+    assert all([key.count("/") == 4 for key in manifest])
+
+def test_get_results(setup_analysis_bucket,tmp_path):
+    bucket_name = setup_analysis_bucket
+    assert monitor.get_results(bucket_name,"user1/results/completed_job",str(tmp_path)) == 1
+    assert "end.txt" in os.listdir(os.path.join(tmp_path,"process_results"))
+    ## already in sync.
+    assert monitor.get_results(bucket_name,"user1/results/completed_job",str(tmp_path)) == 0
+
+def test_get_results_sync(setup_log_bucket,tmp_path,capsys):
+    bucket_name = setup_log_bucket
+    prefix = "resultsgroup/results/job__test"
+    keys = ["{}/process_results/{}.txt".format(prefix,i) for i in range(3)]
+    try:
+        for key in keys:
+            monitor.s3_client.put_object(Bucket = bucket_name,Key = key,Body = key.encode("utf-8"))
+        assert monitor.get_results(bucket_name,prefix,str(tmp_path),workers = 2) == 3
+        with open(tmp_path / "process_results" / "0.txt","r") as f:
+            assert f.read() == keys[0]
+        ## only the changed file is downloaded, and the others are reported as in sync. 
+        monitor.s3_client.put_object(Bucket = bucket_name,Key = keys[0],Body = b"changed")
+        capsys.readouterr()
+        assert monitor.get_results(bucket_name,prefix,str(tmp_path),workers = 2) == 1
+        err = capsys.readouterr().err
+        assert "Downloaded 1 results" in err and "2 already in sync" in err
+        assert monitor.get_results(bucket_name,prefix,str(tmp_path),workers = 2) == 0
+        assert "3 already in sync" in capsys.readouterr().err
+        ## files that cannot be written locally are not counted. 
+        monitor.s3_client.put_object(Bucket = bucket_name,Key = keys[1],Body = b"changed")
+        monitor.s3_client.put_object(Bucket = bucket_name,Key = keys[2],Body = b"changed")
+        os.remove(tmp_path / "process_results" / "2.txt")
+        os.mkdir(tmp_path / "process_results" / "2.txt")
+        assert monitor.get_results(bucket_name,prefix,str(tmp_path),workers = 2) == 1
+    finally:
+        for key in keys:
+            monitor.s3_client.delete_object(Bucket = bucket_name,Key = key)
+
 @pytest.mark.parametrize("path,out",[("user1/results/completed_job",True),("user1/results/uncompleted_job",False)])
 def test_get_end(setup_analysis_bucket,path,out):   
     bucket_name = setup_analysis_bucket
@@ -350,6 +628,21 @@ def test_poll(setup_analysis_bucket,tmp_path,path,out,local):
     assert "certificate.txt" in os.listdir(os.path.join(sub_write,"logs")) 
 
 
+def test_setup_polling_timeout(monkeypatch,tmp_path):
+    ## adaptive waits are cut short at the timeout. 
+    sleeps = []
+    sleep = monitor.time.sleep
+    def recorded_sleep(seconds):
+        sleeps.append(seconds)
+        sleep(seconds)
+    monkeypatch.setattr(monitor,"get_logfiles",lambda *args: 0)
+    monkeypatch.setattr(monitor,"get_end",lambda *args: False)
+    monkeypatch.setattr(monitor.time,"sleep",recorded_sleep)
+    start = time.time()
+    assert monitor.setup_polling("bucket","path",str(tmp_path),step = 0.2,timeout = 1,max_step = 10,backoff = 4) == 1
+    assert time.time()-start < 1.5
+    assert max(sleeps) <= 1
+
 @pytest.mark.parametrize("path,out,local",[("user1/results/completed_job",True,"sub1"),("user1/results/uncompleted_job",False,"sub2")])
 def test_setup_polling(setup_analysis_bucket,tmp_path,path,out,local):
     """Tests that exit codes are correct, and polling returns results after successfully completing. 
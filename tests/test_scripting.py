@@ -3,6 +3,9 @@ import neurocaas_contrib.Interface_S3 as Interface_S3
 import neurocaas_contrib.log as log
 import localstack_client.session
 import shlex
+import zipfile
+import sys
+import time
 import json
 import pytest
 import os
@@ -38,6 +41,40 @@ def test_parse_zipfile(name,value):
         assert folder == "dir2"
         assert os.path.exists(os.path.join(os.path.dirname(zippath),folder))
 
+def make_zipfile(zippath,nfiles = 20):
+    contents = {"dir3/sub{}/file{}.txt".format(i%3,i):("line {}\n".format(i)*1000*(i+1)).encode("utf-8") for i in range(nfiles)}
+    with zipfile.ZipFile(zippath,"w",compression = zipfile.ZIP_DEFLATED) as archive:
+        for name,content in contents.items():
+            archive.writestr(name,content)
+    return contents        
+
+@pytest.mark.parametrize("workers",[1,4])
+def test_parse_zipfile_parallel(tmp_path,workers):
+    zippath = str(tmp_path / "dir3.zip")
+    contents = make_zipfile(zippath)
+    assert scripting.parse_zipfile(zippath,workers = workers) == "dir3"
+    for name,content in contents.items():
+        with open(tmp_path / name,"rb") as f:
+            assert f.read() == content
+
+def test_parse_zipfile_closed(tmp_path,monkeypatch):
+    ## the archive is closed even if it is rejected. 
+    opened = []
+    def tracking_open(*args,**kwargs):
+        opened.append(open(*args,**kwargs))
+        return opened[-1]
+    monkeypatch.setattr(scripting,"open",tracking_open,raising = False)
+    notzip = tmp_path / "notzip.zip"
+    notzip.write_bytes(b"not a zip file")
+    with pytest.raises(AssertionError):
+        scripting.parse_zipfile(str(notzip))
+    with zipfile.ZipFile(tmp_path / "two.zip","w") as archive:
+        archive.writestr("a/file.txt","a")
+        archive.writestr("b/file.txt","b")
+    with pytest.raises(AssertionError):
+        scripting.parse_zipfile(str(tmp_path / "two.zip"))
+    assert len(opened) == 2 and all([f.closed for f in opened])
+
 @pytest.fixture
 def setup_full_bucket(monkeypatch):
     """Makes a simple bucket in localstack named testinterface with the following internal structure:  
@@ -82,16 +119,76 @@ def setup_full_bucket(monkeypatch):
     s3_client.upload_file(os.path.join(loc,"test_mats","certificate.txt"),bucketname,os.path.join("user","results","job__test","logs","certificate.txt"))    
     return bucketname,username,contents,s3_client,s3_resource    
 
-def test_log_process():        
+def test_log_process(tmp_path):        
     badscript = os.path.join(loc,"test_mats","sendtime_br.sh")
     goodscript = os.path.join(loc,"test_mats","sendtime.sh")
-    logpath = os.path.join(loc,"test_mats","log","logfile.txt")
+    ## the logger writes status, shard and event files next to the log. 
+    logpath = str(tmp_path / "logfile.txt")
 
     brcode = scripting.log_process(shlex.split(badscript),logpath,"s3://fakepath/fakefile.txt")
     gdcode = scripting.log_process(shlex.split(goodscript),logpath,"s3://fakepath/fakefile.txt")
     assert brcode == 127
     assert gdcode == 0
 
+def test_log_process_s3(setup_full_bucket,tmp_path):        
+    ## the default certificate mode works with the pinned version of boto3, and keeps the certificate up to date. 
+    bucketname,username,contents,s3_client,s3_resource = setup_full_bucket
+    goodscript = os.path.join(loc,"test_mats","sendtime.sh")
+    s3status = "s3://{}/{}/results/job__test/logs/DATASET_NAME-file.json_STATUS.txt.json".format(bucketname,username)
+    assert scripting.log_process(shlex.split(goodscript),str(tmp_path / "logfile.txt"),s3status) == 0
+    certificate = s3_resource.Object(bucketname,"{}/results/job__test/logs/certificate.txt".format(username)).get()["Body"].read().decode("utf-8")
+    assert "STATUS: SUCCESS" in certificate
+
+def test_JobLogger(tmp_path):        
+    badscript = os.path.join(loc,"test_mats","sendtime_br.sh")
+    goodscript = os.path.join(loc,"test_mats","sendtime.sh")
+    joblogger = scripting.JobLogger("s3://fakepath/certificate.txt",str(tmp_path),min_interval = 0)
+    for i,script in enumerate([goodscript,badscript]):
+        joblogger.add(shlex.split(script),str(tmp_path / "log_{}.txt".format(i)),"s3://fakepath/fakefile.txt",str(tmp_path / "DATASTATUS_{}.json".format(i)))
+    assert joblogger.run() == [0,127]
+    statuses = []
+    for i in range(2):
+        with open(tmp_path / "DATASTATUS_{}.json".format(i),"r") as f:
+            statuses.append(json.load(f)["status"])
+    assert statuses == ["SUCCESS","FAILED"]
+    assert "certificate.txt" in os.listdir(tmp_path)
+
+def test_JobLogger_background(tmp_path):        
+    ## a background process holds on to the output after the process exits. 
+    command = ["bash","-c","sleep 8 & echo hi; printf '\\xe2\\x82'"]
+    joblogger = scripting.JobLogger("s3://fakepath/certificate.txt",str(tmp_path),min_interval = 0)
+    job = joblogger.add(command,str(tmp_path / "log.txt"),"s3://fakepath/fakefile.txt",str(tmp_path / "DATASTATUS.json"))
+    start = time.time()
+    assert joblogger.run() == [0]
+    assert time.time()-start < 5
+    ## incomplete utf-8 sequences at the end of the output are not dropped. 
+    assert job.get_tail()[1] == ["hi\n","\ufffd"]
+
+def test_JobLogger_uploadfail(tmp_path,monkeypatch):        
+    monkeypatch.setattr(scripting.upload_queue,"flush",lambda timeout = None: False)
+    goodscript = os.path.join(loc,"test_mats","sendtime.sh")
+    joblogger = scripting.JobLogger("s3://fakepath/certificate.txt",str(tmp_path),min_interval = 0)
+    joblogger.add(shlex.split(goodscript),str(tmp_path / "log.txt"),"s3://fakepath/fakefile.txt",str(tmp_path / "DATASTATUS.json"))
+    assert joblogger.run() == [0]
+    with open(tmp_path / "certificate.txt","r") as f:
+        assert "LOGFAIL" in f.read()
+
+def test_JobLogger_pump(tmp_path):        
+    command = [sys.executable,"-c","for i in range(5000): print('line {}'.format(i))"]
+    logpath = tmp_path / "log.txt"
+    joblogger = scripting.JobLogger("s3://fakepath/certificate.txt",str(tmp_path),min_interval = 0,publish_bytes = 4096)
+    job = joblogger.add(command,str(logpath),"s3://fakepath/fakefile.txt",str(tmp_path / "DATASTATUS.json"))
+    assert joblogger.run() == [0]
+    ## full output is tee'd to the logfile, and only the tail is kept in memory. 
+    with open(logpath,"r") as f:
+        assert len(f.readlines()) == 5000
+    assert job.lines == 5000
+    assert job.stdstub == "line 4999"
+    with open(tmp_path / "DATASTATUS.json","r") as f:
+        status = json.load(f)
+    assert status["std"]["4999"] == "line 4999\n"
+    assert len(status["std"]) == 100
+
 @pytest.mark.skip
 def test_register_data():    
     s3datapath = "s3://bucketname/groupname/inputs/data.txt"
@@ -316,6 +413,61 @@ class Test_NeuroCAASScriptManager():
         assert ncsm.registration["additional_files"][filename]["local"] == str(tmp_path / "extra.json") 
         assert not ncsm.get_file(filename,path = tmp_path)
 
+    def test_stage_all(self,tmp_path,setup_full_bucket):
+        bucketname,username,contents,s3_client,s3_resource = setup_full_bucket
+        subdir = tmp_path / "subdir"
+        subdir.mkdir()    
+        ncsm = scripting.NeuroCAASScriptManager(subdir)
+        assert ncsm.stage_all() == {"additional_files":{}}
+        ncsm.register_data(f"s3://{bucketname}/{username}/inputs/file.json")
+        ncsm.register_config(f"s3://{bucketname}/{username}/configs/config.json")
+        ncsm.register_file("extra",f"s3://{bucketname}/{username}/inputs/extra.json")
+        (tmp_path / "source").mkdir()
+        localsource = tmp_path / "source" / "model.json"
+        with open(localsource,"w") as f:
+            json.dump({"weights":[1,2]},f)
+        ncsm.register_file_local("model",localsource)
+        assert ncsm.stage_all() == {"data":True,"config":True,"additional_files":{"extra":True,"model":True}}
+        registration = scripting.NeuroCAASScriptManager.from_registration(subdir).registration
+        assert registration["data"]["local"] == str(subdir / "inputs" / "file.json") 
+        assert registration["config"]["local"] == str(subdir / "configs" / "config.json") 
+        assert registration["additional_files"]["extra"]["local"] == str(subdir / "inputs" / "extra.json") 
+        assert registration["additional_files"]["model"]["local"] == str(subdir / "inputs" / "model.json") 
+        for key,content in contents.items():
+            with open(subdir / key,"r") as f:
+                assert json.load(f) == content
+        assert ncsm.stage_all() == {"data":False,"config":False,"additional_files":{"extra":False,"model":False}}
+        assert ncsm.stage_all(path = tmp_path,force = True) == {"data":True,"config":True,"additional_files":{"extra":True,"model":True}}
+        assert ncsm.registration["data"]["local"] == str(tmp_path / "file.json") 
+        ## corrupted downloads are caught. 
+        with pytest.raises(AssertionError):
+            Interface_S3.verify_download(str(tmp_path / "file.json"),len(json.dumps(contents["inputs/file.json"])),'"0123"')
+
+    def test_stage_all_partial(self,tmp_path,setup_full_bucket):
+        ## inputs that were fetched are recorded even if another download fails.
+        bucketname,username,contents,s3_client,s3_resource = setup_full_bucket
+        ncsm = scripting.NeuroCAASScriptManager(tmp_path)
+        ncsm.register_data(f"s3://{bucketname}/{username}/inputs/file.json")
+        ncsm.register_config(f"s3://{bucketname}/{username}/configs/config.json")
+        s3_client.delete_object(Bucket = bucketname,Key = f"{username}/configs/config.json")
+        with pytest.raises(Exception):
+            ncsm.stage_all()
+        registration = scripting.NeuroCAASScriptManager.from_registration(tmp_path).registration
+        assert registration["data"]["local"] == str(tmp_path / "inputs" / "file.json") 
+        assert "local" not in registration["config"]
+
+    def test_parse_zipfile_s3(self,tmp_path,setup_full_bucket):
+        bucketname,username,contents,s3_client,s3_resource = setup_full_bucket
+        zippath = str(tmp_path / "dir3.zip")
+        zipcontents = make_zipfile(zippath)
+        s3_client.upload_file(zippath,bucketname,"user/inputs/dir3.zip")
+        outpath = tmp_path / "out"
+        outpath.mkdir()
+        assert scripting.parse_zipfile(f"s3://{bucketname}/user/inputs/dir3.zip",str(outpath),workers = 4) == "dir3"
+        for name,content in zipcontents.items():
+            with open(outpath / name,"rb") as f:
+                assert f.read() == content
+
     @pytest.mark.parametrize("source",["s3","local"])
     def test_put_result(self,tmp_path,setup_full_bucket,source):    
         bucketname,username,contents,s3_client,s3_resource = setup_full_bucket
@@ -338,6 +490,50 @@ class Test_NeuroCAASScriptManager():
             ncsm.put_result(str(fullpath))
             assert os.path.exists(os.path.join(writepath,"process_results",os.path.basename(fullpath)))
         
+    @pytest.mark.parametrize("source",["s3","local"])
+    def test_put_results_dir(self,tmp_path,setup_full_bucket,source):    
+        bucketname,username,contents,s3_client,s3_resource = setup_full_bucket
+        subdir = tmp_path / "subdir"
+        subdir.mkdir()    
+        resultdir = tmp_path / "outputs"
+        (resultdir / "sub").mkdir(parents = True)
+        names = ["file.txt","sub/file2.txt","sub/file3.txt"]
+        for name in names:
+            with open(resultdir / name,"w") as f:
+                f.write(name)
+        writepath = tmp_path / "outdir"
+        writepath.mkdir()
+        statusname = "DATASET_NAME-file.json_STATUS.txt.json"
+        s3path = f"s3://{bucketname}/{username}/results/job__test"
+        ncsm = scripting.NeuroCAASScriptManager(subdir)
+        with pytest.raises(AssertionError):
+            ncsm.put_results_dir(str(resultdir))
+        ncsm.register_datastatus(f"{s3path}/logs/{statusname}",str(subdir / "logs" / "DATASTATUS.json"))
+        if source == "s3":    
+            ncsm.register_resultpath(s3path)
+        elif source == "local":    
+            ncsm.register_resultpath_local(writepath)
+        stats = ncsm.put_results_dir(str(resultdir))
+        assert stats["files"] == 3 and stats["skipped"] == 0 and stats["bytes"] == sum([len(name) for name in names])
+        for name in names:
+            if source == "s3":
+                s3_client.head_object(Bucket = bucketname,Key = f"{username}/results/job__test/process_results/outputs/{name}")
+            elif source == "local":    
+                assert os.path.exists(writepath / "process_results" / "outputs" / name)
+        ## unchanged files are skipped, even if they are touched. 
+        os.utime(resultdir / "file.txt")
+        with open(resultdir / "sub" / "file2.txt","w") as f:
+            f.write("changed")
+        stats = ncsm.put_results_dir(str(resultdir))
+        assert stats["files"] == 1 and stats["skipped"] == 2
+        assert ncsm.put_results_dir(str(resultdir),force = True)["files"] == 3
+        assert ncsm.registration["result_uploads"]["files"] == 7
+        ## totals are recorded in the datastatus object, and kept for a logged command. 
+        status = json.loads(s3_client.get_object(Bucket = bucketname,Key = f"{username}/results/job__test/logs/{statusname}")["Body"].read())
+        assert status["result_uploads"]["files"] == 7
+        with open(subdir / "logs" / "result_uploads.json","r") as f:
+            assert json.load(f)["files"] == 7
+
     def test_get_name(self,tmp_path):
         contents_empty = {"s3":None,"local":None}
         contents_remote = {"s3":"s3://bucket/group/inputs/key.txt","local":None}